@@ -7,6 +7,12 @@ import Cython.Build
 import Cython.Compiler.Options
 
 
+# Shared with devtools/bench_hot_paths.py so that benchmarks measure what ships
+COMPILER_DIRECTIVES = {
+    'language_level': '3'
+}
+
+
 def run_cython(source_directories=None, source_file=None):
     Cython.Compiler.Options.docstrings = False
     Cython.Compiler.Options.emit_code_comments = False
@@ -32,9 +38,7 @@ def run_cython(source_directories=None, source_file=None):
                                                             'heartbroken.db',
                                                             'heartbroken_auth.json'
                                                         ],
-                                                   compiler_directives={
-                                                       'language_level': '3'
-                                                   },
+                                                   compiler_directives=COMPILER_DIRECTIVES,
                                                    annotate=False
                                                    )
             )
@@ -43,9 +47,7 @@ def run_cython(source_directories=None, source_file=None):
         setup(
             ext_modules=Cython.Build.cythonize(source_file,
                                                build_dir=f'build/{operating_system}_cython_src/',
-                                               compiler_directives={
-                                                   'language_level': '3'
-                                               },
+                                               compiler_directives=COMPILER_DIRECTIVES,
                                                annotate=False,
                                                force=True
                                                )
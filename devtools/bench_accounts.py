@@ -0,0 +1,169 @@
+"""
+Benchmark of multi-account mode (libs.accounts).
+
+Serves a number of simulated accounts from one event loop against devtools.mockapi, each with its own player and
+dislikes, for some seconds of real time. Reports polls per account, skip latency, and how much memory each account
+adds, next to what one single-account app loop process takes, as JSON.
+
+    python -m devtools.bench_accounts --accounts 200 --seconds 30
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import typing
+
+from devtools import procstats
+from devtools.import_budget import SCENARIOS
+from devtools.mockapi import MockPlayer, MockSpotifyAPI, MockSpotifyWrapper
+from libs import accounts, utils
+from libs.database import HeartbrokenDatabase
+
+
+# ========
+def single_process_rss_kb() -> typing.Union[None, int]:
+    """
+    Peak RSS of a fresh interpreter that has imported everything the app loop needs: roughly what each account costs
+    when every account runs its own Heartbroken. Linux only.
+    """
+
+    if not os.path.exists('/proc/self/status'):
+        return None
+
+    # Not procstats.peak_rss_kb(), as getrusage() would report this process's peak, inherited through fork()
+    code = SCENARIOS['app loop'][0] + '\nprint(open("/proc/self/status").read().split("VmHWM:")[1].split()[0])'
+    repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    return int(subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                              cwd=repository).stdout)
+
+# ========
+def seed_dislikes(player: MockPlayer, database_file_name: str, fraction: float, rng: random.Random) -> int:
+    disliked = 0
+
+    for track in player.tracks:
+        if rng.random() < fraction:
+            HeartbrokenDatabase.save_heartbreak(track_id=track.id, file_name=database_file_name)
+            disliked += 1
+
+    return disliked
+
+# ========
+def run(account_count: int, seconds: float, track_count: int, track_seconds: int, disliked_fraction: float,
+        seed: int) -> dict:
+    rng = random.Random(seed)
+    registry = accounts.AccountRegistry('accounts')
+
+    players = {}
+    dislikes = 0
+
+    for index in range(account_count):
+        account = registry.add(f'account-{index:04}')
+
+        player = MockPlayer(track_count, seed=seed + index)
+        for track in player.tracks:
+            # Short tracks, so there is something to skip every few seconds
+            track.duration_ms = rng.randint(track_seconds // 2, track_seconds) * 1000
+
+        players[account.name] = player
+        dislikes += seed_dislikes(player, account.database_file_name, disliked_fraction, rng)
+
+    app_loop_should_run = threading.Event()
+    app_loop_should_run.set()
+    stop = threading.Event()
+
+    with MockSpotifyAPI(MockPlayer(1), players_by_token=players) as api:
+        rss_before_kb = procstats.peak_rss_kb()
+
+        # Setting up the accounts took a while; don't count that as time disliked tracks were playing
+        for player in players.values():
+            player.track_started = player.clock.time()
+
+        threading.Timer(seconds, stop.set).start()
+
+        make_spotify = lambda account: MockSpotifyWrapper(api, access_token=account.name)
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(accounts.serve_accounts(registry.directory, registry.accounts(), app_loop_should_run, stop,
+                                                make_spotify=make_spotify, api_url=api.url))
+
+        rss_after_kb = procstats.peak_rss_kb()
+
+    polls = api.calls['GET /me/player/currently-playing']
+    latencies_ms = [int(latency * 1000) for player in players.values() for latency in player.skip_latencies]
+
+    return {
+        'scenario': {
+            'accounts':          account_count,
+            'seconds':           seconds,
+            'tracks':            track_count,
+            'track_seconds':     track_seconds,
+            'disliked_fraction': disliked_fraction,
+            'dislikes':          dislikes,
+            'seed':              seed
+        },
+        'results': {
+            'polls_per_account_per_second': round(polls / account_count / seconds, 3),
+            'api_calls':                    dict(api.calls),
+            'skips':                        len(latencies_ms),
+            'skip_latency_ms':              {'p50': utils.percentile(latencies_ms, .5),
+                                             'p90': utils.percentile(latencies_ms, .9),
+                                             'p99': utils.percentile(latencies_ms, .99),
+                                             'max': max(latencies_ms, default=None)},
+            'peak_rss_kb':                  rss_after_kb,
+            'rss_per_account_kb':           None if rss_before_kb is None else
+                                            round((rss_after_kb - rss_before_kb) / account_count, 1),
+            'single_account_process_rss_kb': single_process_rss_kb()
+        }
+    }
+
+# ========
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark serving many accounts from one Heartbroken process')
+    parser.add_argument('--accounts',      type=int,   default=100, help='Simulated accounts (default 100)')
+    parser.add_argument('--seconds',       type=float, default=30,  help='Real seconds to run for (default 30)')
+    parser.add_argument('--tracks',        type=int,   default=100, help='Library size of each account (default 100)')
+    parser.add_argument('--track-seconds', type=int,   default=10,  help='Longest simulated track (default 10)')
+    parser.add_argument('--disliked',      type=float, default=.2,  help='Fraction of tracks disliked (default .2)')
+    parser.add_argument('--seed',          type=int,   default=0)
+    parser.add_argument('--output',        default=None, help='Write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    original_directory = os.getcwd()
+
+    # Keep the benchmark's accounts away from the real ones
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            report = run(args.accounts, args.seconds, args.tracks, args.track_seconds, args.disliked, args.seed)
+        finally:
+            os.chdir(original_directory)
+
+    report = {
+        'benchmark':  'accounts',
+        'commit':     procstats.git_commit(),
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python':     sys.version.split()[0],
+        'platform':   sys.platform,
+        **report
+    }
+
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return 0
+
+# ====
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,193 @@
+"""
+Scaling benchmark for the dislike store.
+
+Fills a fresh heartbroken.db with synthetic dislikes at increasing sizes (10^3, 10^4, ...) and measures, at each
+size, HeartbrokenDatabase.is_heartbroken latency percentiles for tracks with 1 to 10 artists, save_heartbreak and
+remove_heartbreak throughput, the time to open the store and answer the first check, and memory use.
+
+    python -m devtools.bench_dislike_store --max-exponent 7 --output store.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from devtools import procstats
+from devtools.mockapi import random_spotify_id
+from libs import utils
+from libs.database import HeartbrokenDatabase
+from libs.spotifywrapper import Track
+
+
+# ========
+def fill(size: int, rng: random.Random) -> dict:
+    """
+    Writes :size dislikes straight into the table in one transaction, 60% tracks and 20% each albums and artists.
+    Returns a sample of the IDs written so lookups can hit them.
+    """
+
+    sample = {'track': [], 'album': [], 'artist': []}
+
+    def rows():
+        for index in range(size):
+            kind = ('track', 'track', 'track', 'album', 'artist')[index % 5]
+            id_  = random_spotify_id(rng)
+
+            if len(sample[kind]) < 1000:
+                sample[kind].append(id_)
+
+            yield (id_ if kind == 'artist' else None,
+                   id_ if kind == 'album' else None,
+                   id_ if kind == 'track' else None)
+
+    connection = sqlite3.connect(HeartbrokenDatabase.file_name)
+    with connection:
+        connection.executemany('INSERT OR IGNORE INTO heartbroken VALUES (?, ?, ?)', rows())
+    connection.close()
+
+    return sample
+
+# ====
+def make_track(rng: random.Random, sample: dict, hit: bool) -> Track:
+    """
+    Builds a Track with 1 to 10 artists. If :hit, one of its IDs is disliked.
+    """
+
+    artist_ids = [random_spotify_id(rng) for _ in range(rng.randint(1, 10))]
+    album_id   = random_spotify_id(rng)
+    track_id   = random_spotify_id(rng)
+
+    if hit:
+        kind = rng.choice(('track', 'album', 'artist'))
+        if kind == 'track':
+            track_id = rng.choice(sample['track'])
+        elif kind == 'album':
+            album_id = rng.choice(sample['album'])
+        else:
+            artist_ids[rng.randrange(len(artist_ids))] = rng.choice(sample['artist'])
+
+    return Track({
+        'is_playing':  True,
+        'progress_ms': 0,
+        'item': {
+            'id':          track_id,
+            'name':        'Benchmark track',
+            'duration_ms': 180000,
+            'album':       {'id': album_id, 'name': 'Benchmark album'},
+            'artists':     [{'id': artist_id, 'name': f'Artist {n}'} for n, artist_id in enumerate(artist_ids)]
+        }
+    })
+
+# ====
+def _percentiles_us(samples: list) -> dict:
+    return {key: round(utils.percentile(samples, fraction) * 1e6, 1)
+            for key, fraction in (('p50', .5), ('p90', .9), ('p99', .99), ('p999', .999))}
+
+# ========
+def measure(size: int, lookups: int, writes: int, seed: int) -> dict:
+    rng = random.Random(seed)
+
+    HeartbrokenDatabase.maybe_create_table()
+
+    start = time.perf_counter()
+    sample = fill(size, rng)
+    fill_seconds = time.perf_counter() - start
+
+    tracks = [make_track(rng, sample, hit=(n % 2 == 0)) for n in range(lookups)]
+
+    # Startup: open the store and answer the first check, as the app does when it launches
+    start = time.perf_counter()
+    HeartbrokenDatabase.maybe_create_table()
+    HeartbrokenDatabase.is_heartbroken(tracks[0])
+    startup_seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    latencies = []
+    hits = 0
+    for track in tracks:
+        start = time.perf_counter()
+        is_heartbroken, _ = HeartbrokenDatabase.is_heartbroken(track)
+        latencies.append(time.perf_counter() - start)
+        hits += bool(is_heartbroken)
+    _, lookup_peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    new_ids = [random_spotify_id(rng) for _ in range(writes)]
+
+    start = time.perf_counter()
+    for track_id in new_ids:
+        HeartbrokenDatabase.save_heartbreak(track_id=track_id)
+    save_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for track_id in new_ids:
+        HeartbrokenDatabase.remove_heartbreak(track_id=track_id)
+    remove_seconds = time.perf_counter() - start
+
+    return {
+        'size':                size,
+        'fill_seconds':        round(fill_seconds, 3),
+        'startup_ms':          round(startup_seconds * 1000, 3),
+        'is_heartbroken_us':   _percentiles_us(latencies),
+        'hit_rate':            round(hits / lookups, 3),
+        'save_per_second':     round(writes / save_seconds, 1),
+        'remove_per_second':   round(writes / remove_seconds, 1),
+        'lookup_peak_alloc_kb': lookup_peak_bytes // 1024,
+        'database_kb':         os.path.getsize(HeartbrokenDatabase.file_name) // 1024,
+        'peak_rss_kb':         procstats.peak_rss_kb()
+    }
+
+# ========
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the Heartbroken dislike store at increasing sizes')
+    parser.add_argument('--min-exponent', type=int, default=3, help='Smallest store is 10^N dislikes (default 3)')
+    parser.add_argument('--max-exponent', type=int, default=6, help='Largest store is 10^N dislikes (default 6)')
+    parser.add_argument('--lookups', type=int, default=2000, help='is_heartbroken calls per size (default 2000)')
+    parser.add_argument('--writes',  type=int, default=500,  help='Saves and removes per size (default 500)')
+    parser.add_argument('--seed',    type=int, default=0)
+    parser.add_argument('--output',  default=None, help='Write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    original_directory = os.getcwd()
+    results = []
+
+    for exponent in range(args.min_exponent, args.max_exponent + 1):
+        size = 10 ** exponent
+        print(f'Measuring {size:,} dislikes...', file=sys.stderr)
+
+        # A fresh directory, and so a fresh heartbroken.db, for every size
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                results.append(measure(size, args.lookups, args.writes, args.seed))
+            finally:
+                os.chdir(original_directory)
+
+    report = {
+        'benchmark':  'dislike_store',
+        'commit':     procstats.git_commit(),
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python':     sys.version.split()[0],
+        'sqlite':     sqlite3.sqlite_version,
+        'platform':   sys.platform,
+        'results':    results
+    }
+
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return 0
+
+# ====
+if __name__ == '__main__':
+    sys.exit(main())
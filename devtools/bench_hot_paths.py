@@ -0,0 +1,221 @@
+"""
+Microbenchmarks for the functions that run on every poll, interpreted versus compiled with Cython.
+
+    python -m devtools.bench_hot_paths             # the build that's importable right now
+    python -m devtools.bench_hot_paths --compare   # cythonizes a copy of libs/ and runs both builds side by side
+
+--compare uses the same compiler directives (and .pxd files) as buildtools/cython_setup.py, and needs Cython and a
+C compiler.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from devtools import procstats
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PAYLOAD = {
+    'is_playing':             True,
+    'progress_ms':            48213,
+    'currently_playing_type': 'track',
+    'item': {
+        'id':          '4uLU6hMCjMI75M1A2tKUQC',
+        'name':        'Never Gonna Give You Up',
+        'type':        'track',
+        'duration_ms': 213573,
+        'album':       {'id': '6XhjNHCyCDyyGJRM5mg40G', 'name': 'Whenever You Need Somebody'},
+        'artists':     [{'id': '0gxyHStUsqpMadRV0Di1Qt', 'name': 'Rick Astley'},
+                        {'id': '1dfeR4HaWDbWqFHLkxsg1d', 'name': 'Queen'},
+                        {'id': '3WrFJ7ztbogyGnTHbHJFl2', 'name': 'The Beatles'}]
+    }
+}
+
+
+# ========
+def _benchmarks() -> dict:
+    """
+    Builds the callables to time. Imports happen here so that whichever build of libs is first on the path is used.
+    """
+
+    from libs import hbcontrol, utils
+    from libs.clock import SystemClock
+    from libs.database import HeartbrokenDatabase
+    from libs.metadata import MetadataCache
+    from libs.rules import CompiledRules, Rule
+    from libs.spotifywrapper import Track
+
+    HeartbrokenDatabase.maybe_create_table()
+    HeartbrokenDatabase.save_heartbreak(artist_id='7dGJo4pcD2V6oG8kP0tJRR')
+
+    track = Track(PAYLOAD)
+
+    class _CachedWrapper:
+        """
+        Just enough of SpotifyWrapper for skip_if_heartbroken, with no HTTP
+        """
+        clock             = SystemClock
+        current_track     = track
+        previous_track    = None
+        skipped_track_ids = set()
+
+        def update_current_track(self):
+            return self.current_track
+
+    wrapper = _CachedWrapper()
+
+    # A few thousand rules that don't match, so every check goes all the way through
+    rng = random.Random(0)
+    words = [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(5, 12))) for _ in range(3000)]
+    literal_rules = CompiledRules([Rule(field, 'contains', word) for field in ('name', 'album', 'artists')
+                                   for word in words[:1000]])
+    regex_rules   = CompiledRules([Rule('name', 'regex', rf'\b{word}\b') for word in words[:100]])
+
+    # Genre and audio feature rules, checked against a warm metadata cache
+    metadata = MetadataCache()
+    metadata.store_response(f'/artists?ids={",".join(track.artist_ids)}', 200,
+                            {'artists': [{'id': artist_id, 'genres': ['album rock', 'classic rock', 'rock']}
+                                         for artist_id in track.artist_ids]})
+    metadata.store_response(f'/audio-features?ids={track.id}', 200,
+                            {'audio_features': [{'id': track.id, 'tempo': 113.8, 'speechiness': .03}]})
+    metadata_rules = CompiledRules([Rule('genres', 'contains', word) for word in words[:1000]] +
+                                   [Rule('tempo', 'above', threshold=500.0),
+                                    Rule('speechiness', 'above', threshold=.66)])
+
+    one_artist   = ['Rick Astley']
+    two_artists  = ['Rick Astley', 'Queen']
+    four_artists = ['Rick Astley', 'Queen', 'The Beatles', 'ABBA']
+
+    return {
+        'Track.__init__':                      lambda: Track(PAYLOAD),
+        'Track.format_artist_list[1]':         lambda: Track.format_artist_list(one_artist),
+        'Track.format_artist_list[2]':         lambda: Track.format_artist_list(two_artists),
+        'Track.format_artist_list[4]':         lambda: Track.format_artist_list(four_artists),
+        'utils._deep_get (hit)':               lambda: utils._deep_get(PAYLOAD, ('item', 'album', 'name'), None),
+        'utils._deep_get (miss)':              lambda: utils._deep_get(PAYLOAD, ('item', 'show', 'name'), None),
+        'HeartbrokenDatabase.is_heartbroken':  lambda: HeartbrokenDatabase.is_heartbroken(track),
+        'CompiledRules.match[3000 contains]':  lambda: literal_rules.match(track),
+        'CompiledRules.match[100 regex]':      lambda: regex_rules.match(track),
+        'CompiledRules.match[metadata]':       lambda: metadata_rules.match(track, metadata),
+        'hbcontrol.skip_if_heartbroken':       lambda: hbcontrol.skip_if_heartbroken(wrapper)
+    }
+
+# ====
+def run_benchmarks(repeat: int) -> dict:
+    """
+    Times every benchmark, returning the best of :repeat runs in nanoseconds per call
+    """
+
+    import libs.spotifywrapper
+
+    results = {}
+    for name, function in _benchmarks().items():
+        timer = timeit.Timer(function)
+        number, _ = timer.autorange()
+        results[name] = round(min(timer.repeat(repeat, number)) / number * 1e9, 1)
+
+    compiled = not libs.spotifywrapper.__file__.endswith('.py')
+    return {'build': 'cython' if compiled else 'python', 'ns_per_call': results}
+
+# ========
+def build_compiled_copy(destination: str) -> None:
+    """
+    Copies libs/ into :destination and cythonizes it in place there, leaving the working tree untouched
+    """
+
+    from buildtools.cython_setup import COMPILER_DIRECTIVES
+
+    libs_copy = os.path.join(destination, 'libs')
+    shutil.copytree(os.path.join(REPO_ROOT, 'libs'), libs_copy,
+                    ignore=shutil.ignore_patterns('__pycache__', '*.so', '*.pyd'))
+
+    sources = [os.path.join('libs', file_name) for file_name in sorted(os.listdir(libs_copy))
+               if file_name.endswith('.py') and file_name != '__init__.py']
+
+    setup_script = (
+        'import setuptools, Cython.Build\n'
+        f'setuptools.setup(ext_modules=Cython.Build.cythonize({sources!r}, '
+        f'compiler_directives={COMPILER_DIRECTIVES!r}, quiet=True))\n'
+    )
+
+    subprocess.run([sys.executable, '-c', setup_script, 'build_ext', '--inplace'], cwd=destination, check=True,
+                   stdout=subprocess.DEVNULL)
+
+# ====
+def run_build_in_subprocess(libs_root: str, repeat: int) -> dict:
+    """
+    Runs the benchmarks in a fresh interpreter that imports libs from :libs_root
+    """
+
+    with tempfile.TemporaryDirectory() as directory:
+        environment = dict(os.environ, PYTHONPATH=os.pathsep.join((libs_root, REPO_ROOT)))
+        output = subprocess.run([sys.executable, '-m', 'devtools.bench_hot_paths', '--repeat', str(repeat)],
+                                cwd=directory, env=environment, check=True, capture_output=True, text=True).stdout
+
+    return json.loads(output)['results']
+
+# ========
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Microbenchmark Heartbroken\'s per-poll hot paths')
+    parser.add_argument('--compare', action='store_true', help='Compare the interpreted and cythonized builds')
+    parser.add_argument('--repeat', type=int, default=5, help='Timing runs per benchmark; the best is kept (default 5)')
+    parser.add_argument('--output', default=None, help='Write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    if args.compare:
+        with tempfile.TemporaryDirectory() as build_directory:
+            print('Cythonizing a copy of libs/...', file=sys.stderr)
+            build_compiled_copy(build_directory)
+
+            results = [run_build_in_subprocess(REPO_ROOT, args.repeat),
+                       run_build_in_subprocess(build_directory, args.repeat)]
+
+        interpreted, compiled = results
+        if compiled['build'] != 'cython':
+            print('WARN: the compiled build did not load; both runs are interpreted', file=sys.stderr)
+
+        print(f'\n{"":36}{"python ns":>12}{"cython ns":>12}{"speedup":>10}', file=sys.stderr)
+        for name, python_ns in interpreted['ns_per_call'].items():
+            cython_ns = compiled['ns_per_call'][name]
+            print(f'{name:36}{python_ns:>12}{cython_ns:>12}{python_ns / cython_ns:>9.2f}x', file=sys.stderr)
+
+    else:
+        # Keep the benchmark's database away from the real one
+        original_directory = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                results = [run_benchmarks(args.repeat)]
+            finally:
+                os.chdir(original_directory)
+
+    report = {
+        'benchmark':  'hot_paths',
+        'commit':     procstats.git_commit(),
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python':     sys.version.split()[0],
+        'platform':   sys.platform,
+        'results':    results if args.compare else results[0]
+    }
+
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return 0
+
+# ====
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+"""
+Benchmark of what the app loop costs while nothing is playing, and how soon it notices playing starting again.
+
+Runs the real heartbroken.app_loop against devtools.mockapi on a virtual clock through a day of breaks in listening:
+pauses of a minute up to a few hours, and the device going inactive overnight, both with playing picked up on the same
+device and on one that was opened just before. Every break is taken a few times, a random bit longer each time, so
+that when playing resumes doesn't line up with when the loop polls. Reports, for every kind of break, the requests
+made per hour of it and how long after playing resumed the loop saw it (which is how much of a disliked track would
+play), as JSON.
+
+    python -m devtools.bench_idle --rounds 5 --output results.json
+"""
+
+import argparse
+import collections
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+import heartbroken
+from devtools import procstats
+from devtools.mockapi import MockPlayer, MockSpotifyAPI, MockSpotifyWrapper
+from libs import utils
+from libs.clock import VirtualClock
+from libs.database import HeartbrokenDatabase
+
+
+PLAY_SECONDS   = 10 * 60  # Listening between the breaks
+JITTER_SECONDS = 60       # Up to this much is added to every stretch of listening and every break
+
+# (name, how playing stops, seconds until it resumes, seconds before that a new device shows up or None)
+BREAKS = (
+    ('paused 1 minute',                         'pause', 60,          None),
+    ('paused 20 minutes',                       'pause', 20 * 60,     None),
+    ('paused 3 hours',                          'pause', 3 * 60 * 60, None),
+    ('stopped 8 hours',                         'stop',  8 * 60 * 60, None),
+    ('stopped 8 hours, played on a new device', 'stop',  8 * 60 * 60, 20),
+)
+
+
+# ========
+class ScenarioPlayer (MockPlayer):
+    """
+    MockPlayer that plays out :events, (time, method, argument) in time order, as requests come in. Keeps the time
+    of every request for the track or the devices in requests, and of every poll that found something playing in
+    playing_seen.
+    """
+
+    def __init__(self, events: typing.Sequence[typing.Tuple[float, str, typing.Any]], *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.events       = collections.deque(events)
+        self.requests     = []
+        self.playing_seen = []
+
+    # ====
+    def currently_playing(self) -> typing.Union[dict, None]:
+        self._play_out()
+
+        body = super().currently_playing()
+
+        self.requests.append(self.clock.time())
+        if body is not None and body['is_playing']:
+            self.playing_seen.append(self.clock.time())
+
+        return body
+
+    # ====
+    def device_list(self) -> typing.List[dict]:
+        self._play_out()
+        self.requests.append(self.clock.time())
+        return super().device_list()
+
+    # ====
+    def _play_out(self) -> None:
+        while self.events and self.events[0][0] <= self.clock.time():
+            at, method, argument = self.events.popleft()
+
+            if method == 'add_device':
+                self.add_device(argument)
+            else:
+                getattr(self, method)(at)
+
+# ========
+def scenario(rounds: int, seed: int) -> typing.Tuple[typing.List[typing.Tuple[float, str, typing.Any]],
+                                                     typing.List[dict], float]:
+    """
+    The player's events for :rounds of BREAKS, the breaks with their times, and when the last one has been listened
+    past
+    """
+
+    rng = random.Random(seed)
+
+    events, breaks = [], []
+    now = PLAY_SECONDS
+
+    for _ in range(rounds):
+        for name, stop_method, idle_seconds, device_lead in BREAKS:
+            idle_seconds += rng.uniform(0, JITTER_SECONDS)
+
+            events.append((now, stop_method, None))
+            if device_lead is not None:
+                events.append((now + idle_seconds - device_lead, 'add_device', f'New device {len(breaks)}'))
+            events.append((now + idle_seconds, 'resume', None))
+
+            breaks.append({'name': name, 'stopped_at': now, 'resumed_at': now + idle_seconds})
+            now += idle_seconds + PLAY_SECONDS + rng.uniform(0, JITTER_SECONDS)
+
+    return events, breaks, now
+
+# ====
+def run(rounds: int, track_count: int, seed: int) -> dict:
+    events, breaks, end = scenario(rounds, seed)
+
+    clock  = VirtualClock(real_time=True)
+    player = ScenarioPlayer(events, track_count, clock, seed)
+
+    HeartbrokenDatabase.maybe_create_table()
+
+    app_loop_should_run = threading.Event()
+    app_loop_should_run.set()
+    stop = threading.Event()
+
+    def loop_target(spotify):
+        with contextlib.redirect_stdout(io.StringIO()):
+            heartbroken.app_loop(app_loop_should_run, stop, spotify)
+
+    with MockSpotifyAPI(player) as api:
+        wall_start = time.perf_counter()
+
+        loop_thread = threading.Thread(target=loop_target, args=(MockSpotifyWrapper(api, clock),))
+        loop_thread.start()
+
+        while clock.time() < end and loop_thread.is_alive():
+            time.sleep(.005)
+
+        stop.set()
+        loop_thread.join()
+
+        wall_seconds = time.perf_counter() - wall_start
+
+    # Per kind of break: [requests, seconds, how long after resuming it was seen for each one]
+    totals = {name: [0, 0, []] for name, _, _, _ in BREAKS}
+
+    for break_ in breaks:
+        seen_at = next((at for at in player.playing_seen if at >= break_['resumed_at']), None)
+        until   = break_['resumed_at'] if seen_at is None else seen_at
+
+        total = totals[break_['name']]
+        total[0] += sum(1 for at in player.requests if break_['stopped_at'] < at <= until)
+        total[1] += break_['resumed_at'] - break_['stopped_at']
+        total[2].append(float('inf') if seen_at is None else seen_at - break_['resumed_at'])
+
+    return {
+        'simulated_seconds':      round(clock.time(), 3),
+        'wall_seconds':           round(wall_seconds, 3),
+        'api_calls':              dict(api.calls),
+        'idle_requests_per_hour': round(sum(total[0] for total in totals.values()) * 3600 /
+                                        sum(total[1] for total in totals.values()), 1),
+        'breaks': {name: {'requests_per_hour':         round(requests * 3600 / seconds, 1),
+                          'resume_seen_after_seconds': {'mean': round(sum(seen_after) / len(seen_after), 2),
+                                                        'p50':  round(utils.percentile(seen_after, .5), 2),
+                                                        'max':  round(max(seen_after), 2)}}
+                   for name, (requests, seconds, seen_after) in totals.items()}
+    }
+
+# ========
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark requests while idle and how soon playing is noticed')
+    parser.add_argument('--rounds', type=int, default=3, help='Times every break is taken (default 3)')
+    parser.add_argument('--tracks', type=int, default=500, help='Size of the simulated library (default 500)')
+    parser.add_argument('--seed',   type=int, default=0)
+    parser.add_argument('--output', default=None, help='Write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    original_directory = os.getcwd()
+
+    # Keep the benchmark's database away from the real one
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            results = run(args.rounds, args.tracks, args.seed)
+        finally:
+            os.chdir(original_directory)
+
+    report = {
+        'benchmark':  'idle',
+        'commit':     procstats.git_commit(),
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python':     sys.version.split()[0],
+        'platform':   sys.platform,
+        'scenario':   {'play_seconds': PLAY_SECONDS, 'jitter_seconds': JITTER_SECONDS,
+                       'breaks': [list(break_) for break_ in BREAKS], 'rounds': args.rounds, 'tracks': args.tracks,
+                       'seed': args.seed},
+        'results':    results
+    }
+
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return 0
+
+# ====
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+Benchmark of the now-playing sources (libs.nowplaying) side by side.
+
+Runs the real heartbroken.app_loop against devtools.mockapi for some seconds of real time, once polling and once
+following a fake Spotify client over MPRIS on a private session bus (devtools.fakempris), with short tracks so there
+is plenty to skip. Reports API calls per minute and skip latency for each as JSON.
+
+    python -m devtools.bench_nowplaying --seconds 60
+
+Needs jeepney and dbus-daemon.
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+
+import heartbroken
+from devtools import procstats
+from devtools.bench_polling import seed_dislikes
+from devtools.fakempris import FakeMprisPlayer, private_session_bus
+from devtools.mockapi import MockPlayer, MockSpotifyAPI, MockSpotifyWrapper
+from libs import nowplaying, utils
+from libs.database import HeartbrokenDatabase
+
+
+# ========
+def run(source_name: str, seconds: float, track_count: int, track_seconds: int, disliked_fraction: float,
+        seed: int) -> dict:
+    rng = random.Random(seed)
+
+    player = MockPlayer(track_count, seed=seed)
+    for track in player.tracks:
+        # Short tracks, so there is something to skip every few seconds
+        track.duration_ms = rng.randint(track_seconds // 2, track_seconds) * 1000
+
+    HeartbrokenDatabase.maybe_create_table()
+    dislikes = seed_dislikes(player, disliked_fraction, seed)
+
+    app_loop_should_run = threading.Event()
+    app_loop_should_run.set()
+    stop = threading.Event()
+
+    with contextlib.ExitStack() as stack:
+        api = stack.enter_context(MockSpotifyAPI(player))
+
+        now_playing = None
+        if source_name == 'mpris':
+            bus_address = stack.enter_context(private_session_bus())
+            stack.enter_context(FakeMprisPlayer(player, bus_address))
+            now_playing = nowplaying.MprisSource(bus_address)
+
+        player.track_started = player.clock.time()
+        threading.Timer(seconds, stop.set).start()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            heartbroken.app_loop(app_loop_should_run, stop, MockSpotifyWrapper(api), now_playing=now_playing)
+
+    latencies_ms = [int(latency * 1000) for latency in player.skip_latencies]
+
+    return {
+        'dislikes':              dislikes,
+        'polls_per_minute':      round(api.calls['GET /me/player/currently-playing'] * 60 / seconds, 1),
+        'api_calls_per_minute':  round(sum(api.calls.values()) * 60 / seconds, 1),
+        'api_calls':             dict(api.calls),
+        'skips':                 len(latencies_ms),
+        'skip_latency_ms':       {'p50': utils.percentile(latencies_ms, .5),
+                                  'p90': utils.percentile(latencies_ms, .9),
+                                  'max': max(latencies_ms, default=None)}
+    }
+
+# ========
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark polling against following the client over MPRIS')
+    parser.add_argument('--seconds',       type=float, default=60, help='Real seconds per source (default 60)')
+    parser.add_argument('--tracks',        type=int,   default=50, help='Size of the simulated library (default 50)')
+    parser.add_argument('--track-seconds', type=int,   default=10, help='Longest simulated track (default 10)')
+    parser.add_argument('--disliked',      type=float, default=.15, help='Fraction of tracks disliked (default .15)')
+    parser.add_argument('--seed',          type=int,   default=0)
+    parser.add_argument('--output',        default=None, help='Write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    original_directory = os.getcwd()
+    results = {}
+
+    for source_name in ('polling', 'mpris'):
+        # Keep the benchmark's database away from the real one
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                results[source_name] = run(source_name, args.seconds, args.tracks, args.track_seconds,
+                                           args.disliked, args.seed)
+            finally:
+                os.chdir(original_directory)
+
+    report = {
+        'benchmark':  'now_playing',
+        'commit':     procstats.git_commit(),
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python':     sys.version.split()[0],
+        'platform':   sys.platform,
+        'scenario':   {'seconds': args.seconds, 'tracks': args.tracks, 'track_seconds': args.track_seconds,
+                       'disliked_fraction': args.disliked, 'seed': args.seed},
+        'results':    results
+    }
+
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return 0
+
+# ====
+if __name__ == '__main__':
+    sys.exit(main())
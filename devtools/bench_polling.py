@@ -0,0 +1,186 @@
+"""
+End-to-end benchmark of the polling loop.
+
+Runs the real heartbroken.app_loop -> hbcontrol.skip_if_heartbroken path against devtools.mockapi for a number of
+simulated hours and reports skip latency, API calls per hour, CPU time per poll, and peak RSS as JSON.
+
+    python -m devtools.bench_polling --hours 2 --output results.json
+    python -m devtools.bench_polling --baseline results.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import heartbroken
+from devtools import procstats
+from devtools.mockapi import MockPlayer, MockSpotifyAPI, MockSpotifyWrapper
+from libs import leakage, utils
+from libs.clock import VirtualClock
+from libs.database import HeartbrokenDatabase
+
+
+# ========
+def seed_dislikes(player: MockPlayer, fraction: float, seed: int) -> dict:
+    """
+    Dislikes roughly :fraction of the player's tracks, split between track, album, and artist dislikes
+    """
+
+    rng = random.Random(seed)
+    counts = {'track': 0, 'album': 0, 'artist': 0}
+
+    for track in player.tracks:
+        if rng.random() >= fraction:
+            continue
+
+        kind = rng.choice(('track', 'track', 'album', 'artist'))
+        counts[kind] += 1
+
+        if kind == 'track':
+            HeartbrokenDatabase.save_heartbreak(track_id=track.id)
+        elif kind == 'album':
+            HeartbrokenDatabase.save_heartbreak(album_id=track.album_id)
+        else:
+            HeartbrokenDatabase.save_heartbreak(artist_id=track.artist_ids[0])
+
+    return counts
+
+# ========
+def run(hours: float, track_count: int, disliked_fraction: float, seed: int) -> dict:
+    clock  = VirtualClock(real_time=True)
+    player = MockPlayer(track_count, clock, seed)
+
+    dislikes = seed_dislikes(player, disliked_fraction, seed)
+    leakage.reset()
+
+    app_loop_should_run = threading.Event()
+    app_loop_should_run.set()
+    stop = threading.Event()
+
+    loop_cpu = {}
+
+    def loop_target(spotify):
+        start = time.thread_time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            heartbroken.app_loop(app_loop_should_run, stop, spotify)
+        loop_cpu['seconds'] = time.thread_time() - start
+
+    with MockSpotifyAPI(player) as api:
+        wall_start = time.perf_counter()
+
+        loop_thread = threading.Thread(target=loop_target, args=(MockSpotifyWrapper(api, clock),))
+        loop_thread.start()
+
+        end = hours * 3600
+        while clock.time() < end and loop_thread.is_alive():
+            time.sleep(.005)
+
+        stop.set()
+        loop_thread.join()
+
+        wall_seconds = time.perf_counter() - wall_start
+
+    simulated_hours = clock.time() / 3600
+    polls = api.calls['GET /me/player/currently-playing']
+    latencies_ms = [int(latency * 1000) for latency in player.skip_latencies]
+
+    return {
+        'scenario': {
+            'hours':             hours,
+            'tracks':            track_count,
+            'disliked_fraction': disliked_fraction,
+            'dislikes':          dislikes,
+            'seed':              seed
+        },
+        'results': {
+            'simulated_seconds':  round(clock.time(), 3),
+            'wall_seconds':       round(wall_seconds, 3),
+            'polls':              polls,
+            'api_calls':          dict(api.calls),
+            'api_calls_per_hour': round(sum(api.calls.values()) / simulated_hours, 1),
+            'skips':              len(latencies_ms),
+            'leaked_audio_ms':    leakage.summary(),
+            'skip_latency_ms':    {'p50': utils.percentile(latencies_ms, .5),
+                                   'p90': utils.percentile(latencies_ms, .9),
+                                   'p99': utils.percentile(latencies_ms, .99),
+                                   'max': max(latencies_ms, default=None)},
+            'cpu_ms_per_poll':    round(loop_cpu['seconds'] * 1000 / max(1, polls), 4),
+            'peak_rss_kb':        procstats.peak_rss_kb()
+        }
+    }
+
+# ========
+def compare(baseline: dict, current: dict) -> None:
+    """
+    Prints the headline numbers of two runs side by side
+    """
+
+    rows = (
+        ('skip latency p50 (ms)', ('skip_latency_ms', 'p50')),
+        ('skip latency p99 (ms)', ('skip_latency_ms', 'p99')),
+        ('leaked track p50 (ms)', ('leaked_audio_ms', 'track', 'p50')),
+        ('API calls per hour',    ('api_calls_per_hour',)),
+        ('CPU ms per poll',       ('cpu_ms_per_poll',)),
+        ('peak RSS (KiB)',        ('peak_rss_kb',))
+    )
+
+    print(f'\n{"":24}{baseline.get("commit") or "baseline":>14}{current.get("commit") or "current":>14}')
+    for label, keys in rows:
+        old = utils._deep_get(baseline['results'], keys, None)
+        new = utils._deep_get(current['results'], keys, None)
+        print(f'{label:24}{str(old):>14}{str(new):>14}')
+
+# ========
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the Heartbroken polling loop against a mock Spotify API')
+    parser.add_argument('--hours',    type=float, default=1.0, help='Simulated hours of listening (default 1)')
+    parser.add_argument('--tracks',   type=int,   default=500, help='Size of the simulated library (default 500)')
+    parser.add_argument('--disliked', type=float, default=.15, help='Fraction of tracks disliked (default .15)')
+    parser.add_argument('--seed',     type=int,   default=0)
+    parser.add_argument('--output',   default=None, help='Write the JSON results here instead of stdout')
+    parser.add_argument('--baseline', default=None, help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    original_directory = os.getcwd()
+
+    # Keep the benchmark's database away from the real one
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            HeartbrokenDatabase.maybe_create_table()
+            report = run(args.hours, args.tracks, args.disliked, args.seed)
+        finally:
+            os.chdir(original_directory)
+
+    report = {
+        'benchmark':  'polling_loop',
+        'commit':     procstats.git_commit(),
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python':     sys.version.split()[0],
+        'platform':   sys.platform,
+        **report
+    }
+
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            compare(json.load(f), report)
+
+    return 0
+
+# ====
+if __name__ == '__main__':
+    sys.exit(main())
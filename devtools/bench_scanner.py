@@ -0,0 +1,116 @@
+"""
+Benchmark of the library and playlist scanner (libs.scanner).
+
+Scans simulated libraries of a few sizes served by devtools.mockapi, which answers some requests with a 429 to make
+the scanner back off, and reports the time taken and the peak memory traced during each scan as JSON. The peak should
+stay about the same whatever the size.
+
+    python -m devtools.bench_scanner --tracks 1000 10000
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from devtools import procstats
+from devtools.mockapi import MockPlayer, MockSpotifyAPI
+from libs import scanner
+from libs.database import HeartbrokenDatabase
+
+
+# ========
+def run(track_count: int, disliked_fraction: float, rate_limit: tuple, concurrency: int, seed: int) -> dict:
+    rng = random.Random(seed)
+
+    player = MockPlayer(track_count, seed=seed)
+
+    HeartbrokenDatabase.maybe_create_table()
+    for track in rng.sample(player.tracks, int(track_count * disliked_fraction)):
+        HeartbrokenDatabase.save_heartbreak(track_id=track.id)
+
+    with MockSpotifyAPI(player, rate_limit=rate_limit) as api:
+        tracemalloc.start()
+        started = time.perf_counter()
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            exit_code = asyncio.run(scanner.run_scan('token', None, True, 'scan.csv', concurrency=concurrency,
+                                                     api_url=api.url))
+
+        seconds = time.perf_counter() - started
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    with open('scan.csv', encoding='utf8') as f:
+        reported = sum(1 for _ in f) - 1
+
+    entries = len(player.tracks) + sum(len(playlist['tracks']) for playlist in player.playlists)
+
+    return {
+        'exit_code':          exit_code,
+        'entries':            entries,
+        'reported':           reported,
+        'seconds':            round(seconds, 2),
+        'entries_per_second': round(entries / seconds),
+        'peak_traced_mb':     round(peak_bytes / 1e6, 2),
+        'api_calls':          dict(api.calls),
+        'summary':            output.getvalue().splitlines()[1:3]
+    }
+
+# ========
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark scanning a library and its playlists')
+    parser.add_argument('--tracks',      type=int, nargs='+', default=[1000, 10000],
+                        help='Library sizes to scan (default 1000 10000)')
+    parser.add_argument('--disliked',    type=float, default=.01, help='Fraction of tracks disliked (default .01)')
+    parser.add_argument('--rate-limit',  type=int, default=200,
+                        help='Answer every nth request with a 429 (default 200)')
+    parser.add_argument('--retry-after', type=float, default=.2, help='Retry-After of the 429s (default .2)')
+    parser.add_argument('--concurrency', type=int, default=scanner.SCAN_CONCURRENCY)
+    parser.add_argument('--seed',        type=int, default=0)
+    parser.add_argument('--output',      default=None, help='Write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    original_directory = os.getcwd()
+    results = {}
+
+    for track_count in args.tracks:
+        # Keep the benchmark's database and report away from the real ones
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                results[track_count] = run(track_count, args.disliked, (args.rate_limit, args.retry_after),
+                                           args.concurrency, args.seed)
+            finally:
+                os.chdir(original_directory)
+
+    report = {
+        'benchmark':  'scanner',
+        'commit':     procstats.git_commit(),
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python':     sys.version.split()[0],
+        'platform':   sys.platform,
+        'scenario':   {'disliked_fraction': args.disliked, 'rate_limit': args.rate_limit,
+                       'retry_after': args.retry_after, 'concurrency': args.concurrency, 'seed': args.seed},
+        'results':    results
+    }
+
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return 0
+
+# ====
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+"""
+Check of the infinite-loop guard in hbcontrol.skip_if_heartbroken() against devtools.mockapi.
+
+A disliked track is skipped, and then the polls that follow are answered the ways Spotify can answer them. Checks
+that:
+    - a failed poll right after a skip (429, 5xx) doesn't pause playback, and the poll after it goes on as normal
+    - disliked tracks in a row are each skipped, without pausing
+    - a skip that Spotify accepts but doesn't carry out still pauses playback, which is what the guard is for
+
+    python -m devtools.check_skip_guard
+
+Exits with 1 if any check fails.
+"""
+
+import collections
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import typing
+
+from devtools.mockapi import MockPlayer, MockSpotifyAPI, MockSpotifyWrapper
+from libs import hbcontrol, logs
+from libs.database import HeartbrokenDatabase
+
+
+PAUSE = 'PUT /me/player/pause'
+
+
+# ========
+def answer_with(api: MockSpotifyAPI, route: typing.Tuple[str, str],
+                statuses: typing.Iterable[typing.Union[None, int, typing.Callable]]) -> None:
+    """
+    Answers the next requests to :route with :statuses in turn: as usual for None, with an error for a status, and by
+    calling what's given with the player otherwise. The route is served as usual after that.
+    """
+
+    handler = api.routes[route]
+    pending = collections.deque(statuses)
+
+    def answer(query, player: MockPlayer) -> typing.Tuple[int, typing.Any]:
+        status = pending.popleft() if pending else None
+        if status is None:
+            return handler(query, player)
+
+        if callable(status):
+            return status(player)
+
+        return status, {'error': {'status': status, 'message': 'Answered by devtools.check_skip_guard'}}
+
+    api.routes[route] = answer
+
+# ====
+def play(disliked: int, answers: typing.Dict[typing.Tuple[str, str], typing.List],
+         polls: int) -> typing.Tuple[typing.List[typing.Union[None, bool]], int, MockPlayer]:
+    """
+    Dislikes the first :disliked tracks of a new player, sets up :answers (see answer_with()) and polls :polls times.
+    Returns what every poll returned, the pauses sent, and the player.
+    """
+
+    player = MockPlayer(20, seed=disliked)
+    for track in player.tracks[:disliked]:
+        HeartbrokenDatabase.save_heartbreak(track_id=track.id)
+
+    with MockSpotifyAPI(player) as api:
+        for route, statuses in answers.items():
+            answer_with(api, route, statuses)
+
+        spotify = MockSpotifyWrapper(api)
+        spotify.initialize_spotify_client()
+
+        verdicts = [hbcontrol.skip_if_heartbroken(spotify) for _ in range(polls)]
+
+        return verdicts, api.calls[PAUSE], player
+
+# ========
+def run() -> typing.List[typing.Tuple[str, bool, str]]:
+    HeartbrokenDatabase.maybe_create_table()
+
+    results = []
+
+    # The poll after the skip fails, so the skipped track is still what was last seen
+    for status in (429, 500, 503):
+        verdicts, pauses, player = play(1, {('GET', '/me/player/currently-playing'): [None, status]}, 3)
+        passed = verdicts == [True, None, False] and pauses == 0 and player.is_playing
+        results.append((f'HTTP {status} after a skip', passed, f'polls returned {verdicts}, {pauses} pause(s)'))
+
+    verdicts, pauses, _ = play(3, {}, 4)
+    results.append(('disliked tracks in a row', verdicts == [True, True, True, False] and pauses == 0,
+                    f'polls returned {verdicts}, {pauses} pause(s)'))
+
+    # Spotify says yes to the skip but keeps playing the track
+    verdicts, pauses, player = play(1, {('POST', '/me/player/next'): [lambda player: (204, None)]}, 2)
+    results.append(('skip not carried out', verdicts == [True, None] and pauses == 1 and not player.is_playing,
+                    f'polls returned {verdicts}, {pauses} pause(s)'))
+
+    return results
+
+# ========
+def main() -> int:
+    original_directory = os.getcwd()
+
+    # The guard logs a warning when it pauses, which one of the checks makes it do on purpose
+    logs.start(file_name=None, console=False)
+
+    # Keep the check's dislikes away from the real ones
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = run()
+        finally:
+            os.chdir(original_directory)
+            logs.stop()
+
+    for name, passed, detail in results:
+        print(f'{"ok  " if passed else "FAIL"} {name:25}{detail}')
+
+    return 0 if all(passed for _, passed, _ in results) else 1
+
+# ====
+if __name__ == '__main__':
+    sys.exit(main())
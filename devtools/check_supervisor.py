@@ -0,0 +1,173 @@
+"""
+Check of the multi-process supervisor (libs.supervisor) against devtools.mockapi.
+
+Splits simulated accounts over worker processes, each account with its own player, then checks that:
+    - every account is polled about once a second, so by exactly one worker
+    - a killed worker is restarted and its accounts are polled again
+    - adding a worker moves only the accounts that now hash to it, about 1/N, and every account is still polled once
+
+    python -m devtools.check_supervisor --accounts 24 --workers 2
+
+Exits with 1 if any check fails.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+from devtools.mockapi import MockPlayer, MockSpotifyAPI
+from libs import accounts, constants, logs
+from libs.supervisor import Supervisor
+
+
+# ========
+def connect(account: accounts.Account) -> None:
+    """
+    Writes credentials that won't need refreshing, with the account's name as the token so the mock API can tell the
+    accounts apart
+    """
+
+    credentials = {'access_token': account.name, 'token_type': 'Bearer', 'expires_in': 86400,
+                   'expires_at': time.time() + 86400, 'refresh_token': 'mock'}
+
+    with open(account.credentials_file_name, 'w') as f:
+        json.dump(credentials, f)
+
+# ====
+def wait_for(condition: typing.Callable[[], bool], timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(.1)
+    return False
+
+# ====
+def poll_rates(players: typing.Dict[str, MockPlayer], seconds: float) -> typing.Dict[str, float]:
+    """
+    Polls per second each account got over the next :seconds
+    """
+
+    before = {name: player.polls for name, player in players.items()}
+    time.sleep(seconds)
+    return {name: (player.polls - before[name]) / seconds for name, player in players.items()}
+
+# ====
+def polled_once(rates: typing.Dict[str, float]) -> typing.Tuple[bool, str]:
+    interval = constants.SpotifyAPI.REQUEST_INTERVAL_SECONDS
+
+    # Polls are timed to track ends as well, so a bit over one per interval is expected; two workers would double it
+    unpolled = sorted(name for name, rate in rates.items() if rate < .5 / interval)
+    doubled  = sorted(name for name, rate in rates.items() if rate > 1.6 / interval)
+
+    detail = f'{min(rates.values()):.2f}-{max(rates.values()):.2f} polls/s per account'
+    if unpolled:
+        detail += f', not polled: {", ".join(unpolled)}'
+    if doubled:
+        detail += f', polled twice: {", ".join(doubled)}'
+
+    return not unpolled and not doubled, detail
+
+# ========
+def run(account_count: int, worker_count: int, window: float) -> typing.List[typing.Tuple[str, bool, str]]:
+    registry = accounts.AccountRegistry('accounts')
+    players = {}
+
+    for index in range(account_count):
+        account = registry.add(f'account-{index:04}')
+        connect(account)
+        players[account.name] = MockPlayer(50, seed=index)
+
+    results = []
+
+    with MockSpotifyAPI(MockPlayer(1), players_by_token=players) as api:
+        supervisor = Supervisor(registry.directory, worker_count, api_url=api.url)
+
+        shutdown = threading.Event()
+        control_queue = queue.Queue()
+
+        supervising = threading.Thread(target=supervisor.run, args=(shutdown, control_queue))
+        supervising.start()
+
+        def reported():
+            health = supervisor.health()
+            return health['healthy'] and all(worker['polls_per_second'] > 0 for worker in health['workers'])
+
+        try:
+            # Every account is served
+            started = wait_for(reported, 30)
+            passed, detail = polled_once(poll_rates(players, window))
+            results.append(('all accounts served', started and passed, detail))
+
+            # A killed worker comes back with its accounts
+            victim = supervisor.workers[0]
+            victim_accounts = {name: players[name] for name in victim.accounts}
+            victim.process.kill()
+
+            restarted = wait_for(lambda: victim.restarts == 1 and victim.is_alive, 15)
+            wait_for(reported, 30)
+            passed, detail = polled_once(poll_rates(victim_accounts, window))
+            results.append(('killed worker restarted', restarted and passed,
+                            f'{len(victim_accounts)} account(s), {detail}'))
+
+            # A new worker only takes accounts, it never shuffles them between the existing ones
+            owners = {name: supervisor.worker_for(name).id for name in players}
+            control_queue.put((constants.Command.SET_WORKERS, worker_count + 1))
+
+            rebalanced = wait_for(lambda: len(supervisor.workers) == worker_count + 1 and reported(), 30)
+            moved = [name for name in players if supervisor.worker_for(name).id != owners[name]]
+            to_new = all(supervisor.worker_for(name).id == worker_count for name in moved)
+
+            passed, detail = polled_once(poll_rates(players, window))
+            results.append(('worker added', rebalanced and to_new and passed,
+                            f'{len(moved)} of {account_count} account(s) moved, '
+                            f'{account_count / (worker_count + 1):.1f} expected, {detail}'))
+
+            results.append(('health', supervisor.health()['healthy'], supervisor.report()))
+        finally:
+            shutdown.set()
+            supervising.join()
+
+    return results
+
+# ========
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Check the supervisor behind heartbroken.py --workers')
+    parser.add_argument('--accounts', type=int,   default=24, help='Simulated accounts (default 24)')
+    parser.add_argument('--workers',  type=int,   default=2,  help='Worker processes to start with (default 2)')
+    parser.add_argument('--window',   type=float, default=5,  help='Seconds poll rates are measured over (default 5)')
+    parser.add_argument('--verbose',  action='store_true', help="Show the workers' output")
+    args = parser.parse_args()
+
+    original_directory = os.getcwd()
+
+    # The supervisor logs a warning for the worker the check kills on purpose
+    logs.start(file_name=None, console=args.verbose)
+
+    # Keep the check's accounts away from the real ones
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+            with output:
+                results = run(args.accounts, args.workers, args.window)
+        finally:
+            os.chdir(original_directory)
+            logs.stop()
+
+    for name, passed, detail in results:
+        print(f'{"ok  " if passed else "FAIL"} {name:25}{detail}')
+
+    return 0 if all(passed for _, passed, _ in results) else 1
+
+# ====
+if __name__ == '__main__':
+    sys.exit(main())
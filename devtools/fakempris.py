@@ -0,0 +1,141 @@
+"""
+Stand-in for the Spotify client's MPRIS interface on Linux, for testing libs.nowplaying.MprisSource.
+
+FakeMprisPlayer publishes a devtools.mockapi.MockPlayer on a D-Bus session bus the way the client does: it owns
+org.mpris.MediaPlayer2.spotify, serves PlaybackStatus and Metadata through org.freedesktop.DBus.Properties, and
+signals PropertiesChanged whenever the player moves to another track or stops. private_session_bus() starts a
+throwaway bus for it, so nothing reaches the real desktop session.
+
+Needs jeepney and dbus-daemon.
+"""
+
+import contextlib
+import subprocess
+import threading
+import typing
+
+from jeepney import DBusAddress, MessageType, HeaderFields, message_bus, new_error, new_method_return, new_signal
+from jeepney.io.blocking import open_dbus_connection
+
+from devtools.mockapi import MockPlayer
+from libs.nowplaying import MPRIS_PATH, PLAYER_INTERFACE, SPOTIFY_BUS_NAME
+
+
+CHECK_SECONDS = .01  # How often the player is checked for changes, which is how late signals can be
+
+
+# ========
+@contextlib.contextmanager
+def private_session_bus() -> typing.Iterator[str]:
+    """
+    Runs a session bus of its own for the duration and yields its address
+    """
+
+    daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address'],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        yield daemon.stdout.readline().strip()
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+# ========
+class FakeMprisPlayer:
+    """
+    Serves :player over MPRIS on the bus at :bus_address from a background thread. Use as a context manager.
+    :trackid_style is 'path' (/com/spotify/track/<id>, current clients) or 'uri' (spotify:track:<id>, older ones).
+    """
+
+    def __init__(self, player: MockPlayer, bus_address: str, trackid_style: str = 'path'):
+        self.player = player
+        self.bus_address = bus_address
+        self.trackid_style = trackid_style
+
+        self.signals_sent = 0
+
+        self._connection = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    # ====
+    def start(self) -> 'FakeMprisPlayer':
+        self._connection = open_dbus_connection(self.bus_address)
+        self._connection.send_and_get_reply(message_bus.RequestName(SPOTIFY_BUS_NAME))
+
+        self._thread = threading.Thread(target=self._serve, name='fake mpris', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+        self._connection.close()
+
+    def __enter__(self) -> 'FakeMprisPlayer':
+        return self.start()
+
+    def __exit__(self, *_) -> None:
+        self.stop()
+
+    # ========
+    def properties(self) -> typing.Dict[str, typing.Tuple[str, typing.Any]]:
+        """
+        The player's MPRIS properties, as (signature, value) variants
+        """
+
+        current = self.player.currently_playing()
+        if current is None or not current['is_playing']:
+            return {'PlaybackStatus': ('s', 'Paused'), 'Metadata': ('a{sv}', {})}
+
+        track = current['item']
+        trackid = f'/com/spotify/track/{track["id"]}' if self.trackid_style == 'path' else f'spotify:track:{track["id"]}'
+
+        return {
+            'PlaybackStatus': ('s', 'Playing'),
+            'Metadata': ('a{sv}', {
+                'mpris:trackid': ('o' if self.trackid_style == 'path' else 's', trackid),
+                'mpris:length':  ('t', track['duration_ms'] * 1000),
+                'xesam:title':   ('s', track['name']),
+                'xesam:album':   ('s', track['album']['name']),
+                'xesam:artist':  ('as', [artist['name'] for artist in track['artists']]),
+                'xesam:url':     ('s', f'https://open.spotify.com/track/{track["id"]}')
+            })
+        }
+
+    # ====
+    def _serve(self) -> None:
+        last_sent = self.properties()
+
+        while not self._stopped.is_set():
+            try:
+                message = self._connection.receive(timeout=CHECK_SECONDS)
+            except TimeoutError:
+                message = None
+
+            if message is not None and message.header.message_type == MessageType.method_call:
+                self._connection.send(self._reply(message))
+
+            properties = self.properties()
+            if properties != last_sent:
+                changed = new_signal(DBusAddress(MPRIS_PATH, interface='org.freedesktop.DBus.Properties'),
+                                     'PropertiesChanged', 'sa{sv}as', (PLAYER_INTERFACE, properties, []))
+                self._connection.send(changed)
+
+                last_sent = properties
+                self.signals_sent += 1
+
+    # ====
+    def _reply(self, message):
+        interface = message.header.fields.get(HeaderFields.interface, None)
+        member = message.header.fields.get(HeaderFields.member, None)
+
+        if interface == 'org.freedesktop.DBus.Properties' and message.body[0] == PLAYER_INTERFACE:
+            properties = self.properties()
+
+            if member == 'GetAll':
+                return new_method_return(message, 'a{sv}', (properties,))
+
+            if member == 'Get' and message.body[1] in properties:
+                return new_method_return(message, 'v', (properties[message.body[1]],))
+
+        return new_error(message, 'org.freedesktop.DBus.Error.UnknownMethod', 's', (f'{interface}.{member}',))
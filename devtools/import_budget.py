@@ -0,0 +1,123 @@
+"""
+Startup import budget.
+
+Imports what each Heartbroken process needs before it can do anything useful in a fresh interpreter under
+`-X importtime`, and fails if that takes longer than its budget or pulls in a module that process should not load.
+
+    python -m devtools.import_budget
+    python -m devtools.import_budget --scale 2   (slow machine / CI runner)
+
+Exits with 1 if any budget is broken, so it can gate a build.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import typing
+
+
+MARKER = 'heartbroken-import-budget-start'
+
+# name: (code run in a fresh interpreter, budget in ms, modules that must not be imported)
+SCENARIOS = {
+    # The tray process imports heartbroken again when it spawns; pywin32 comes after that, inside gui_runner
+    'tray': (
+        'import heartbroken',
+        40,
+        ('requests', 'requests_oauthlib', 'sqlite3', 'http.server', 'webbrowser', 'libs.hbcontrol')
+    ),
+    # Everything the app loop imports before its first poll
+    'app loop': (
+        'import heartbroken\n'
+        'from libs import hbcontrol, leakage, metrics, profiling\n'
+        'from libs.database import HeartbrokenDatabase\n'
+        'from libs.spotifywrapper import SpotifyWrapper',
+        250,
+        ('http.server', 'webbrowser', 'libs.oauthserver', 'cProfile', 'pstats', 'tracemalloc')
+    )
+}
+
+
+# ========
+def measure(code: str) -> typing.Tuple[float, typing.Set[str]]:
+    """
+    Runs :code in a fresh interpreter and returns how long its imports took in ms, and which modules it imported
+    """
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             f'import sys; print({MARKER!r}, file=sys.stderr, flush=True)\n{code}'],
+                            capture_output=True, text=True)
+
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    # Everything before the marker was imported by site, not by :code
+    lines = result.stderr.split(MARKER, 1)[1].splitlines()
+
+    total_us = 0
+    modules = set()
+
+    for line in lines:
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip())
+
+        # Only top level imports; nested ones are already counted in their parent's cumulative time
+        if not name.startswith('  '):
+            total_us += int(cumulative)
+
+    return total_us / 1000, modules
+
+# ========
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Check how long Heartbroken takes to import at startup')
+    parser.add_argument('--runs',  type=int,   default=5, help='Runs per scenario; the median is compared (default 5)')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplier for every budget (default 1)')
+    parser.add_argument('--json',  action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    results = {}
+    failed = False
+
+    for name, (code, budget_ms, forbidden) in SCENARIOS.items():
+        try:
+            measure(code)  # Warm-up, so bytecode compilation isn't counted
+        except RuntimeError as ex:
+            print(f'FAIL {name}: {ex}')
+            failed = True
+            continue
+
+        timings = []
+        modules = set()
+
+        for _ in range(args.runs):
+            milliseconds, modules = measure(code)
+            timings.append(milliseconds)
+
+        median_ms = statistics.median(timings)
+        budget_ms = budget_ms * args.scale
+        loaded = sorted(module for module in forbidden if module in modules)
+
+        passed = median_ms <= budget_ms and len(loaded) == 0
+        failed = failed or not passed
+
+        results[name] = {'median_ms': round(median_ms, 1), 'budget_ms': budget_ms,
+                         'forbidden_imports': loaded, 'passed': passed}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name, result in results.items():
+            status = 'ok  ' if result['passed'] else 'FAIL'
+            print(f'{status} {name:10}{result["median_ms"]:8.1f} ms of {result["budget_ms"]:g} ms', end='')
+            print(f'   imports {", ".join(result["forbidden_imports"])}' if result['forbidden_imports'] else '')
+
+    return 1 if failed else 0
+
+# ====
+if __name__ == '__main__':
+    sys.exit(main())
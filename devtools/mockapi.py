@@ -0,0 +1,481 @@
+"""
+In-process stand-in for the Spotify Web API endpoints that Heartbroken uses.
+
+MockSpotifyAPI serves a simulated player over real HTTP on 127.0.0.1, so the code under test goes through requests
+exactly as it does in production. The player is driven by a clock from libs.clock; sharing a VirtualClock with the
+app loop lets hours of listening play out in seconds.
+"""
+
+import collections
+import http.server
+import json
+import random
+import re
+import string
+import threading
+import typing
+import urllib.parse
+
+import requests
+
+from libs.clock import SystemClock
+from libs.spotifywrapper import SpotifyWrapper
+
+
+BASE62 = string.digits + string.ascii_letters
+
+# Paths with an ID in them are routed by their template, '/playlists/{id}/tracks', with the ID in the query as id
+templated_path_regex = re.compile(r'^/(albums|artists|playlists)/([A-Za-z0-9]+)(?=/)')
+
+GENRES = ('dance pop', 'electropop', 'hardstyle', 'indie folk', 'lo-fi beats', 'metalcore', 'modern rock', 'podcast',
+          'trap', 'vapor soul')
+
+
+# ========
+def random_spotify_id(rng: random.Random) -> str:
+    """
+    Spotify IDs are 22-char base-62 strings
+    """
+    return ''.join(rng.choice(BASE62) for _ in range(22))
+
+# ========
+class MockTrack:
+    def __init__(self, rng: random.Random, artist_ids: typing.List[str], album_id: str):
+        self.id          = random_spotify_id(rng)
+        self.name        = f'Track {self.id[:6]}'
+        self.duration_ms = rng.randint(120, 300) * 1000
+        self.album_id    = album_id
+        self.artist_ids  = artist_ids
+
+    # ====
+    def to_json(self) -> dict:
+        return {
+            'id':          self.id,
+            'name':        self.name,
+            'type':        'track',
+            'duration_ms': self.duration_ms,
+            'album':       {'id': self.album_id, 'name': f'Album {self.album_id[:6]}'},
+            'artists':     [{'id': artist_id, 'name': f'Artist {artist_id[:6]}'} for artist_id in self.artist_ids]
+        }
+
+# ========
+class MockPlayer:
+    """
+    A Spotify player working through a shuffled library, one track after the other, on the given clock
+    """
+
+    def __init__(self, track_count: int = 500, clock=SystemClock, seed: int = 0):
+        rng = random.Random(seed)
+
+        self.clock = clock
+
+        artists = [random_spotify_id(rng) for _ in range(max(1, track_count // 10))]
+        albums  = [random_spotify_id(rng) for _ in range(max(1, track_count // 8))]
+
+        self.tracks = [MockTrack(rng, rng.sample(artists, rng.randint(1, min(3, len(artists)))), rng.choice(albums))
+                       for _ in range(track_count)]
+
+        # For /artists and /audio-features; drawn separately so the library is the same as without them
+        metadata_rng = random.Random(f'{seed} metadata')
+        self.genres   = {artist_id: metadata_rng.sample(GENRES, metadata_rng.randint(0, 2)) for artist_id in artists}
+        self.features = {track.id: {'danceability': round(metadata_rng.random(), 3),
+                                    'energy':       round(metadata_rng.random(), 3),
+                                    'speechiness':  round(metadata_rng.random() ** 3, 3),
+                                    'tempo':        round(metadata_rng.uniform(60, 200), 3)}
+                         for track in self.tracks}
+
+        # Every track is in Liked Songs; playlists hold some of them, the odd one more than once
+        playlist_rng = random.Random(f'{seed} playlists')
+        self.playlists = [{'id':     random_spotify_id(playlist_rng),
+                           'name':   f'Playlist {index + 1}',
+                           'tracks': playlist_rng.choices(self.tracks,
+                                                          k=playlist_rng.randint(1, min(track_count, 1000)))}
+                          for index in range(max(1, track_count // 500))]
+
+        self.index          = 0
+        self.is_playing     = True
+        self.is_active      = True  # Whether the player's device is active; paused players stay active until stop()
+        self.track_started  = clock.time()
+        self._paused_at     = None
+        self.polls          = 0  # Requests for the currently playing track
+
+        # The devices Spotify is open on, as /me/player/devices lists them; the first one is the one playing
+        device_rng = random.Random(f'{seed} devices')
+        self.devices = [{'id': random_spotify_id(device_rng), 'name': 'Mock computer', 'type': 'Computer'}]
+
+        # Time from each track starting to it being skipped, in seconds of the player's clock
+        self.skip_latencies = []
+        self.skipped_ids    = []
+
+        self._lock = threading.Lock()
+
+    # ====
+    @property
+    def current(self) -> MockTrack:
+        return self.tracks[self.index % len(self.tracks)]
+
+    # ====
+    def _advance(self, now: typing.Union[None, float] = None) -> None:
+        """
+        Moves on to whatever track should be playing by :now (the clock's time by default) if the current one has
+        finished on its own
+        """
+
+        if not self.is_playing:
+            return
+
+        now = self.clock.time() if now is None else now
+        while (now - self.track_started) * 1000 >= self.current.duration_ms:
+            self.track_started += self.current.duration_ms / 1000
+            self.index += 1
+
+    # ====
+    def currently_playing(self) -> typing.Union[dict, None]:
+        """
+        None while no device is active, as Spotify answers 204 then
+        """
+
+        with self._lock:
+            self._advance()
+
+            if not self.is_active:
+                return None
+
+            position = self._paused_at if not self.is_playing else self.clock.time()
+
+            return {
+                'is_playing':             self.is_playing,
+                'progress_ms':            int((position - self.track_started) * 1000),
+                'currently_playing_type': 'track',
+                'item':                   self.current.to_json()
+            }
+
+    # ====
+    def device_list(self) -> typing.List[dict]:
+        with self._lock:
+            return [dict(device, is_active=self.is_active and index == 0) for index, device in enumerate(self.devices)]
+
+    # ====
+    def add_device(self, name: str) -> None:
+        """
+        Spotify being opened on another device, which doesn't start playing by itself
+        """
+
+        with self._lock:
+            self.devices.append({'id': random_spotify_id(random.Random(name)), 'name': name, 'type': 'Smartphone'})
+
+    # ====
+    def upcoming(self, count: int) -> typing.List[dict]:
+        """
+        The next :count tracks in the queue, as /me/player/queue lists them
+        """
+
+        with self._lock:
+            self._advance()
+            return [self.tracks[(self.index + offset) % len(self.tracks)].to_json() for offset in range(1, count + 1)]
+
+    # ====
+    def skip(self) -> None:
+        with self._lock:
+            self._advance()
+
+            now = self.clock.time()
+            self.skip_latencies.append(now - self.track_started)
+            self.skipped_ids.append(self.current.id)
+
+            self.index += 1
+            self.track_started = now
+            self.is_playing = True
+            self.is_active  = True
+
+    # ====
+    def pause(self, at: typing.Union[None, float] = None) -> None:
+        """
+        :at, here and in stop() and resume(), is when it happened by the player's clock if not now, for a scenario
+        that is played out as requests come in (see devtools.bench_idle)
+        """
+
+        with self._lock:
+            at = self.clock.time() if at is None else at
+            self._advance(at)
+
+            if self.is_playing:
+                self.is_playing = False
+                self._paused_at = at
+
+    # ====
+    def stop(self, at: typing.Union[None, float] = None) -> None:
+        """
+        Pauses and lets the device go inactive, as Spotify does a while after pausing or when the app is closed
+        """
+
+        self.pause(at)
+        with self._lock:
+            self.is_active = False
+
+    # ====
+    def resume(self, at: typing.Union[None, float] = None) -> None:
+        """
+        Picks the current track up where it was paused, as pressing play does
+        """
+
+        with self._lock:
+            self.is_active = True
+            if self.is_playing:
+                return
+
+            self.track_started += (self.clock.time() if at is None else at) - self._paused_at
+            self.is_playing = True
+
+# ========
+class _MockRequestHandler (http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real API
+    disable_nagle_algorithm = True  # Otherwise delayed ACKs add ~40ms to every response
+
+    def do_GET(self) -> None:
+        self._dispatch('GET')
+
+    def do_POST(self) -> None:
+        self._dispatch('POST')
+
+    def do_PUT(self) -> None:
+        self._dispatch('PUT')
+
+    # ====
+    def _dispatch(self, method: str) -> None:
+        api = self.server.api
+        url = urllib.parse.urlsplit(self.path)
+
+        path = url.path[3:] if url.path.startswith('/v1/') else url.path
+        query = urllib.parse.parse_qs(url.query)
+
+        # Drain any request body so the connection can be reused
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        if length:
+            self.rfile.read(length)
+
+        match = templated_path_regex.match(path)
+        if match is not None:
+            path = f'/{match.group(1)}/{{id}}{path[match.end():]}'
+            query['id'] = [match.group(2)]
+
+        with api.lock:
+            api.calls[f'{method} {path}'] += 1
+            throttled = api.rate_limit is not None and sum(api.calls.values()) % api.rate_limit[0] == 0
+
+        if throttled:
+            self._respond(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                          {'Retry-After': str(api.rate_limit[1])})
+            return
+
+        handler = api.routes.get((method, path), None)
+        if handler is None:
+            self._respond(404, {'error': {'status': 404, 'message': 'Service not found'}})
+            return
+
+        status, body = handler(query, api.player_for(self.headers.get('Authorization', None)))
+        self._respond(status, body)
+
+    # ====
+    def _respond(self, status: int, body: typing.Any,
+                 headers: typing.Union[None, typing.Dict[str, str]] = None) -> None:
+        payload = b'' if body is None else json.dumps(body).encode('utf8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    # ====
+    def log_message(self, format, *args) -> None:
+        # Mutes default console logging of requests
+        pass
+
+# ========
+class MockSpotifyAPI:
+    """
+    Serves a MockPlayer on a free localhost port from a background thread. Use as a context manager.
+
+    :players_by_token gives each access token (see MockSpotifyWrapper) a player of its own, for many accounts at once;
+    requests with any other token or none go to :player.
+
+    :rate_limit, (n, retry_after_seconds), answers every nth request with a 429 and that Retry-After.
+    """
+
+    def __init__(self, player: MockPlayer, players_by_token: typing.Union[None, typing.Dict[str, MockPlayer]] = None,
+                 rate_limit: typing.Union[None, typing.Tuple[int, float]] = None):
+        self.player = player
+        self.players_by_token = players_by_token or {}
+        self.rate_limit = rate_limit
+
+        self.calls = collections.Counter()
+        self.lock  = threading.Lock()
+
+        self.routes = {
+            ('GET', '/me/player/currently-playing'): self._currently_playing,
+            ('GET', '/me/player/queue'):             self._queue,
+            ('GET', '/me/player/devices'):           self._devices,
+            ('POST', '/me/player/next'):             self._next,
+            ('PUT', '/me/player/pause'):             self._pause,
+            ('GET', '/artists'):                     self._artists,
+            ('GET', '/audio-features'):              self._audio_features,
+            ('GET', '/me/tracks'):                   self._saved_tracks,
+            ('GET', '/me/playlists'):                self._playlists,
+            ('GET', '/playlists/{id}/tracks'):       self._playlist_tracks,
+            ('GET', '/albums/{id}/tracks'):          self._album_tracks,
+            ('GET', '/artists/{id}/albums'):         self._artist_albums
+        }
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _MockRequestHandler)
+        self._server.daemon_threads = True
+        self._server.api = self
+
+        self._thread = None
+
+    # ====
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    # ====
+    def start(self) -> 'MockSpotifyAPI':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'MockSpotifyAPI':
+        return self.start()
+
+    def __exit__(self, *_) -> None:
+        self.stop()
+
+    # ====
+    def player_for(self, authorization: typing.Union[None, str]) -> MockPlayer:
+        token = (authorization or '')[len('Bearer '):]
+        return self.players_by_token.get(token, self.player)
+
+    # ====
+    def _currently_playing(self, _query, player: MockPlayer) -> typing.Tuple[int, typing.Union[dict, None]]:
+        with self.lock:
+            player.polls += 1
+
+        body = player.currently_playing()
+        return (204, None) if body is None else (200, body)
+
+    def _queue(self, _query, player: MockPlayer) -> typing.Tuple[int, dict]:
+        current = player.currently_playing()
+        return 200, {'currently_playing': None if current is None else current['item'], 'queue': player.upcoming(20)}
+
+    def _devices(self, _query, player: MockPlayer) -> typing.Tuple[int, dict]:
+        return 200, {'devices': player.device_list()}
+
+    def _next(self, _query, player: MockPlayer) -> typing.Tuple[int, None]:
+        player.skip()
+        return 204, None
+
+    def _pause(self, _query, player: MockPlayer) -> typing.Tuple[int, None]:
+        player.pause()
+        return 204, None
+
+    def _artists(self, query, player: MockPlayer) -> typing.Tuple[int, dict]:
+        ids = query.get('ids', [''])[0].split(',')
+        if len(ids) > 50:
+            return 400, {'error': {'status': 400, 'message': 'Too many ids requested'}}
+
+        return 200, {'artists': [None if artist_id not in player.genres else
+                                 {'id': artist_id, 'name': f'Artist {artist_id[:6]}', 'type': 'artist',
+                                  'genres': player.genres[artist_id]}
+                                 for artist_id in ids]}
+
+    def _audio_features(self, query, player: MockPlayer) -> typing.Tuple[int, dict]:
+        ids = query.get('ids', [''])[0].split(',')
+        if len(ids) > 100:
+            return 400, {'error': {'status': 400, 'message': 'Too many ids requested'}}
+
+        return 200, {'audio_features': [None if track_id not in player.features else
+                                        {'id': track_id, 'type': 'audio_features', **player.features[track_id]}
+                                        for track_id in ids]}
+
+    def _saved_tracks(self, query, player: MockPlayer) -> typing.Tuple[int, dict]:
+        return _page(query, player.tracks, 50, lambda track: {'added_at': '2024-01-01T00:00:00Z',
+                                                              'track': track.to_json()})
+
+    def _playlists(self, query, player: MockPlayer) -> typing.Tuple[int, dict]:
+        return _page(query, player.playlists, 50, lambda playlist: {'id': playlist['id'], 'name': playlist['name'],
+                                                                    'tracks': {'total': len(playlist['tracks'])}})
+
+    def _playlist_tracks(self, query, player: MockPlayer) -> typing.Tuple[int, dict]:
+        playlist = next((playlist for playlist in player.playlists if playlist['id'] == query['id'][0]), None)
+        if playlist is None:
+            return 404, {'error': {'status': 404, 'message': 'Not found.'}}
+
+        return _page(query, playlist['tracks'], 100, lambda track: {'is_local': False, 'track': track.to_json()})
+
+    def _album_tracks(self, query, player: MockPlayer) -> typing.Tuple[int, dict]:
+        tracks = [track for track in player.tracks if track.album_id == query['id'][0]]
+        if not tracks:
+            return 404, {'error': {'status': 404, 'message': 'Non existing id'}}
+
+        return _page(query, tracks, 50, lambda track: {key: value for key, value in track.to_json().items()
+                                                       if key != 'album'})
+
+    def _artist_albums(self, query, player: MockPlayer) -> typing.Tuple[int, dict]:
+        album_ids = sorted({track.album_id for track in player.tracks if query['id'][0] in track.artist_ids})
+        if not album_ids:
+            return 404, {'error': {'status': 404, 'message': 'Non existing id'}}
+
+        return _page(query, album_ids, 50, lambda album_id: {
+            'id': album_id, 'name': f'Album {album_id[:6]}', 'album_type': 'album',
+            'total_tracks': sum(1 for track in player.tracks if track.album_id == album_id)})
+
+# ====
+def _page(query, items: typing.Sequence[typing.Any], max_limit: int,
+          to_json: typing.Callable[[typing.Any], dict]) -> typing.Tuple[int, dict]:
+    """
+    A page of :items as Spotify's paged endpoints return them, going by the limit and offset in :query
+    """
+
+    limit  = int(query.get('limit', ['20'])[0])
+    offset = int(query.get('offset', ['0'])[0])
+
+    if not 1 <= limit <= max_limit:
+        return 400, {'error': {'status': 400, 'message': 'Invalid limit'}}
+
+    return 200, {'items':  [to_json(item) for item in items[offset:offset + limit]],
+                 'limit':  limit,
+                 'offset': offset,
+                 'total':  len(items),
+                 'next':   None if offset + limit >= len(items) else f'?offset={offset + limit}&limit={limit}'}
+
+# ========
+class MockSpotifyWrapper (SpotifyWrapper):
+    """
+    SpotifyWrapper pointed at a MockSpotifyAPI. Uses a plain requests session and never needs credentials.
+    :access_token picks the player, see MockSpotifyAPI.
+    """
+
+    def __init__(self, api: MockSpotifyAPI, clock=SystemClock, access_token: typing.Union[None, str] = None):
+        super().__init__(clock)
+        self.api_url = api.url
+        self.access_token = access_token
+
+    def initialize_spotify_client(self, margin_seconds: float = 1):
+        if self.client is None:
+            self.client = requests.Session()
+
+            if self.access_token is not None:
+                self.client.headers['Authorization'] = f'Bearer {self.access_token}'
+                self.client.access_token = self.access_token  # Where the asyncio engine finds it on an OAuth2Session
+
+        return self.client
+
+    def is_token_expired(self, margin_seconds: float = 1) -> bool:
+        return False
@@ -0,0 +1,84 @@
+"""
+Process resource readings shared by the benchmarks
+"""
+
+import os
+import subprocess
+import sys
+import typing
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# ========
+def peak_rss_kb() -> typing.Union[int, None]:
+    """
+    Peak resident set size of this process in KiB, or None where the platform doesn't report it
+    """
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak  # macOS reports bytes, Linux KiB
+
+# ====
+def rss_kb() -> typing.Union[int, None]:
+    """
+    Current resident set size of this process in KiB, or None where /proc isn't there to read it from
+    """
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+# ====
+def open_fds() -> typing.Union[int, None]:
+    """
+    File descriptors this process has open, or None on platforms that don't list them (Windows)
+    """
+
+    for directory in ('/proc/self/fd', '/dev/fd'):
+        try:
+            return len(os.listdir(directory))
+        except OSError:
+            continue
+
+    return None
+
+# ====
+def open_sockets() -> typing.Union[int, None]:
+    """
+    How many of this process's file descriptors are sockets, or None where /proc isn't there to tell
+    """
+
+    try:
+        names = os.listdir('/proc/self/fd')
+    except OSError:
+        return None
+
+    sockets = 0
+    for name in names:
+        try:
+            sockets += os.readlink(f'/proc/self/fd/{name}').startswith('socket:')
+        except OSError:  # Closed since it was listed
+            pass
+
+    return sockets
+
+# ========
+def git_commit() -> typing.Union[str, None]:
+    """
+    The commit the working tree is on, so results from different builds can be told apart
+    """
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,336 @@
+"""
+Soak test of the app loop and the tray's menu actions over simulated days, against devtools.mockapi.
+
+The library plays in sessions with breaks in between, the access token expires every hour (and the OAuth session is
+rebuilt, as SpotifyWrapper.initialize_spotify_client() does after a refresh), and every few simulated minutes one of
+the tray's menu items is clicked through the callbacks the tray itself uses (heartbroken.tray_menu()). Logging goes
+through libs.logs to a file, as it does in the app.
+
+Every simulated hour the process's RSS, open file descriptors, sockets, threads and traced memory are read. After a
+warm-up, a straight line is fitted through each reading, and the soak fails if one climbs faster per simulated day
+than its limit. The allocation sites that grew the most are reported along with the readings. A simulated day takes
+about five minutes, most of it tracemalloc's overhead.
+
+    python -m devtools.soak --days 3
+    python -m devtools.soak --days 7 --output soak.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import gc
+import io
+import json
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import typing
+
+import heartbroken
+from devtools import procstats
+from devtools.mockapi import MockPlayer, MockSpotifyAPI, MockSpotifyWrapper
+from libs import constants, logs
+from libs.clock import VirtualClock
+from libs.database import HeartbrokenDatabase
+from libs.tokenhandler import OAuthManager
+
+
+# Simulated seconds per real second. Time has to pass in real time at some rate, since the tray drops repeat clicks
+# on all but its toggles by the real clock (heartbroken.TRAY_COALESCE_SECONDS). The real time that passes is part of
+# the simulated time, not extra to it (see VirtualClock).
+DEFAULT_SPEED = 3600
+
+SAMPLE_SECONDS         = 3600  # Simulated time between readings
+ACTION_SECONDS         = 20 * 60
+TOKEN_LIFETIME_SECONDS = 3600
+
+LISTENING_SECONDS     = (3600, 4 * 3600)  # Range of a listening session's length
+BREAK_SECONDS         = (15 * 60, 3 * 3600)
+STOPPED_AFTER_SECONDS = 3600  # Breaks longer than this are taken with the device inactive, see libs.idle
+
+# Allowed growth per simulated day, by reading
+DEFAULT_LIMITS = {'rss_kb': 2048, 'traced_kb': 256, 'open_fds': 1, 'sockets': 1, 'threads': 1}
+
+# Clicking these would measure the measuring: profiles run cProfile, and memory snapshots start and stop tracemalloc
+SKIPPED_MENU_ITEMS = ('Profile the app loop', 'Take memory snapshot')
+
+# The stand-in API shares the process; what it allocates doesn't count
+TRACEMALLOC_EXCLUDED = ('*/devtools/*', '*/http/server.py', '*/socketserver.py', tracemalloc.__file__)
+TOP_GROWTH_SITES = 10
+SETTLE_SECONDS   = .1  # Real time waited before each reading, see sample()
+
+
+# ========
+class SoakSpotifyWrapper (MockSpotifyWrapper):
+    """
+    MockSpotifyWrapper whose access token expires every TOKEN_LIFETIME_SECONDS, getting a new OAuth session each time
+    """
+
+    def __init__(self, api: MockSpotifyAPI, clock: VirtualClock):
+        super().__init__(api, clock)
+        self.expires_at = clock.time()
+        self.refreshes  = 0
+
+    def initialize_spotify_client(self, margin_seconds: float = 1):
+        self.client = OAuthManager.build_oauth_session(self.client_id, f'soak-token-{self.refreshes}')
+        self.expires_at = self.clock.time() + TOKEN_LIFETIME_SECONDS
+        self.refreshes += 1
+        return self.client
+
+    def is_token_expired(self, margin_seconds: float = 1) -> bool:
+        return self.clock.time() >= self.expires_at - margin_seconds
+
+# ====
+class TrayStandIn:
+    """
+    What the menu callbacks use of pytotray.SysTrayIcon, keeping track of which items are enabled
+    """
+
+    def __init__(self, menu: typing.Sequence[typing.Tuple[str, typing.Callable, bool]]):
+        self.icon       = None
+        self.hover_text = heartbroken.TRAY_HOVER_TEXT
+        self.enabled    = [enabled for _, _, enabled in menu]
+
+    def refresh_icon(self) -> None:
+        pass
+
+    def change_menu_item_text(self, index: int, text: str) -> None:
+        pass
+
+    def enable_menu_item(self, index: int) -> None:
+        self.enabled[index] = True
+
+    def disable_menu_item(self, index: int) -> None:
+        self.enabled[index] = False
+
+# ========
+def sample(started_at: float, clock: VirtualClock, api: MockSpotifyAPI,
+           player: MockPlayer) -> typing.Tuple[dict, tracemalloc.Snapshot]:
+    gc.collect()
+
+    # Sessions dropped by a token refresh are closed by the collection; the mock API's threads for their connections
+    # need a moment to see that and exit
+    time.sleep(SETTLE_SECONDS)
+
+    snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, pattern)
+                                                          for pattern in TRACEMALLOC_EXCLUDED])
+
+    reading = {
+        'simulated_hours': round((clock.time() - started_at) / 3600, 2),
+        'rss_kb':          procstats.rss_kb(),
+        'traced_kb':       round(sum(stat.size for stat in snapshot.statistics('filename')) / 1024, 1),
+        'open_fds':        procstats.open_fds(),
+        'sockets':         procstats.open_sockets(),
+        'threads':         threading.active_count(),
+        'api_calls':       sum(api.calls.values()),
+        'skips':           len(player.skip_latencies)
+    }
+
+    return reading, snapshot
+
+# ====
+def slope_per_day(readings: typing.Sequence[dict], key: str) -> typing.Union[None, float]:
+    """
+    Least-squares slope of :key against simulated time, per day; None if it wasn't read
+    """
+
+    points = [(reading['simulated_hours'] / 24, reading[key]) for reading in readings if reading[key] is not None]
+    if len(points) < 2:
+        return None
+
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance if variance else None
+
+# ========
+def run(days: float, warmup_hours: float, track_count: int, disliked_fraction: float, speed: float,
+        seed: int) -> dict:
+    rng    = random.Random(seed)
+    clock  = VirtualClock(speed=speed, real_time=True)
+    player = MockPlayer(track_count, clock, seed)
+
+    for track in rng.sample(player.tracks, int(track_count * disliked_fraction)):
+        HeartbrokenDatabase.save_heartbreak(track_id=track.id)
+
+    app_loop_should_run = threading.Event()
+    app_loop_should_run.set()
+    stop = threading.Event()
+    control_queue = queue.Queue()
+
+    # Globals the tray process sets up in gui_runner()
+    heartbroken.console_is_visible = False
+    heartbroken.tray_feedback_shown = 0
+
+    menu = heartbroken.tray_menu(app_loop_should_run, control_queue)
+    tray = TrayStandIn(menu)
+    clicks = {}
+
+    tracemalloc.start()
+
+    with MockSpotifyAPI(player) as api:
+        spotify = SoakSpotifyWrapper(api, clock)
+
+        loop_thread = threading.Thread(target=heartbroken.app_loop,
+                                       args=(app_loop_should_run, stop, spotify, control_queue), name='app loop')
+        loop_thread.start()
+
+        started_at   = clock.time()
+        ends_at      = started_at + days * 86400
+        warmup_ends  = started_at + warmup_hours * 3600
+        next_sample  = warmup_ends
+        next_action  = started_at + ACTION_SECONDS
+        session_ends = started_at + rng.uniform(*LISTENING_SECONDS)
+
+        readings = []
+        baseline = latest = None
+
+        while clock.time() < ends_at and loop_thread.is_alive():
+            now = clock.time()
+
+            if now >= session_ends:
+                if player.is_playing:
+                    # Longer breaks outlast the device's session, so they are spent checking the device list
+                    break_seconds = rng.uniform(*BREAK_SECONDS)
+                    if break_seconds > STOPPED_AFTER_SECONDS:
+                        player.stop()
+                    else:
+                        player.pause()
+                    session_ends = now + break_seconds
+                else:
+                    player.resume()
+                    session_ends = now + rng.uniform(*LISTENING_SECONDS)
+
+            if now >= next_action:
+                # Auto-skip is only left paused until the next click
+                if not app_loop_should_run.is_set():
+                    index = 0
+                else:
+                    index = rng.choice([index for index, (label, _, _) in enumerate(menu)
+                                        if tray.enabled[index] and label not in SKIPPED_MENU_ITEMS])
+
+                label, action, _ = menu[index]
+                action(tray)
+                clicks[label] = clicks.get(label, 0) + 1
+                next_action = now + ACTION_SECONDS
+
+            if now >= next_sample:
+                reading, latest = sample(started_at, clock, api, player)
+                readings.append(reading)
+                baseline = baseline or latest
+                next_sample = now + SAMPLE_SECONDS
+
+            time.sleep(.005)
+
+        loop_exited = not loop_thread.is_alive()
+
+        stop.set()
+        control_queue.put((constants.Command.WAKE, None))
+        loop_thread.join()
+
+    tracemalloc.stop()
+
+    top_growth = []
+    if baseline is not latest:
+        top_growth = [str(difference) for difference in latest.compare_to(baseline, 'lineno')[:TOP_GROWTH_SITES]]
+
+    return {
+        'simulated_days': round((clock.time() - started_at) / 86400, 2),
+        'loop_exited':    loop_exited,
+        'token_refreshes': spotify.refreshes,
+        'tray_clicks':    clicks,
+        'api_calls':      dict(api.calls),
+        'skips':          len(player.skip_latencies),
+        'readings':       readings,
+        'top_growth':     top_growth
+    }
+
+# ========
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Soak test the app loop and tray actions over simulated days')
+    parser.add_argument('--days',     type=float, default=2, help='Simulated days to run for (default 2)')
+    parser.add_argument('--warmup',   type=float, default=3,
+                        help='Simulated hours before the first reading, while caches fill up (default 3)')
+    parser.add_argument('--tracks',   type=int,   default=2000, help='Size of the simulated library (default 2000)')
+    parser.add_argument('--disliked', type=float, default=.1, help='Fraction of tracks disliked (default .1)')
+    parser.add_argument('--speed',    type=float, default=DEFAULT_SPEED,
+                        help=f'Simulated seconds per real second while waiting (default {DEFAULT_SPEED})')
+    parser.add_argument('--seed',     type=int,   default=0)
+    for key, limit in DEFAULT_LIMITS.items():
+        parser.add_argument(f'--max-{key.replace("_", "-")}-per-day', type=float, default=limit, dest=key,
+                            help=f'Allowed growth of {key} per simulated day (default {limit})')
+    parser.add_argument('--output',   default=None, help='Also write the readings and results here as JSON')
+    args = parser.parse_args()
+
+    if args.days * 24 < args.warmup + 3 * SAMPLE_SECONDS / 3600:
+        parser.error('--days has to leave room for at least three readings after the warm-up')
+
+    # The stand-in API is plain HTTP, which OAuth2Session otherwise refuses to send a token over
+    os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+
+    original_directory = os.getcwd()
+
+    # Keep the soak's database, logs and saved files away from the real ones
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            logs.start(console=False)
+            HeartbrokenDatabase.maybe_create_table()
+
+            # The tray's own callbacks print, as the tray process has no log
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = run(args.days, args.warmup, args.tracks, args.disliked, args.speed, args.seed)
+        finally:
+            logs.stop()
+            os.chdir(original_directory)
+
+    checks = []
+    for key in DEFAULT_LIMITS:
+        slope = slope_per_day(results['readings'], key)
+        limit = getattr(args, key)
+        checks.append((key, slope is None or slope <= limit, slope, limit))
+
+    checks.append(('app loop ran throughout', not results['loop_exited'], None, None))
+
+    for name, passed, slope, limit in checks:
+        detail = '' if limit is None else \
+                 ('not available here' if slope is None else f'{slope:+.2f} per day (limit {limit:g})')
+        print(f'{"ok  " if passed else "FAIL"} {name:25}{detail}')
+
+    polls = results['api_calls'].get('GET /me/player/currently-playing', 0)
+    print(f'\n{results["simulated_days"]} simulated days, {polls} polls, {results["skips"]} skips, '
+          f'{results["token_refreshes"]} token refreshes, {sum(results["tray_clicks"].values())} tray clicks')
+
+    if results['readings']:
+        first, last = results['readings'][0], results['readings'][-1]
+        print(f'RSS {first["rss_kb"]} -> {last["rss_kb"]} KiB, traced {first["traced_kb"]} -> {last["traced_kb"]} KiB, '
+              f'sockets {first["sockets"]} -> {last["sockets"]}, threads {first["threads"]} -> {last["threads"]}')
+
+    if args.output is not None:
+        report = {
+            'benchmark':  'soak',
+            'commit':     procstats.git_commit(),
+            'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python':     sys.version.split()[0],
+            'platform':   sys.platform,
+            'scenario':   {'days': args.days, 'warmup_hours': args.warmup, 'tracks': args.tracks,
+                           'disliked_fraction': args.disliked, 'speed': args.speed, 'seed': args.seed},
+            'limits':     {key: getattr(args, key) for key in DEFAULT_LIMITS},
+            'checks':     {name: {'passed': passed, 'slope_per_day': slope} for name, passed, slope, _ in checks},
+            **results
+        }
+
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return 0 if all(passed for _, passed, _, _ in checks) else 1
+
+# ====
+if __name__ == '__main__':
+    sys.exit(main())
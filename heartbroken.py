@@ -1,78 +1,359 @@
+import argparse
 import atexit
 import ctypes
+import logging
 import multiprocessing
 import os
+import queue
+import signal
+import socket
+import sys
+import threading
 import time
 import typing
 
-from libs import pytotray, hbcontrol, constants
-from libs.database import HeartbrokenDatabase
-from libs.tokenhandler import TokenHandler, OAuthManager
-from libs.spotifywrapper import SpotifyWrapper
+# The tray process starts by importing this module again, so only what both processes need is imported up here.
+# The app loop's dependencies (requests, sqlite3, ...) and the tray's (pywin32) are imported where they are used.
+from libs import constants, tracing
 
+if typing.TYPE_CHECKING:
+    from libs import nowplaying, pytotray
+    from libs.spotifywrapper import SpotifyWrapper
+    from libs.supervisor import Supervisor
+
+
+logger = logging.getLogger('heartbroken')
 
 TRAY_PROCESS         = None
 OAUTH_SERVER_PROCESS = None
 
+# The app loop waits for its next timer or a control message, but never longer than this, so that ctrl+c (which
+# can't interrupt a wait on Windows) and housekeeping like finishing a profile happen in good time
+MAX_WAIT_SECONDS = 1
+
+COALESCED_COMMANDS = (constants.Command.DISLIKE, constants.Command.UNDISLIKE, constants.Command.PRINT_STATS,
+                      constants.Command.SHOW_LOG, constants.Command.START_PROFILE, constants.Command.MEMORY_SNAPSHOT)
+
+TRAY_HOVER_TEXT        = 'Heartbroken - Dislike for Spotify'
+TRAY_COALESCE_SECONDS  = 1.5  # Repeat clicks on the same tray item within this long are dropped, except toggles
+TRAY_FEEDBACK_SECONDS  = 4    # How long the hover text shows what was just clicked
+
 # ========
-def app_loop(app_loop_should_run: multiprocessing.Event, gui_process_terminated: multiprocessing.Event) -> int:
+def app_loop(app_loop_should_run: multiprocessing.Event, gui_process_terminated: multiprocessing.Event,
+             spotify: typing.Union[None, 'SpotifyWrapper'] = None,
+             control_queue: typing.Union[None, multiprocessing.Queue] = None,
+             now_playing: typing.Union[None, 'nowplaying.PollingSource'] = None) -> int:
     """
     The main body of Heartbroken. Controls program initialization as well as the scheduling of calls to the
     Spotify API.
 
+    :spotify can be provided to swap out the HTTP layer and clock (see libs.replay); a plain SpotifyWrapper is used otherwise
+    :control_queue receives messages from the tray (see constants.Command)
+    :now_playing decides when to poll (see libs.nowplaying); every REQUEST_INTERVAL_SECONDS by default, and as
+    libs.idle says while nothing is playing
+
     Returns exit codes 0, 1, or 2 
     """
 
-    spotify = SpotifyWrapper()
+    from libs import hbcontrol, idle, metrics, nowplaying, profiling
+    from libs.scheduler import Scheduler, forward_control_messages
+    from libs.spotifywrapper import SpotifyWrapper
+
+    if spotify is None:
+        spotify = SpotifyWrapper()
+
+    if now_playing is None:
+        now_playing = nowplaying.PollingSource()
+
+    if not connect_account(spotify):
+        return 1
+
+    spotify.update_current_track()
+
+    scheduler = Scheduler(spotify.clock)
+
+    # Messages are moved to the inbox by a thread that wakes the scheduler, so they are handled as they arrive
+    inbox = None
+    if control_queue is not None:
+        inbox = queue.Queue()
+        forward_control_messages(control_queue, inbox, scheduler)
+
+    idle_watch = idle.IdleWatch(spotify.clock)
+
+    last_logged_track = None
+    waiting_logged = False
+    token_failures = 0
+    exit_code = None
+
+    def poll():
+        nonlocal last_logged_track, waiting_logged, token_failures, exit_code
+
+        # Spotify hasn't caught up with the last skip yet, so it may still say the skipped track is playing
+        settle_seconds = spotify.seconds_until_settled()
+        if settle_seconds > 0:
+            scheduler.call_later(settle_seconds, 'poll', poll)
+            return
+
+        started = metrics.timer()
+        if spotify.is_token_expired():
+            client = spotify.initialize_spotify_client()
+
+            if client is None:
+                logger.error('Something went wrong while trying to connect your account. Please run Heartbroken again.')
+                exit_code = 2
+                return
+
+            # The next try is a timer like any other poll, so the tray is still heard in between
+            if client == -1:
+                token_failures += 1
+                if token_failures >= constants.SpotifyAPI.TOKEN_REFRESH_ATTEMPTS:
+                    logger.critical('FATAL: Could not get a Spotify access token from the Heartbroken servers '
+                                    'after %d attempts', token_failures)
+                    exit_code = 2
+                    return
+
+                scheduler.call_later(constants.SpotifyAPI.TOKEN_RETRY_SECONDS, 'poll', poll)
+                return
+
+            token_failures = 0
+        metrics.observe_phase('token_check', started)
+
+        # No device is active, so the device list tells sooner than the track when that changes
+        if idle_watch.checks_devices:
+            if not idle_watch.observe_devices(*spotify.get_json('/me/player/devices')):
+                scheduler.call_later(idle_watch.next_delay(), 'poll', poll)
+                return
+
+        started = metrics.timer()
+        verdict = hbcontrol.skip_if_heartbroken(spotify)
+        metrics.observe_phase('poll', started)
+
+        idle_watch.observe(spotify.player_state)
+
+        # Keep things nice rate-limiting-wise
+        delay = constants.SpotifyAPI.REQUEST_INTERVAL_SECONDS
+
+        # A disliked track was just skipped, so look at what came next as soon as Spotify has caught up
+        if verdict == True:
+            delay = spotify.seconds_until_settled()
+
+        # Nothing is playing or a network error was encountered
+        elif verdict is None:
+            if not waiting_logged:
+                logger.info('Nothing is currently playing, waiting (ctrl+c to exit)...')
+                last_logged_track = None
+                waiting_logged = True
+
+            delay = idle_watch.next_delay()
+
+        else:
+            if last_logged_track is None or spotify.current_track.id != last_logged_track.id:
+                logger.info('Currently playing: %s', spotify.current_track)
+                last_logged_track = spotify.current_track
+                waiting_logged = False
+
+                # Genres and audio features of what's coming up, for rules that use them, while there's time
+                scheduler.call_later(0, 'prefetch_metadata', lambda: hbcontrol.prefetch_metadata(spotify))
+
+            delay = now_playing.next_poll_delay(spotify.current_track, delay)
+
+        # None: nothing to poll for until the now-playing source sees a change
+        if delay is not None:
+            scheduler.call_later(delay, 'poll', poll)
+
+    now_playing.start(scheduler.wake)
+    scheduler.call_later(0, 'poll', poll)
+    paused = False
+
+    try:
+        while True:
+            was_paused, paused = paused, not app_loop_should_run.is_set()
+            changed = now_playing.has_changed()
+
+            # Dislikes and un-dislikes still come in while auto-skip is paused
+            nudged = handle_control_messages(inbox, spotify, paused=paused) and idle_watch.nudge()
+
+            # Don't sit out the rest of a wait that was scheduled before the pause, check on a change the now-playing
+            # source saw straight away, and when nothing is playing, as soon as someone is at the tray
+            if not paused and (was_paused or changed or nudged):
+                scheduler.cancel('poll')
+                scheduler.call_later(0, 'poll', poll)
+
+            profile_path = profiling.finish_profile_if_due()
+            if profile_path is not None:
+                logger.info('Saved profile to %s', os.path.abspath(profile_path))
+
+            if not paused:
+                scheduler.run_due()
+
+            if exit_code is not None:
+                return exit_code
+
+            if gui_process_terminated.is_set():
+                return 0
+
+            started = metrics.timer()
+            scheduler.wait(MAX_WAIT_SECONDS, timers=not paused)
+            metrics.observe_phase('wait', started)
+    finally:
+        now_playing.stop()
+
+# ========
+def async_app_loop(app_loop_should_run: multiprocessing.Event, gui_process_terminated: multiprocessing.Event,
+                   spotify: typing.Union[None, 'SpotifyWrapper'] = None,
+                   control_queue: typing.Union[None, multiprocessing.Queue] = None) -> int:
+    """
+    app_loop() on the asyncio engine (libs.asyncengine), where polling, queue lookahead, token refresh and control
+    messages run concurrently. :spotify only provides the API's URL and the access token here.
+
+    Returns exit codes 0, 1, or 2
+    """
+
+    from libs import asyncengine
+    from libs.spotifywrapper import SpotifyWrapper
+
+    if spotify is None:
+        spotify = SpotifyWrapper()
+
+    if not connect_account(spotify):
+        return 1
+
+    # Dislikes are the engine's own; everything else is handled here, the same as in app_loop()
+    def other_commands(command, payload):
+        handle_control_message(command, payload, spotify)
+
+    return asyncengine.run(app_loop_should_run, gui_process_terminated, spotify, control_queue, other_commands)
+
+# ====
+def multi_account_app_loop(accounts_directory: str, app_loop_should_run: threading.Event, terminated: threading.Event,
+                           control_queue: typing.Union[None, queue.Queue] = None) -> int:
+    """
+    Serves every connected account under :accounts_directory from this process (see libs.accounts)
+
+    Returns exit codes 0, 1, or 2
+    """
+
+    from libs import accounts
+
+    connected = [account for account in accounts.AccountRegistry(accounts_directory).accounts() if account.is_connected]
+    if len(connected) == 0:
+        logger.error('No accounts are connected in %s, add one with: python -m libs.accounts add <name>',
+                     accounts_directory)
+        return 1
+
+    def other_commands(command, payload):
+        handle_control_message(command, payload, None)
+
+    return accounts.run(accounts_directory, connected, app_loop_should_run, terminated, control_queue, other_commands)
+
+# ====
+def connect_account(spotify: 'SpotifyWrapper') -> bool:
+    """
+    Gets :spotify an access token, running the OAuth flow first if no account has been connected yet.
+    Returns False if connecting failed.
+    """
 
     if spotify.initialize_spotify_client() is None:
-        print('No account credentials found, running Spotify OAuth flow...')
+        logger.info('No account credentials found, running Spotify OAuth flow...')
         global OAUTH_SERVER_PROCESS
+        from libs.tokenhandler import OAuthManager
 
         oauth_handler_generator = OAuthManager.do_spotify_oauth()
         OAUTH_SERVER_PROCESS    = next(oauth_handler_generator)
         oauth_result            = next(oauth_handler_generator)
 
         if oauth_result is None:
-            print('\nSomething went wrong while trying to connect your account. Please run Heartbroken again.\n')
-            return 1
+            logger.error('Something went wrong while trying to connect your account. Please run Heartbroken again.')
+            return False
 
         spotify.initialize_spotify_client()
 
-    spotify.update_current_track()
-    last_logged_track = None
-    backing_off = False
+    return True
+
+# ========
+def handle_control_messages(control_queue: typing.Union[None, multiprocessing.Queue], spotify: 'SpotifyWrapper',
+                            paused: bool = False) -> bool:
+    """
+    Carries out everything the tray has asked of the app loop since the last call.
+    Dislikes act on :spotify's current track and session; while :paused, the current track is fetched first.
+
+    Returns True if any of it means someone is at the tray (see libs.idle.NUDGING_COMMANDS)
+    """
+
+    from libs import idle
+
+    if control_queue is None:
+        return False
+
+    handled = set()
+    nudging = False
 
     while True:
-        if gui_process_terminated.is_set():
-            return 0
+        try:
+            command, payload = control_queue.get_nowait()
+        except queue.Empty:
+            return nudging
 
-        app_loop_should_run.wait()
+        nudging = nudging or command in idle.NUDGING_COMMANDS
 
-        if TokenHandler.is_token_expired():
-            if spotify.initialize_spotify_client() is None:
-                print('\nSomething went wrong while trying to connect your account. Please run Heartbroken again.\n')
-                return 2
+        # The same dislike twice in one batch (a double click, a repeated socket command) is only carried out once
+        if command in COALESCED_COMMANDS:
+            if (command, payload) in handled:
+                continue
+            handled.add((command, payload))
 
-        # Nothing is playing or a network error was encountered
-        if hbcontrol.skip_if_heartbroken(spotify) is None:
-            if not spotify.backing_off:
-                print('\nNothing is currently playing, waiting (ctrl+c to exit)...')
-                last_logged_track = None
+        handle_control_message(command, payload, spotify, paused)
+
+# ====
+def handle_control_message(command: str, payload: typing.Any, spotify: 'SpotifyWrapper', paused: bool = False) -> None:
+    """
+    Carries out one message from the tray, see constants.Command
+    """
+
+    if command in (constants.Command.WAKE, constants.Command.NUDGE):
+        pass
 
-            time.sleep(spotify.get_backoff())
+    elif command == constants.Command.DUMP_TRACE:
+        path = tracing.dump(other_events=payload)
+        logger.info('Saved performance trace to %s', os.path.abspath(path))
 
-        elif last_logged_track is None or spotify.current_track.id != last_logged_track.id:
-            print(f'Currently playing: {spotify.current_track}')
-            last_logged_track = spotify.current_track
-            spotify.reset_backoff()
+    elif command == constants.Command.DISLIKE:
+        from libs import hbcontrol
+        hbcontrol.handle_heartbreak(spotify, **{payload: True}, refresh=paused)
 
-        # Keep things nice rate-limiting-wise. Rely on back-off delay otherwise.
-        if not backing_off:
-            time.sleep(constants.SpotifyAPI.REQUEST_INTERVAL_SECONDS)
+    elif command == constants.Command.UNDISLIKE:
+        from libs import hbcontrol
+        hbcontrol.handle_clear_heartbreak(spotify, **{payload: True}, refresh=paused)
+
+    elif command == constants.Command.PRINT_STATS:
+        from libs import leakage
+        logger.info('%s', leakage.report())
+
+    elif command == constants.Command.SHOW_LOG:
+        from libs import logs
+        path = os.path.abspath(logs.save_recent())
+
+        # Windows only; elsewhere there is no tray, and the control socket's log command does the same
+        if hasattr(os, 'startfile'):
+            os.startfile(path)
+        else:
+            logger.info('Saved the recent log to %s', path)
+
+    elif command == constants.Command.START_PROFILE:
+        from libs import profiling
+        profiling.start_profile(payload)
+
+    elif command == constants.Command.MEMORY_SNAPSHOT:
+        from libs import profiling
+        report_path = profiling.memory_snapshot()
+        if report_path is None:
+            logger.info('Took a baseline memory snapshot; take another one later to see what grew')
+        else:
+            logger.info('Saved memory report to %s', os.path.abspath(report_path))
 
 # ========
-def toggle_auto_skip(menu: pytotray.SysTrayIcon, app_loop_should_run: multiprocessing.Event) -> None:
+def toggle_auto_skip(menu: 'pytotray.SysTrayIcon', app_loop_should_run: multiprocessing.Event,
+                     control_queue: multiprocessing.Queue) -> None:
     """
     GUI callback that handles both altering the system tray menu and setting the main loop's Event
     to its paused state
@@ -106,14 +387,18 @@ def toggle_auto_skip(menu: pytotray.SysTrayIcon, app_loop_should_run: multiproce
 
         print('Heartbroken auto-skip resumed')
 
+    control_queue.put((constants.Command.WAKE, None))
+
 # ========
-def on_quit_cleanup(app_loop_should_run: multiprocessing.Event, gui_process_terminated: multiprocessing.Event) -> None:
+def on_quit_cleanup(app_loop_should_run: multiprocessing.Event, gui_process_terminated: multiprocessing.Event,
+                    control_queue: multiprocessing.Queue) -> None:
     """
     Handler that sets the program's core Events to their shutdown state
     """
 
     gui_process_terminated.set()
     app_loop_should_run.set()
+    control_queue.put((constants.Command.WAKE, None))
 
 # ========
 def toggle_console_visibility(forced_visibility_state: typing.Union[None, bool] = None) -> None:
@@ -128,69 +413,474 @@ def toggle_console_visibility(forced_visibility_state: typing.Union[None, bool]
 
     global console_is_visible
 
+    # Windows only; there is no console window to show or hide anywhere else
+    if not hasattr(ctypes, 'windll'):
+        return
+
     console_is_visible = (not console_is_visible) if forced_visibility_state is None else forced_visibility_state
     visible_flag = 4 if console_is_visible else 0
     ctypes.windll.user32.ShowWindow(ctypes.windll.kernel32.GetConsoleWindow(), visible_flag)
 
 # ========
-def gui_runner(app_loop_should_run: multiprocessing.Event, gui_process_terminated: multiprocessing.Event) -> typing.NoReturn:
+def request_heartbreak(control_queue: multiprocessing.Queue, item_type: str, clear: bool = False) -> None:
+    """
+    GUI callback for the (un-)dislike items. The app loop does the work against the track it is looking at, so the
+    tray never talks to Spotify itself.
+    """
+
+    control_queue.put((constants.Command.UNDISLIKE if clear else constants.Command.DISLIKE, item_type))
+
+# ========
+def request_stats(control_queue: multiprocessing.Queue) -> None:
+    """
+    GUI callback that shows the console and has the app loop print its skip statistics to it
+    """
+
+    toggle_console_visibility(forced_visibility_state=True)
+    control_queue.put((constants.Command.PRINT_STATS, None))
+
+# ====
+def request_log(control_queue: multiprocessing.Queue) -> None:
+    """
+    GUI callback that has the app loop open what it logged last, without having to keep the console open
+    """
+
+    control_queue.put((constants.Command.SHOW_LOG, None))
+
+# ====
+def request_profile(control_queue: multiprocessing.Queue) -> None:
+    """
+    GUI callback that profiles the app loop for a while without pausing it. The .prof is saved when it is done.
+    """
+
+    toggle_console_visibility(forced_visibility_state=True)
+    control_queue.put((constants.Command.START_PROFILE, constants.SpotifyAPI.PROFILE_SECONDS))
+
+# ====
+def request_memory_snapshot(control_queue: multiprocessing.Queue) -> None:
+    """
+    GUI callback for memory snapshots; the first one is the baseline that later ones are compared against
+    """
+
+    toggle_console_visibility(forced_visibility_state=True)
+    control_queue.put((constants.Command.MEMORY_SNAPSHOT, None))
+
+# ========
+def request_trace_dump(control_queue: multiprocessing.Queue) -> None:
+    """
+    GUI callback that hands the tray's trace events to the app loop, which merges them with its own and saves the file
+    """
+
+    control_queue.put((constants.Command.DUMP_TRACE, tracing.events()))
+    print('Saving performance trace...')
+
+# ========
+def tray_action(label: str, action: typing.Callable, feedback: typing.Union[None, str],
+                coalesce: bool = True) -> typing.Callable:
+    """
+    Wraps a tray menu callback. Every action only hands work to the app loop, so the message pump is never held up by
+    the network; this adds coalescing of repeat clicks with :coalesce (a double click would otherwise dislike the
+    track after the one that was meant) and shows :feedback in the hover text straight away instead of waiting for
+    the loop.
+    """
+
+    last_clicked_at = None
+
+    def run_action(menu):
+        nonlocal last_clicked_at
+
+        clicked_at = time.monotonic()
+        if coalesce and last_clicked_at is not None and clicked_at - last_clicked_at < TRAY_COALESCE_SECONDS:
+            return
+        last_clicked_at = clicked_at
+
+        with tracing.span('tray action', action=label):
+            action(menu)
+
+            if feedback is not None:
+                show_tray_feedback(menu, feedback)
+
+    return run_action
+
+# ====
+def show_tray_feedback(menu: 'pytotray.SysTrayIcon', feedback: str) -> None:
+    """
+    Shows :feedback in the tray icon's hover text for a few seconds
+    """
+
+    global tray_feedback_shown
+
+    menu.hover_text = f'Heartbroken - {feedback}'
+    menu.refresh_icon()
+
+    tray_feedback_shown += 1
+    shown = tray_feedback_shown
+
+    def restore_hover_text():
+        # Leave it alone if something newer is being shown
+        if shown == tray_feedback_shown:
+            menu.hover_text = TRAY_HOVER_TEXT
+            menu.refresh_icon()
+
+    timer = threading.Timer(TRAY_FEEDBACK_SECONDS, restore_hover_text)
+    timer.daemon = True
+    timer.start()
+
+# ========
+def gui_runner(app_loop_should_run: multiprocessing.Event, gui_process_terminated: multiprocessing.Event,
+               control_queue: multiprocessing.Queue, trace_enabled: bool = False) -> typing.NoReturn:
     """
     Target of the GUI thread. This is where the system tray icon is initialized and its loop runs.
     """
 
-    global console_is_visible
+    from libs import pytotray
+
+    global console_is_visible, tray_feedback_shown
     console_is_visible = False
+    tray_feedback_shown = 0
+
+    if trace_enabled:
+        tracing.enable('Heartbroken tray')
 
     icon = './heartbroken.ico' if os.path.isfile('./heartbroken.ico') else './resources/heartbroken.ico'
-    hover_text= 'Heartbroken - Dislike for Spotify'
+    menu = tray_menu(app_loop_should_run, control_queue, trace_enabled)
+
+    try:
+        # Opening the menu is a sign that playing may start soon, see libs.idle
+        tray = pytotray.SysTrayIcon(icon, TRAY_HOVER_TEXT, menu,
+                                    on_quit=lambda _: on_quit_cleanup(app_loop_should_run, gui_process_terminated, control_queue),
+                                    on_menu=lambda _: control_queue.put((constants.Command.NUDGE, None)))
+    except KeyboardInterrupt:
+        tray.destroy()
+
+# ====
+def tray_menu(app_loop_should_run: multiprocessing.Event, control_queue: multiprocessing.Queue,
+              trace_enabled: bool = False) -> typing.Tuple[typing.Tuple[str, typing.Callable, bool], ...]:
+    """
+    The tray's menu items as pytotray takes them, (label, callback taking the menu, initially enabled).
+    Also driven without a tray by devtools.soak.
+    """
 
     # A quit option is automatically injected by pytotray
+    # (label, action, initially enabled, hover text shown right after it is clicked, repeat clicks dropped)
+    # Toggles always go through, however quickly they are clicked again; the rest would only repeat themselves
     menu = (
-        ('Pause auto-skip',           (lambda menu: toggle_auto_skip(menu, app_loop_should_run)), True),
-        ('Dislike current track',     (lambda _: hbcontrol.handle_heartbreak(track=True)),  True),
-        ('Dislike current artist',    (lambda _: hbcontrol.handle_heartbreak(artist=True)), True),
-        ('Dislike current album',     (lambda _: hbcontrol.handle_heartbreak(album=True)),  True),
-        ('Un-dislike current track',  (lambda _: hbcontrol.handle_clear_heartbreak(track=True)),  False),
-        ('Un-dislike current artist', (lambda _: hbcontrol.handle_clear_heartbreak(artist=True)), False),
-        ('Un-dislike current album',  (lambda _: hbcontrol.handle_clear_heartbreak(album=True)),  False),
-        ('Hide/show console',         (lambda _: toggle_console_visibility()), True)
+        ('Pause auto-skip',           (lambda menu: toggle_auto_skip(menu, app_loop_should_run, control_queue)), True, None, False),
+        ('Dislike current track',     (lambda _: request_heartbreak(control_queue, 'track')),  True, 'Disliked current track',  True),
+        ('Dislike current artist',    (lambda _: request_heartbreak(control_queue, 'artist')), True, 'Disliked current artist', True),
+        ('Dislike current album',     (lambda _: request_heartbreak(control_queue, 'album')),  True, 'Disliked current album',  True),
+        ('Un-dislike current track',  (lambda _: request_heartbreak(control_queue, 'track',  clear=True)), False, 'Un-disliked current track',  True),
+        ('Un-dislike current artist', (lambda _: request_heartbreak(control_queue, 'artist', clear=True)), False, 'Un-disliked current artist', True),
+        ('Un-dislike current album',  (lambda _: request_heartbreak(control_queue, 'album',  clear=True)), False, 'Un-disliked current album',  True),
+        ('Hide/show console',         (lambda _: toggle_console_visibility()), True, None, False),
+        ('Show skip stats',           (lambda _: request_stats(control_queue)), True, None, True),
+        ('Show recent log',           (lambda _: request_log(control_queue)), True, None, True),
+        ('Profile the app loop',      (lambda _: request_profile(control_queue)), True, 'Profiling the app loop', True),
+        ('Take memory snapshot',      (lambda _: request_memory_snapshot(control_queue)), True, 'Took a memory snapshot', True)
     )
 
-    try:
-        tray = pytotray.SysTrayIcon(icon, hover_text, menu,
-                                    on_quit=lambda _: on_quit_cleanup(app_loop_should_run, gui_process_terminated))
-    except KeyboardInterrupt:
-        tray.destroy()
+    if trace_enabled:
+        menu += (('Save performance trace', (lambda _: request_trace_dump(control_queue)), True, 'Saving performance trace', True),)
+
+    return tuple((label, tray_action(label, action, feedback, coalesce), enabled)
+                 for label, action, enabled, feedback, coalesce in menu)
 
 # ========
-def main() -> int:
+def headless_control_handlers(app_loop_should_run: threading.Event, shutdown: threading.Event,
+                              control_queue: queue.Queue,
+                              account_names: typing.Union[None, typing.Sequence[str]] = None) -> typing.Dict[str, typing.Callable]:
+    """
+    What the control socket can do in headless mode; these stand in for the tray menu.
+    Each handler takes the command's argument and returns a message for the client.
+    In multi-account mode, :account_names are the accounts served and dislikes name one: "alice:track".
+    """
+
+    def target(argument):
+        if account_names is None:
+            if argument not in ('track', 'artist', 'album'):
+                raise ValueError('Expected track, artist, or album')
+            return argument
+
+        name, _, item_type = (argument or '').partition(':')
+        if name not in account_names or item_type not in ('track', 'artist', 'album'):
+            raise ValueError('Expected <account>:<track, artist, or album>, with an account out of: '
+                             + ', '.join(account_names))
+        return argument
+
+    def status(_):
+        return 'Auto-skip is running' if app_loop_should_run.is_set() else 'Auto-skip is paused'
+
+    def pause(_):
+        app_loop_should_run.clear()
+        control_queue.put((constants.Command.WAKE, None))
+        logger.info('Heartbroken auto-skip paused')
+        return 'Auto-skip paused'
+
+    def resume(_):
+        app_loop_should_run.set()
+        control_queue.put((constants.Command.WAKE, None))
+        logger.info('Heartbroken auto-skip resumed')
+        return 'Auto-skip resumed'
+
+    def current(argument):
+        name, _, item_type = argument.rpartition(':')
+        return f"{name}'s current {item_type}" if name else f'the current {item_type}'
+
+    def dislike(argument):
+        request_heartbreak(control_queue, target(argument))
+        return f'Disliking {current(argument)}, see the Heartbroken log for the result'
+
+    def undislike(argument):
+        request_heartbreak(control_queue, target(argument), clear=True)
+        return f'Un-disliking {current(argument)}, see the Heartbroken log for the result'
+
+    def stats(_):
+        from libs import leakage
+        return leakage.report()
+
+    def log(argument):
+        from libs import logs
+
+        try:
+            count = None if argument is None else int(argument)
+        except ValueError:
+            raise ValueError('Expected the number of lines') from None
+
+        return '\n'.join(logs.recent(count)) or 'Nothing has been logged yet'
+
+    def profile(_):
+        control_queue.put((constants.Command.START_PROFILE, constants.SpotifyAPI.PROFILE_SECONDS))
+        return f'Profiling the app loop for {constants.SpotifyAPI.PROFILE_SECONDS} seconds'
+
+    def memory(_):
+        control_queue.put((constants.Command.MEMORY_SNAPSHOT, None))
+        return 'Taking a memory snapshot, see the Heartbroken log for where the report was saved'
+
+    def trace(_):
+        if not tracing.ENABLED:
+            raise ValueError('Tracing is off, start Heartbroken with --trace to record a timeline')
+
+        control_queue.put((constants.Command.DUMP_TRACE, []))
+        return 'Saving the performance trace, see the Heartbroken log for where it was saved'
+
+    def quit(_):
+        on_quit_cleanup(app_loop_should_run, shutdown, control_queue)
+        return 'Heartbroken is exiting'
+
+    return {'status': status, 'pause': pause, 'resume': resume, 'dislike': dislike, 'undislike': undislike,
+            'stats': stats, 'log': log, 'profile': profile, 'memory': memory, 'trace': trace, 'quit': quit}
+
+# ====
+def supervisor_control_handlers(supervisor: 'Supervisor',
+                                control_queue: queue.Queue) -> typing.Dict[str, typing.Callable]:
+    """
+    Control socket commands that work differently when the accounts are split over worker processes (--workers)
+    """
+
+    def workers(argument):
+        try:
+            worker_count = int(argument)
+        except (TypeError, ValueError):
+            raise ValueError('Expected the number of worker processes') from None
+
+        if worker_count < 1:
+            raise ValueError('There has to be at least one worker process')
+
+        control_queue.put((constants.Command.SET_WORKERS, worker_count))
+        return f'Moving to {worker_count} worker process(es), see the Heartbroken log for the accounts moved'
+
+    def stats(_):
+        return supervisor.report()
+
+    return {'workers': workers, 'stats': stats}
+
+# ========
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Heartbroken - Dislike for Spotify')
+    parser.add_argument('--record-trace', metavar='PATH', default=None,
+                        help='Record Spotify player responses to a trace file that can be replayed with libs.replay')
+    parser.add_argument('--trace', action='store_true',
+                        help='Record a timeline of the app loop and tray, saved from the tray menu as a Chrome trace')
+    parser.add_argument('--metrics-port', metavar='PORT', type=int, default=None,
+                        help='Serve loop timings and counters at http://127.0.0.1:PORT/metrics (Prometheus format)')
+    parser.add_argument('--headless', action='store_true',
+                        help='Run as a single process without the tray icon, controlled through a Unix domain socket '
+                             '(see python -m libs.controlsocket --help). The default outside of Windows.')
+    parser.add_argument('--control-socket', metavar='PATH', default=None,
+                        help='Where the control socket is created in headless mode (default ./heartbroken.sock)')
+    parser.add_argument('--engine', choices=('threaded', 'asyncio'), default='threaded',
+                        help='threaded (default) polls and skips one request at a time; asyncio also looks ahead in '
+                             'the queue and refreshes the token alongside polling')
+    parser.add_argument('--now-playing', choices=('polling', 'mpris'), default='polling',
+                        help='polling (default) asks the Spotify API what is playing every second; mpris follows the '
+                             'Spotify client on this Linux desktop over D-Bus and only calls the API when the track '
+                             'changes (needs jeepney, polls while the client is not playing)')
+    parser.add_argument('--accounts', metavar='DIR', default=None,
+                        help='Serve every account connected under DIR (see python -m libs.accounts --help) from this '
+                             'one process. Runs headless on the asyncio engine.')
+    parser.add_argument('--workers', metavar='N', type=int, default=None,
+                        help='With --accounts, split the accounts over N worker processes, restarting any that crash. '
+                             'Health and throughput are served at /health next to /metrics with --metrics-port.')
+
+    args = parser.parse_args()
+    if args.accounts is not None:
+        args.headless = True
+        args.engine = 'asyncio'
+
+    if args.workers is not None and (args.accounts is None or args.workers < 1):
+        parser.error('--workers needs --accounts and at least one worker')
+
+    if args.engine == 'asyncio' and args.record_trace is not None:
+        parser.error('--record-trace only works with the threaded engine')
+
+    if args.engine == 'asyncio' and args.now_playing != 'polling':
+        parser.error('--now-playing only works with the threaded engine')
+
+    return args
+
+# ========
+def main(args: argparse.Namespace) -> int:
     print('~ HEARTBROKEN FOR SPOTIFY ~\n')
 
     global TRAY_PROCESS
+    from libs import logs, metrics
+    from libs.database import HeartbrokenDatabase
 
-    if HeartbrokenDatabase.maybe_create_table() == False:
+    # From here on the app loop side logs through a queue, see libs.logs; the tray process keeps printing
+    logs.start()
+    atexit.register(logs.stop)
+
+    # Every account has its own database in multi-account mode
+    if args.accounts is None and HeartbrokenDatabase.maybe_create_table() == False:
         return 3
 
+    if not args.headless and sys.platform != 'win32':
+        logger.warning('The tray icon is only available on Windows, running headless')
+        args.headless = True
+
+    if args.headless and not hasattr(socket, 'AF_UNIX'):
+        logger.error('Headless mode needs Unix domain socket support, which this platform does not have')
+        return 4
+
+    if args.trace:
+        tracing.enable('Heartbroken app loop')
+        where = 'send the trace command over the control socket' if args.headless else 'use "Save performance trace" in the tray menu'
+        logger.info('Tracing enabled, %s to save a timeline', where)
+
+    # The supervisor serves every worker's metrics itself, see run_headless()
+    if args.metrics_port is not None and args.workers is None:
+        metrics.serve(args.metrics_port)
+        logger.info('Serving metrics at http://127.0.0.1:%d/metrics', args.metrics_port)
+
+    spotify = None
+    if args.record_trace is not None:
+        from libs.replay import RecordingSpotifyWrapper
+        spotify = RecordingSpotifyWrapper(args.record_trace)
+        logger.info('Recording player trace to %s', args.record_trace)
+
+    if args.headless:
+        return run_headless(args, spotify)
+
     # Set == running
     app_loop_should_run = multiprocessing.Event()
     app_loop_should_run.set()
 
     tray_process_terminated = multiprocessing.Event()
+    control_queue = multiprocessing.Queue()
 
     TRAY_PROCESS = multiprocessing.Process(target=gui_runner,
-                                           args=(app_loop_should_run, tray_process_terminated))
+                                           args=(app_loop_should_run, tray_process_terminated, control_queue, args.trace))
     TRAY_PROCESS.start()
     atexit.register(TRAY_PROCESS.terminate)
 
-    return app_loop(app_loop_should_run, tray_process_terminated)
+    return run_engine(args, app_loop_should_run, tray_process_terminated, spotify, control_queue)
+
+# ====
+def run_engine(args: argparse.Namespace, app_loop_should_run, terminated, spotify: typing.Union[None, 'SpotifyWrapper'],
+               control_queue) -> int:
+    """
+    Runs the app loop on the engine picked with --engine until :terminated is set, or every account's with --accounts
+    """
+
+    if args.accounts is not None:
+        return multi_account_app_loop(args.accounts, app_loop_should_run, terminated, control_queue)
+
+    if args.engine == 'asyncio':
+        return async_app_loop(app_loop_should_run, terminated, spotify, control_queue)
+
+    now_playing = None
+    if args.now_playing == 'mpris':
+        from libs import nowplaying
+        now_playing = nowplaying.MprisSource()
+
+    return app_loop(app_loop_should_run, terminated, spotify, control_queue, now_playing)
+
+# ====
+def run_headless(args: argparse.Namespace, spotify: typing.Union[None, 'SpotifyWrapper']) -> int:
+    """
+    Runs the app loop in this process with no tray. Everything the tray menu does is available through the control
+    socket instead, and SIGTERM shuts down cleanly so this can run as a service.
+    """
+
+    from libs import controlsocket
+
+    # Set == running
+    app_loop_should_run = threading.Event()
+    app_loop_should_run.set()
+
+    shutdown = threading.Event()
+    control_queue = queue.Queue()
+
+    account_names = None
+    if args.accounts is not None:
+        from libs import accounts
+        account_names = [account.name for account in accounts.AccountRegistry(args.accounts).accounts()]
+
+    supervisor = None
+    if args.workers is not None:
+        from libs import supervisor as supervisor_module
+        supervisor = supervisor_module.Supervisor(args.accounts, args.workers)
+
+        # Pausing has to reach every worker, and accounts come and go while it runs
+        app_loop_should_run = supervisor.app_loop_should_run
+        account_names = supervisor.account_names
+
+        if args.metrics_port is not None:
+            supervisor_module.serve_status(supervisor, args.metrics_port)
+            logger.info('Serving health at http://127.0.0.1:%d/health and metrics at /metrics', args.metrics_port)
+
+    socket_path = args.control_socket or controlsocket.DEFAULT_SOCKET_PATH
+    try:
+        handlers = headless_control_handlers(app_loop_should_run, shutdown, control_queue, account_names)
+        if supervisor is not None:
+            handlers.update(supervisor_control_handlers(supervisor, control_queue))
+
+        server = controlsocket.serve(socket_path, handlers)
+    except OSError as ex:
+        logger.error('Could not open the control socket: %s', ex)
+        return 4
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signal_number, frame: sys.exit(0))
+    logger.info('Running headless, control with: python -m libs.controlsocket --socket %s <command>', socket_path)
+
+    try:
+        if supervisor is not None:
+            return supervisor.run(shutdown, control_queue)
+        return run_engine(args, app_loop_should_run, shutdown, spotify, control_queue)
+    finally:
+        server.close()
 
 # ====
 if __name__ == '__main__':
     multiprocessing.freeze_support()  # Required for cx_freeze
 
     try:
-        toggle_console_visibility(forced_visibility_state=False)
-        exit_code = main()
+        arguments = parse_arguments()
+        if not arguments.headless:
+            toggle_console_visibility(forced_visibility_state=False)
+
+        exit_code = main(arguments)
         print('\nThanks for using Heartbroken!\n')
 
     except KeyboardInterrupt:
@@ -0,0 +1,303 @@
+"""
+Multi-account mode: one process serving many Spotify accounts (heartbroken.py --accounts DIR).
+
+Every account is a directory under DIR with its own credentials and dislikes:
+    accounts/alice/heartbroken_auth.json
+    accounts/alice/heartbroken.db
+
+Each account gets an AsyncEngine (libs.asyncengine), all on one event loop. They share one pool of connections to the
+API, one executor for database checks, and a smaller one for token refreshes, which can be kept waiting by the
+Heartbroken servers without holding up anyone's database checks. Their polls are spread evenly over the poll interval,
+and the pool hands out connections first come, first served, so a busy account can't starve the others.
+
+Accounts are managed with:
+    python -m libs.accounts add alice      (connects the Spotify account through the browser)
+    python -m libs.accounts list
+    python -m libs.accounts remove alice
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import logging
+import os
+import re
+import shutil
+import sys
+import typing
+
+from libs import constants
+from libs.asyncengine import AsyncEngine, forward_control_messages
+from libs.asynchttp import AsyncHTTPClient
+from libs.database import HeartbrokenDatabase
+from libs.metadata import MetadataCache
+from libs.spotifywrapper import SpotifyWrapper
+from libs.tokenhandler import OAuthManager, TokenHandler
+
+
+DEFAULT_ACCOUNTS_DIRECTORY = 'accounts'
+
+SHARED_CONNECTIONS    = 16  # Connections to the API shared by all accounts
+EXECUTOR_THREADS      = 8   # Threads shared by all accounts for database checks
+TOKEN_REFRESH_THREADS = 2   # Threads shared by all accounts for token refreshes
+
+logger = logging.getLogger(__name__)
+
+account_name_regex = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+# ========
+class Account:
+    def __init__(self, name: str, directory: str):
+        self.name      = name
+        self.directory = directory
+
+        self.credentials_file_name = os.path.join(directory, TokenHandler.credentials_file_name)
+        self.database_file_name    = os.path.join(directory, HeartbrokenDatabase.file_name)
+
+    # ====
+    def __repr__(self) -> str:
+        return f'Account({self.name!r})'
+
+    # ====
+    @property
+    def is_connected(self) -> bool:
+        return os.path.isfile(self.credentials_file_name)
+
+# ========
+class AccountRegistry:
+    """
+    The accounts under :directory, one subdirectory each
+    """
+
+    def __init__(self, directory: str = DEFAULT_ACCOUNTS_DIRECTORY):
+        self.directory = directory
+
+    # ====
+    def accounts(self) -> typing.List[Account]:
+        """
+        Every account with a valid name, connected or not, sorted by name
+        """
+
+        if not os.path.isdir(self.directory):
+            return []
+
+        return [Account(name, os.path.join(self.directory, name)) for name in sorted(os.listdir(self.directory))
+                if account_name_regex.match(name) and os.path.isdir(os.path.join(self.directory, name))]
+
+    # ====
+    def get(self, name: str) -> typing.Union[None, Account]:
+        for account in self.accounts():
+            if account.name == name:
+                return account
+        return None
+
+    # ====
+    def add(self, name: str) -> Account:
+        """
+        Creates the account's directory and dislikes database. Raises ValueError for a name that can't be used.
+        """
+
+        if not account_name_regex.match(name):
+            raise ValueError('Account names can only contain letters, digits, - and _, up to 64 of them')
+
+        account = Account(name, os.path.join(self.directory, name))
+        os.makedirs(account.directory, exist_ok=True)
+
+        if not HeartbrokenDatabase.maybe_create_table(account.database_file_name):
+            raise ValueError(f'Could not create the database for {name}')
+
+        return account
+
+    # ====
+    def remove(self, name: str) -> bool:
+        """
+        Deletes the account's credentials and dislikes. Returns False if there is no such account.
+        """
+
+        account = self.get(name)
+        if account is None:
+            return False
+
+        shutil.rmtree(account.directory)
+        return True
+
+# ========
+async def serve_accounts(accounts_directory: str, accounts: typing.Sequence[Account], app_loop_should_run, terminated,
+                         control_queue=None,
+                         other_commands: typing.Callable[[str, typing.Any], None] = lambda command, payload: None,
+                         make_spotify: typing.Callable[[Account], SpotifyWrapper] = None,
+                         api_url: str = SpotifyWrapper.api_url) -> int:
+    """
+    Runs an engine per account of :accounts (which are under :accounts_directory) until :terminated is set, or until
+    no accounts are left. An account whose token can't be refreshed stops on its own while the rest carry on.
+
+    Dislikes on :control_queue name their account, 'alice:track'; WAKE goes to every engine, SET_ACCOUNTS swaps the
+    accounts served for the ones named (see libs.supervisor), and everything else goes to :other_commands.
+    :make_spotify swaps out the wrapper that provides each account's token and :api_url where requests go
+    (see devtools.mockapi).
+
+    Returns 0, or 2 if every account stopped because its token couldn't be refreshed
+    """
+
+    if make_spotify is None:
+        make_spotify = lambda account: SpotifyWrapper(credentials_file_name=account.credentials_file_name)
+
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(EXECUTOR_THREADS, thread_name_prefix='accounts'))
+    token_executor = concurrent.futures.ThreadPoolExecutor(TOKEN_REFRESH_THREADS, thread_name_prefix='token refresh')
+
+    http = AsyncHTTPClient(api_url, max_connections=SHARED_CONNECTIONS)
+
+    # Genres and audio features are the same for everyone, so the accounts share them
+    metadata = MetadataCache(os.path.join(accounts_directory, MetadataCache.file_name))
+
+    engines = {}
+    tasks = set()
+    exit_codes = []
+
+    async def run_engine(name, engine):
+        exit_code = await engine.run()
+        if exit_code != 0:
+            logger.warning('[%s] Stopped, the account needs to be connected again: python -m libs.accounts add %s',
+                           name, name)
+
+        if engines.get(name, None) is engine:
+            del engines[name]
+        exit_codes.append(exit_code)
+
+    def start(account, poll_offset):
+        engine = AsyncEngine(app_loop_should_run, terminated, make_spotify(account), name=account.name,
+                             database_file_name=account.database_file_name, http=http, poll_offset=poll_offset,
+                             metadata=metadata, token_executor=token_executor)
+        engines[account.name] = engine
+
+        task = loop.create_task(run_engine(account.name, engine))
+        tasks.add(task)
+
+    def set_accounts(names):
+        for name in set(engines) - set(names):
+            engines.pop(name).stop()
+
+        added = [account for account in AccountRegistry(accounts_directory).accounts()
+                 if account.name in names and account.name not in engines and account.is_connected]
+        for index, account in enumerate(added):
+            start(account, interval * index / len(added))
+
+        logger.info('Now serving %d account(s)', len(engines))
+
+    def route(command, payload):
+        if command in (constants.Command.DISLIKE, constants.Command.UNDISLIKE):
+            name, _, item_type = payload.partition(':')
+            if name in engines:
+                engines[name].deliver(command, item_type)
+            else:
+                logger.warning('No account named "%s"', name)
+
+        elif command == constants.Command.WAKE:
+            for engine in engines.values():
+                engine.deliver(command, payload)
+
+        elif command == constants.Command.SET_ACCOUNTS:
+            set_accounts(payload)
+
+        else:
+            other_commands(command, payload)
+
+    # Spread the first polls over one interval, so the accounts don't all poll at once forever after
+    interval = constants.SpotifyAPI.REQUEST_INTERVAL_SECONDS
+    for index, account in enumerate(accounts):
+        start(account, interval * index / len(accounts))
+
+    if control_queue is not None:
+        forward_control_messages(control_queue, loop, route)
+
+    logger.info('Serving %d account(s): %s', len(engines), ', '.join(engines))
+
+    try:
+        # Accounts can be added while this waits, so it goes until none are left running
+        while tasks:
+            done, _ = await asyncio.wait(set(tasks), return_when=asyncio.FIRST_COMPLETED)
+            tasks.difference_update(done)
+
+            for task in done:
+                task.result()  # Re-raises anything an engine died of
+    finally:
+        for task in tasks:
+            task.cancel()
+        await http.close()
+
+        # A refresh still waiting on the Heartbroken servers has nothing left to refresh for
+        token_executor.shutdown(wait=False)
+
+    return 2 if exit_codes and all(exit_code == 2 for exit_code in exit_codes) else 0
+
+# ====
+def run(accounts_directory: str, accounts: typing.Sequence[Account], app_loop_should_run, terminated,
+        control_queue=None, other_commands: typing.Callable[[str, typing.Any], None] = lambda command, payload: None,
+        make_spotify: typing.Callable[[Account], SpotifyWrapper] = None, api_url: str = SpotifyWrapper.api_url) -> int:
+    """
+    serve_accounts() on a new event loop
+    """
+
+    return asyncio.run(serve_accounts(accounts_directory, accounts, app_loop_should_run, terminated, control_queue,
+                                      other_commands, make_spotify, api_url))
+
+# ========
+def connect(account: Account) -> bool:
+    """
+    Runs the Spotify OAuth flow for :account. Returns False if it failed.
+    """
+
+    oauth_handler_generator = OAuthManager.do_spotify_oauth(account.credentials_file_name)
+    server_process = next(oauth_handler_generator)
+
+    try:
+        return next(oauth_handler_generator) is not None
+    finally:
+        if server_process.is_alive():
+            server_process.terminate()
+
+# ========
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Manage the accounts served by heartbroken.py --accounts')
+    parser.add_argument('command', choices=('add', 'list', 'remove'))
+    parser.add_argument('name', nargs='?', default=None, help='Account name, for add and remove')
+    parser.add_argument('--directory', default=DEFAULT_ACCOUNTS_DIRECTORY,
+                        help=f'Where the accounts are kept (default ./{DEFAULT_ACCOUNTS_DIRECTORY})')
+    args = parser.parse_args()
+
+    registry = AccountRegistry(args.directory)
+
+    if args.command == 'list':
+        for account in registry.accounts():
+            print(account.name if account.is_connected else f'{account.name} (not connected)')
+        return 0
+
+    if args.name is None:
+        parser.error(f'{args.command} needs an account name')
+
+    if args.command == 'remove':
+        if not registry.remove(args.name):
+            print(f'No account named "{args.name}"')
+            return 1
+        print(f'Removed {args.name} and its dislikes')
+        return 0
+
+    try:
+        account = registry.add(args.name)
+    except ValueError as ex:
+        print(ex)
+        return 1
+
+    print(f'Connecting a Spotify account for {account.name}, continue in your browser...')
+    if not connect(account):
+        print('\nSomething went wrong while trying to connect the account. Please try again.\n')
+        return 1
+
+    print(f'Connected {account.name}')
+    return 0
+
+# ====
+if __name__ == '__main__':
+    sys.exit(main())
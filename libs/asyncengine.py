@@ -0,0 +1,726 @@
+"""
+asyncio variant of the app loop (heartbroken.py --engine asyncio).
+
+Polling, queue lookahead, token refresh and control messages run as separate tasks on one event loop and share one
+AsyncHTTPClient, so a slow token refresh or queue fetch never holds up the next poll or a skip. Database checks and
+token refreshes run in the default executor, since sqlite3 and requests block.
+
+The lookahead task checks the next few queued tracks against the database ahead of time; when the next one is known
+to be disliked, the poll is scheduled for the moment the current track ends instead of up to a full interval later.
+It also fetches the genres and audio features of those tracks when there are rules that use them (see libs.metadata).
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+import typing
+
+from libs import constants, hbcontrol, idle, leakage, metrics, profiling
+from libs.asynchttp import AsyncHTTPClient, AsyncHTTPResponse
+from libs.database import HeartbrokenDatabase
+from libs.metadata import MetadataCache
+from libs.rules import RuleSet
+from libs.spotifywrapper import SpotifyWrapper, Track
+
+
+HOUSEKEEPING_SECONDS   = 1    # How often pausing, shutdown and finished profiles are checked for
+TOKEN_CHECK_SECONDS    = 30   # How often the token's expiry is checked; refreshes start well before it
+MAX_CACHED_VERDICTS    = 256  # Lookahead verdicts kept before the cache is dropped and rebuilt
+MIN_POLL_DELAY_SECONDS = 0.1  # Floor for polls timed to the end of a track, in case Spotify is slow to move on
+
+logger = logging.getLogger(__name__)
+
+
+# ========
+class AsyncEngine:
+    """
+    :spotify provides the API's URL and the access token (initialize_spotify_client()); it is never used for requests.
+    :other_commands(command, payload) carries out the control messages that don't touch the player, such as
+    printing stats or saving a trace.
+
+    For running many accounts on one loop (see libs.accounts), :name prefixes everything the engine logs,
+    :database_file_name is the account's dislikes (and its name rules sit next to it), :http is a client shared between the engines, :poll_offset delays
+    the first poll so the accounts' polls are spread out, :metadata is a genre and audio feature cache shared between
+    the engines, :token_executor runs token refreshes apart from the database checks in the default executor, and
+    messages are handed over with deliver() rather than through :control_queue.
+    """
+
+    def __init__(self, app_loop_should_run, terminated, spotify: SpotifyWrapper, control_queue=None,
+                 other_commands: typing.Callable[[str, typing.Any], None] = lambda command, payload: None,
+                 name: typing.Union[None, str] = None, database_file_name: typing.Union[None, str] = None,
+                 http: typing.Union[None, AsyncHTTPClient] = None, poll_offset: float = 0,
+                 metadata: typing.Union[None, MetadataCache] = None,
+                 token_executor: typing.Union[None, concurrent.futures.Executor] = None):
+        self.app_loop_should_run = app_loop_should_run
+        self.terminated          = terminated
+        self.spotify             = spotify
+        self.control_queue       = control_queue
+        self.other_commands      = other_commands
+
+        self.name               = name
+        self.database_file_name = database_file_name
+        self.poll_offset        = poll_offset
+        self.token_executor     = token_executor
+
+        self.rules = hbcontrol.default_rules if database_file_name is None else \
+                     RuleSet(os.path.join(os.path.dirname(database_file_name), RuleSet.file_name))
+        self.metadata = metadata or hbcontrol.default_metadata
+
+        self.current_track  = None
+        self.previous_track = None
+        self.player_state   = None  # What the last poll saw, see SpotifyWrapper.player_state
+        self.idle_watch     = idle.IdleWatch(name=name)
+
+        self.next_track_id  = None  # First track in Spotify's queue, by the last lookahead
+        self.verdicts       = {}    # Track id -> (True, what_disliked) for disliked tracks, filled in by the lookahead
+        self.verdicts_rules = None  # The compiled rules the verdicts were made with
+        self.lookahead_enabled = True
+
+        self._http         = http
+        self._owns_http    = http is None
+        self._auth_headers = {}  # This account's Authorization header, sent with each of its requests
+
+        # Created in run(), on the event loop
+        self._loop          = None
+        self._inbox         = None
+        self._exit_code     = None
+        self._running       = None  # Mirrors app_loop_should_run
+        self._poll_now      = None
+        self._track_changed = None
+        self._refresh_now   = None
+        self._player_lock   = None  # Held while a poll or dislike is acting on the player, so they don't both skip
+
+    # ========
+    async def run(self) -> int:
+        """
+        Returns exit code 0 when the tray quits, or 2 if the access token can't be refreshed
+        """
+
+        self._loop          = asyncio.get_running_loop()
+        self._inbox         = self._inbox or asyncio.Queue()
+        self._exit_code     = self._exit_code or self._loop.create_future()
+        self._running       = asyncio.Event()
+        self._poll_now      = asyncio.Event()
+        self._track_changed = asyncio.Event()
+        self._refresh_now   = asyncio.Event()
+        self._player_lock   = asyncio.Lock()
+
+        if self.app_loop_should_run.is_set():
+            self._running.set()
+
+        if self._owns_http:
+            self._http = AsyncHTTPClient(self.spotify.api_url)
+
+        if not await self._refresh_token(force=False):
+            if self._owns_http:
+                await self._http.close()
+
+            # Unless it gave up because it was told to stop
+            if self._exit_code.done():
+                return self._exit_code.result()
+            return 0 if self.terminated.is_set() else 2
+
+        # Stopped while the token was being refreshed
+        if self._exit_code.done():
+            return self._exit_code.result()
+
+        tasks = [self._loop.create_task(coroutine) for coroutine in
+                 (self._poll_task(), self._lookahead_task(), self._token_task(), self._control_task(),
+                  self._housekeeping_task())]
+
+        for task in tasks:
+            task.add_done_callback(self._on_task_done)
+
+        try:
+            return await self._exit_code
+        finally:
+            # Before Python 3.12, asyncio.wait_for() can swallow a cancellation that lands just as what it waits for
+            # finishes, so cancel until every task has really stopped
+            pending = set(tasks)
+            while pending:
+                for task in pending:
+                    task.cancel()
+                _, pending = await asyncio.wait(pending, timeout=HOUSEKEEPING_SECONDS)
+
+            if self._owns_http:
+                await self._http.close()
+
+    # ====
+    def deliver(self, command: str, payload: typing.Any) -> None:
+        """
+        Hands the engine a control message (see constants.Command). Must be called on the event loop's thread.
+        """
+
+        if self._inbox is None:
+            self._inbox = asyncio.Queue()
+        self._inbox.put_nowait((command, payload))
+
+    # ====
+    def stop(self) -> None:
+        """
+        Makes run() return 0, for an account that is no longer served. Must be called on the event loop's thread.
+        """
+
+        if self._exit_code is None:
+            self._exit_code = asyncio.get_running_loop().create_future()
+        self._exit(0)
+
+    # ====
+    def _log(self, message: str, level: int = logging.INFO) -> None:
+        if self.name is not None:
+            message = f'[{self.name}] {message}'
+        logger.log(level, message)
+
+    # ====
+    def _exit(self, exit_code: int) -> None:
+        if not self._exit_code.done():
+            self._exit_code.set_result(exit_code)
+
+    def _on_task_done(self, task: asyncio.Task) -> None:
+        # A task that dies takes the engine down with it, the way an exception in the threaded loop would
+        if not task.cancelled() and task.exception() is not None and not self._exit_code.done():
+            self._exit_code.set_exception(task.exception())
+
+    # ====
+    async def _wait_for(self, event: asyncio.Event, timeout: float) -> bool:
+        """
+        Waits until :event is set or :timeout seconds pass; clears it and returns True if it was set
+        """
+
+        try:
+            await asyncio.wait_for(event.wait(), max(0.0, timeout))
+        except asyncio.TimeoutError:
+            return False
+
+        event.clear()
+        return True
+
+    # ========
+    async def _poll_task(self) -> None:
+        last_logged_track = None
+        waiting_logged = False
+        await asyncio.sleep(self.poll_offset)
+
+        while True:
+            await self._running.wait()
+
+            # No device is active, so the device list tells sooner than the track when that changes
+            if self.idle_watch.checks_devices and not await self._check_devices():
+                await self._wait_for(self._poll_now, self.idle_watch.next_delay())
+                continue
+
+            started = metrics.timer()
+            async with self._player_lock:
+                verdict = await self._skip_if_heartbroken()
+            metrics.observe_phase('poll', started)
+
+            self.idle_watch.observe(self.player_state)
+
+            # Keep things nice rate-limiting-wise
+            delay = constants.SpotifyAPI.REQUEST_INTERVAL_SECONDS
+
+            # Nothing is playing or a network error was encountered
+            if verdict is None:
+                if not waiting_logged:
+                    self._log('Nothing is currently playing, waiting (ctrl+c to exit)...')
+                    last_logged_track = None
+                    waiting_logged = True
+
+                delay = self.idle_watch.next_delay()
+
+            else:
+                if last_logged_track is None or self.current_track.id != last_logged_track.id:
+                    self._log(f'Currently playing: {self.current_track}')
+                    last_logged_track = self.current_track
+                    waiting_logged = False
+
+                # Be there the moment a disliked track comes up next, rather than up to a whole interval into it
+                if self._is_disliked(self.next_track_id) and self.current_track.time_remaining_ms >= 0:
+                    delay = min(delay, max(MIN_POLL_DELAY_SECONDS, self.current_track.time_remaining_ms / 1000))
+
+            started = metrics.timer()
+            await self._wait_for(self._poll_now, delay)
+            metrics.observe_phase('wait', started)
+
+    # ====
+    async def _check_devices(self) -> bool:
+        """
+        Polls the device list for the idle watch; True if the track should be polled straight away
+        """
+
+        response = await self._request('GET', '/me/player/devices')
+        if response is None:
+            return self.idle_watch.observe_devices(0, None)
+
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+
+        return self.idle_watch.observe_devices(response.status_code, body)
+
+    # ====
+    async def _skip_if_heartbroken(self) -> typing.Union[None, bool]:
+        """
+        hbcontrol.skip_if_heartbroken() for this engine. Skips until something that isn't disliked is playing.
+        """
+
+        current_track = await self._update_current_track()
+
+        if current_track is None or current_track == -1:
+            return None
+
+        if self.previous_track is not None and current_track.id == self.previous_track.id:
+            return False
+
+        tracks_skipped = set()
+        while True:
+            current_track = self.current_track
+            detected_at   = time.monotonic()
+
+            is_heartbroken, what_heartbroken = await self._check_track(current_track)
+
+            current_track.track_heartbroken  = what_heartbroken == 'track'
+            current_track.album_heartbroken  = what_heartbroken == 'album'
+            current_track.artist_heartbroken = what_heartbroken == 'artist'
+
+            if not is_heartbroken:
+                return is_heartbroken
+
+            self._log(hbcontrol.skip_message(current_track, what_heartbroken))
+            tracks_skipped.add(current_track.id)
+
+            started = metrics.timer()
+            next_track, skip_confirmed_at = await self._skip_current_track()
+            metrics.observe_phase('skip_current_track', started)
+
+            # Only skips Spotify accepted are counted
+            if skip_confirmed_at is not None:
+                metrics.count('heartbroken_skips_total', reason=what_heartbroken)
+                leakage.record(what_heartbroken, current_track.progress_ms,
+                               int((skip_confirmed_at - detected_at) * 1000))
+
+            if next_track == -1:
+                self._log(f'Something went wrong while skipping disliked {what_heartbroken} ({current_track.url})',
+                          logging.ERROR)
+                return None
+
+            elif next_track is None:
+                return None
+
+            # Prevent infinite loops
+            if self.current_track.id in tracks_skipped:
+                self._log('Current track has been skipped previously in the current queue; '
+                          'stopping playback to prevent an infinite loop', logging.WARNING)
+                await self._stop_playback()
+                return None
+
+    # ====
+    async def _check_track(self, track: Track) -> typing.Tuple[typing.Union[None, bool], typing.Union[None, str]]:
+        verdict = self.verdicts.get(track.id, None)
+        if verdict is not None:
+            if verdict[1] != 'rule':
+                return verdict
+
+            # The lookahead matched the rule on its own copy of the track. Matching again also picks up rule edits
+            # made since, which may have dropped it.
+            track.matched_rule = self.rules.match(track, self.metadata)
+            if track.matched_rule is not None:
+                return verdict
+
+        started = metrics.timer()
+        verdict = await self._loop.run_in_executor(None, HeartbrokenDatabase.is_heartbroken, track,
+                                                   self.database_file_name)
+        metrics.observe_phase('is_heartbroken', started)
+
+        # The lookahead fetches metadata ahead of time, this is for a track that it missed
+        if not verdict[0]:
+            await self._fetch_metadata([track])
+
+        return hbcontrol.apply_rules(track, verdict, self.rules, self.metadata)
+
+    def _is_disliked(self, track_id: typing.Union[None, str]) -> bool:
+        return track_id is not None and self.verdicts.get(track_id, (None, None))[0] == True
+
+    # ========
+    async def _request(self, method: str, path: str) -> typing.Union[None, AsyncHTTPResponse]:
+        """
+        Returns None if no response came back. A 401 has the token task refresh the token straight away.
+        """
+
+        try:
+            response = await self._http.request(method, path, self._auth_headers)
+        except OSError as ex:
+            self._log(f'Network error while calling {path}: {ex}', logging.WARNING)
+            return None
+
+        metrics.api_call(path.partition('?')[0], response.status_code)
+
+        if response.status_code == 401:
+            self._refresh_now.set()
+
+        return response
+
+    # ====
+    async def _update_current_track(self) -> typing.Union[Track, None, int]:
+        """
+        SpotifyWrapper.update_current_track() for this engine: None if nothing is playing and -1 on failure
+        """
+
+        started  = metrics.timer()
+        response = await self._request('GET', '/me/player/currently-playing')
+        metrics.observe_phase('currently_playing_http', started)
+
+        if response is None:
+            self.player_state = None
+            return -1
+
+        # No device is active
+        if response.status_code == 204:
+            self.current_track = None
+            self.player_state  = idle.INACTIVE
+            return None
+
+        if response.status_code >= 300 or response.status_code < 200:
+            self._log(f'Something went wrong while requesting the current song:\n'
+                      f'HTTP {response.status_code} : {response.text}', logging.ERROR)
+            self.player_state = None
+            return -1
+
+        try:
+            started = metrics.timer()
+            track = Track(response.json())
+            metrics.observe_phase('json_decode', started)
+
+        except ValueError:
+            self._log(f'Something unexpected happened while requesting the current song:\n'
+                      f'HTTP {response.status_code} : {response.text}', logging.ERROR)
+            self.player_state = None
+            return -1
+
+        # A podcast or nothing is being listened to
+        if track.type == 'show' or not track.is_playing:
+            self.current_track = None
+            self.player_state  = idle.PAUSED
+            return None
+
+        self.player_state = idle.PLAYING
+
+        # Do not wipe out previous track if song is on repeat
+        if self.current_track is not None and self.current_track.id != track.id:
+            self.previous_track = self.current_track
+
+        if self.current_track is None or self.current_track.id != track.id:
+            self._track_changed.set()
+
+        self.current_track = track
+
+        return track
+
+    # ====
+    async def _skip_current_track(self) -> typing.Tuple[typing.Union[Track, None, int], typing.Union[None, float]]:
+        """
+        Returns what is playing after the skip (see _update_current_track()) and when Spotify accepted the skip, by
+        time.monotonic(), or None if it didn't
+        """
+
+        response = await self._request('POST', '/me/player/next')
+        if response is None:
+            return -1, None
+
+        skip_confirmed_at = time.monotonic() if 200 <= response.status_code < 300 else None
+
+        if response.status_code == 403:
+            try:
+                error_message = response.json().get('error', {}).get('message', None)
+            except ValueError:
+                error_message = None
+
+            # User interacted with Spotify (skip, pause) while we were processing,
+            # so wait for things to settle and then return the current track
+            if error_message == 'Player command failed: Restriction violated':
+                await asyncio.sleep(constants.SpotifyAPI.REQUEST_DELAY_COMPENSATION_MS / 1000)
+                return await self._update_current_track(), None
+
+        if response.status_code >= 300 or response.status_code < 200:
+            self._log(f'Something went wrong while trying to skip the current song:\n'
+                      f'HTTP {response.status_code} : "{response.text or "<no message>"}"', logging.ERROR)
+            return -1, None
+
+        await asyncio.sleep(constants.SpotifyAPI.REQUEST_DELAY_COMPENSATION_MS / 1000)
+
+        return await self._update_current_track(), skip_confirmed_at
+
+    # ====
+    async def _stop_playback(self) -> None:
+        response = await self._request('PUT', '/me/player/pause')
+
+        if response is None or response.status_code >= 300 or response.status_code < 200:
+            message = 'Something went wrong while trying to stop playback:'
+            if response is not None:
+                message += f'\nHTTP {response.status_code} : "{response.text or "<no message>"}"'
+            self._log(message, logging.ERROR)
+            return
+
+        self.previous_track = self.current_track
+        self.current_track  = None
+
+    # ========
+    async def _lookahead_task(self) -> None:
+        """
+        Checks the next few queued tracks against the database whenever the track changes
+        """
+
+        while self.lookahead_enabled:
+            await self._track_changed.wait()
+            self._track_changed.clear()
+
+            response = await self._request('GET', '/me/player/queue')
+            if response is None:
+                continue
+
+            # Tokens from before the queue needed user-read-playback-state can't read it; reconnecting fixes that
+            if response.status_code == 403:
+                self._log('Queue lookahead is off: the account needs to be connected again to allow reading the queue',
+                          logging.WARNING)
+                self.lookahead_enabled = False
+                return
+
+            if response.status_code != 200:
+                continue
+
+            try:
+                upcoming = response.json().get('queue', None) or []
+            except ValueError:
+                continue
+
+            queued = [Track({'item': item, 'is_playing': True}) for item in upcoming if item is not None]
+
+            # For the whole queue while at it, it costs no more requests. Before the verdicts, which are kept, so
+            # rules on genres and audio features get to see it.
+            await self._fetch_metadata([self.current_track] + queued)
+
+            upcoming = queued[:constants.SpotifyAPI.LOOKAHEAD_TRACKS]
+            self.next_track_id = upcoming[0].id if upcoming else None
+
+            # Verdicts the rules made before they were edited may no longer hold
+            self.rules.reload_if_changed()
+            if len(self.verdicts) > MAX_CACHED_VERDICTS or self.verdicts_rules is not self.rules.compiled:
+                self.verdicts.clear()
+                self.verdicts_rules = self.rules.compiled
+
+            for track in upcoming:
+                if track.id is None or track.id in self.verdicts:
+                    continue
+
+                verdict = await self._loop.run_in_executor(None, HeartbrokenDatabase.is_heartbroken, track,
+                                                   self.database_file_name)
+                verdict = hbcontrol.apply_rules(track, verdict, self.rules, self.metadata)
+
+                # Only dislikes are kept: a track that's fine is checked again when it plays, so a dislike made
+                # elsewhere in the meantime still gets it skipped
+                if verdict[0] == True:
+                    self.verdicts[track.id] = verdict
+
+    # ====
+    async def _fetch_metadata(self, tracks: typing.Sequence[Track]) -> None:
+        """
+        Fetches what the rules need to check :tracks and the cache doesn't have, in batches; see
+        hbcontrol.fetch_metadata()
+        """
+
+        for path in hbcontrol.metadata_requests(tracks, self.rules, self.metadata):
+            started = metrics.timer()
+            response = await self._request('GET', path)
+            metrics.observe_phase('metadata_http', started)
+
+            if response is None:
+                return
+
+            try:
+                body = response.json()
+            except ValueError:
+                body = None
+
+            await self._loop.run_in_executor(None, self.metadata.store_response, path, response.status_code, body)
+
+    # ========
+    async def _token_task(self) -> None:
+        while True:
+            refresh_now = await self._wait_for(self._refresh_now, TOKEN_CHECK_SECONDS)
+
+            if not await self._refresh_token(force=refresh_now):
+                if self.terminated.is_set():
+                    self._exit(0)
+                    return
+
+                self._log('Something went wrong while trying to connect your account. Please run Heartbroken again.',
+                          logging.ERROR)
+                self._exit(2)
+                return
+
+    # ====
+    async def _refresh_token(self, force: bool) -> bool:
+        """
+        Refreshes the access token in the executor if it expires soon (or regardless, with :force), and sends the
+        current one with every request. Returns False if it couldn't be refreshed, or the tray quit while trying.
+        """
+
+        margin = float('inf') if force else constants.SpotifyAPI.TOKEN_REFRESH_MARGIN_SECONDS
+
+        for attempt in range(1, constants.SpotifyAPI.TOKEN_REFRESH_ATTEMPTS + 1):
+            started = metrics.timer()
+            client = await self._loop.run_in_executor(self.token_executor, self.spotify.initialize_spotify_client,
+                                                      margin)
+            metrics.observe_phase('token_check', started)
+
+            if client != -1 or self.terminated.is_set() or self._exit_code.done():
+                break
+
+            if attempt == constants.SpotifyAPI.TOKEN_REFRESH_ATTEMPTS:
+                self._log(f'FATAL: Could not get a Spotify access token from the Heartbroken servers after {attempt} '
+                          f'attempts', logging.CRITICAL)
+                break
+
+            # Only this task waits; polls and control messages carry on with the token from before
+            await asyncio.sleep(constants.SpotifyAPI.TOKEN_RETRY_SECONDS)
+
+        if client is None or client == -1:
+            return False
+
+        access_token = getattr(client, 'access_token', None)
+        if access_token is not None:
+            self._auth_headers['Authorization'] = f'Bearer {access_token}'
+
+        return True
+
+    # ========
+    async def _control_task(self) -> None:
+        if self.control_queue is not None:
+            forward_control_messages(self.control_queue, self._loop, self.deliver)
+
+        while True:
+            messages = [await self._inbox.get()]
+            while not self._inbox.empty():
+                messages.append(self._inbox.get_nowait())
+
+            # The same dislike twice in one batch (a double click, a repeated socket command) is only carried out once
+            handled = set()
+
+            for command, payload in messages:
+                key = (command, repr(payload))
+                if command in (constants.Command.DISLIKE, constants.Command.UNDISLIKE):
+                    if key in handled:
+                        continue
+                    handled.add(key)
+
+                # Someone is at the tray or the control socket, so playing may start any moment
+                if command in idle.NUDGING_COMMANDS and self.idle_watch.nudge():
+                    self._poll_now.set()
+
+                if command == constants.Command.WAKE:
+                    self._sync_running()
+
+                elif command in (constants.Command.DISLIKE, constants.Command.UNDISLIKE):
+                    async with self._player_lock:
+                        await self._handle_heartbreak(payload, clear=command == constants.Command.UNDISLIKE)
+
+                else:
+                    self.other_commands(command, payload)
+
+    # ====
+    async def _handle_heartbreak(self, item_type: str, clear: bool) -> None:
+        """
+        hbcontrol.handle_heartbreak() and handle_clear_heartbreak() for this engine
+        """
+
+        current_track = self.current_track
+        if current_track is None or not self._running.is_set():
+            current_track = await self._update_current_track()
+
+        verb = 'un-dislike' if clear else 'dislike'
+        if current_track is None or current_track == -1:
+            self._log(f'Cannot {verb} {item_type}, nothing is playing!', logging.WARNING)
+            return
+
+        store = hbcontrol.clear_heartbreak if clear else hbcontrol.save_heartbreak
+        succeeded = await self._loop.run_in_executor(
+            None, lambda: store(current_track, **{item_type: True}, database_file_name=self.database_file_name))
+
+        # Whatever the lookahead knew may have just changed
+        self.verdicts.clear()
+        self._track_changed.set()
+
+        if not succeeded:
+            self._log(f'Sorry, something went wrong while {verb[:-1]}ing the {item_type} ({current_track.url})',
+                      logging.ERROR)
+            return
+
+        if clear:
+            self._log(f'Sucessfully un-disliked {item_type}')
+            return
+
+        self._log(f'Sucessfully disliked {item_type}, skipping... ({current_track.url})')
+
+        next_track, _ = await self._skip_current_track()
+        if next_track == -1:
+            self._log(f'Sorry, something went wrong while skipping the current {item_type} ({current_track.url})',
+                      logging.ERROR)
+
+        # The next track may be disliked too
+        self._poll_now.set()
+
+    # ====
+    def _sync_running(self) -> None:
+        if self.app_loop_should_run.is_set():
+            if not self._running.is_set():
+                # Don't sit out the rest of a wait that was scheduled before the pause
+                self._running.set()
+                self._poll_now.set()
+        else:
+            self._running.clear()
+
+    # ========
+    async def _housekeeping_task(self) -> None:
+        while True:
+            if self.terminated.is_set():
+                self._exit(0)
+                return
+
+            # In case a WAKE was lost, e.g. the tray was killed between setting the Event and sending it
+            self._sync_running()
+
+            profile_path = profiling.finish_profile_if_due()
+            if profile_path is not None:
+                self._log(f'Saved profile to {os.path.abspath(profile_path)}')
+
+            await asyncio.sleep(HOUSEKEEPING_SECONDS)
+
+# ========
+def forward_control_messages(control_queue, loop: asyncio.AbstractEventLoop,
+                             deliver: typing.Callable[[str, typing.Any], None]) -> threading.Thread:
+    """
+    Starts a thread that hands each message from :control_queue to :deliver on :loop. control_queue blocks (and may be
+    fed by another process), so it can't be awaited directly.
+    """
+
+    def forward():
+        while True:
+            loop.call_soon_threadsafe(deliver, *control_queue.get())
+
+    thread = threading.Thread(target=forward, name='control queue', daemon=True)
+    thread.start()
+
+    return thread
+
+# ========
+def run(app_loop_should_run, terminated, spotify: SpotifyWrapper, control_queue=None,
+        other_commands: typing.Callable[[str, typing.Any], None] = lambda command, payload: None) -> int:
+    """
+    Runs an AsyncEngine on a new event loop until the tray quits; see AsyncEngine.run() for the exit codes
+    """
+
+    return asyncio.run(AsyncEngine(app_loop_should_run, terminated, spotify, control_queue, other_commands).run())
@@ -0,0 +1,170 @@
+"""
+Minimal HTTP/1.1 client on asyncio streams, for the asyncio engine (libs.asyncengine).
+
+It covers what the Spotify player endpoints need and nothing more: keep-alive connections to one host, JSON
+responses with a Content-Length or chunked body, and bearer tokens. The dependency-free route was taken over an
+async HTTP library to keep the frozen build small.
+"""
+
+import asyncio
+import json
+import ssl
+import typing
+import urllib.parse
+
+
+# ========
+class ProtocolError (OSError):
+    """
+    The server's response couldn't be parsed as HTTP. An OSError, so whoever handles network errors handles it too.
+    """
+
+# ========
+class AsyncHTTPResponse:
+    """
+    The parts of requests.Response that the engine uses
+    """
+
+    def __init__(self, status_code: int, headers: typing.Dict[str, str], body: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = body
+
+    # ====
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf8', errors='replace')
+
+    def json(self) -> typing.Any:
+        return json.loads(self.content)
+
+# ========
+class AsyncHTTPClient:
+    """
+    Sends requests to the host of :base_url over a small pool of keep-alive connections, so a slow request never
+    holds up another one. :base_url's path is prepended to every request path.
+
+    One client can be shared by many engines (see libs.accounts); requests beyond :max_connections wait their turn
+    in the order they were made.
+    """
+
+    def __init__(self, base_url: str, max_connections: int = 4, timeout: float = 10.0):
+        url = urllib.parse.urlsplit(base_url)
+
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == 'https' else 80)
+        self.base_path = url.path.rstrip('/')
+        self.timeout = timeout
+
+        self.headers = {}  # Sent with every request, e.g. Authorization
+
+        self._ssl = ssl.create_default_context() if url.scheme == 'https' else None
+        self._idle = []  # (reader, writer) pairs ready for reuse
+        self._slots = asyncio.Semaphore(max_connections)
+
+    # ====
+    async def request(self, method: str, path: str,
+                      headers: typing.Union[None, typing.Dict[str, str]] = None) -> AsyncHTTPResponse:
+        """
+        :headers are sent along with self.headers, e.g. a per-account Authorization header on a shared client.
+        Raises OSError (including timeouts, dropped connections and ProtocolError for malformed responses) if no
+        response could be read
+        """
+
+        async with self._slots:
+            while True:
+                reused = len(self._idle) > 0
+                reader, writer = self._idle.pop() if reused else await self._connect()
+
+                try:
+                    exchange = self._exchange(reader, writer, method, path, headers)
+                    response, keep_alive = await asyncio.wait_for(exchange, self.timeout)
+                    break
+
+                except asyncio.TimeoutError as ex:
+                    writer.close()
+                    raise OSError(f'{method} {path} timed out after {self.timeout}s') from ex
+
+                except (OSError, asyncio.IncompleteReadError) as ex:
+                    writer.close()
+
+                    # The server may have closed an idle connection since it was last used, so try the next one
+                    if not reused:
+                        raise OSError(f'{method} {path} failed: {ex!r}') from ex
+
+                # Garbled status line, headers too long for the stream's buffer, bad lengths. Retrying another
+                # connection wouldn't help, and the connection's state is unknown, so it's dropped.
+                except (ValueError, IndexError, asyncio.LimitOverrunError) as ex:
+                    writer.close()
+                    raise ProtocolError(f'{method} {path} got a malformed response: {ex!r}') from ex
+
+            if keep_alive:
+                self._idle.append((reader, writer))
+            else:
+                writer.close()
+
+            return response
+
+    # ====
+    async def close(self) -> None:
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+    # ====
+    async def _connect(self) -> typing.Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        try:
+            return await asyncio.wait_for(asyncio.open_connection(self.host, self.port, ssl=self._ssl), self.timeout)
+        except asyncio.TimeoutError as ex:
+            raise OSError(f'Connecting to {self.host}:{self.port} timed out after {self.timeout}s') from ex
+
+    # ====
+    async def _exchange(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, method: str, path: str,
+                        headers: typing.Union[None, typing.Dict[str, str]]) -> typing.Tuple[AsyncHTTPResponse, bool]:
+        lines = [f'{method} {self.base_path}{path} HTTP/1.1', f'Host: {self.host}', 'Accept: application/json',
+                 'Content-Length: 0']
+        lines += [f'{name}: {value}' for name, value in {**self.headers, **(headers or {})}.items()]
+
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+        status_line = await reader.readuntil(b'\r\n')
+        status_code = int(status_line.split(b' ', 2)[1])
+
+        headers = {}
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = headers.get('connection', '').lower() != 'close'
+
+        if status_code in (204, 304) or 100 <= status_code < 200:
+            body = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = await self._read_chunked(reader)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+
+        return AsyncHTTPResponse(status_code, headers, body), keep_alive
+
+    # ====
+    @staticmethod
+    async def _read_chunked(reader: asyncio.StreamReader) -> bytes:
+        chunks = []
+
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';', 1)[0], 16)
+            if size == 0:
+                # Skip trailers
+                while await reader.readuntil(b'\r\n') != b'\r\n':
+                    pass
+                return b''.join(chunks)
+
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
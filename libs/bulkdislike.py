@@ -0,0 +1,315 @@
+"""
+Dislikes every track of playlists, albums or artists at once, from links as Spotify shares them:
+
+    python -m libs.bulkdislike https://open.spotify.com/playlist/<id> https://open.spotify.com/album/<id> ...
+
+A playlist or album becomes its tracks, and an artist the tracks of their albums and singles. Track links work too.
+Disliking an album or artist from the tray is usually the better choice, since it also covers what they release
+later; this is for when only what is there today should go.
+
+Links are expanded through libs.scanner's Pager, several pages at a time, and every page is recorded in a checkpoint
+(heartbroken_bulk_<key>.db next to heartbroken.db) as soon as it arrives, along with the tracks on it. Running the
+same command after an interruption only fetches what is still missing. Once everything is in, the tracks are
+de-duplicated and disliked in one transaction (HeartbrokenDatabase.save_heartbreaks()), and the checkpoint is deleted.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import sys
+import typing
+
+from libs.asynchttp import AsyncHTTPClient
+from libs.database import HeartbrokenDatabase
+from libs.scanner import SCAN_CONCURRENCY, Pager, Source, link_regex
+from libs.spotifywrapper import SpotifyWrapper
+
+
+# Items on pages of albums, as opposed to tracks; see Checkpoint.save_page()
+ALBUMS = 'albums'
+TRACKS = 'tracks'
+
+
+# ========
+class Checkpoint:
+    """
+    What a bulk dislike has fetched so far, in the sqlite database :file_name: the sources to page through, the
+    pages done, and the tracks found on them. Every page is saved in a transaction of its own.
+    """
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+
+        # Pages are saved from the executor, one at a time
+        self._connection = sqlite3.connect(file_name, check_same_thread=False)
+        with self._connection:
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS sources(
+                                          path CHAR PRIMARY KEY,
+                                          name CHAR NOT NULL,
+                                          page_size INTEGER NOT NULL,
+                                          kind CHAR NOT NULL,
+                                          total INTEGER DEFAULT NULL
+                                      )''')
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS pages(
+                                          path CHAR NOT NULL,
+                                          offset INTEGER NOT NULL,
+                                          PRIMARY KEY (path, offset)
+                                      )''')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS tracks(id CHAR PRIMARY KEY)')
+
+    # ====
+    def close(self) -> None:
+        self._connection.close()
+
+    # ========
+    def add_sources(self, sources: typing.Iterable[typing.Tuple[Source, str]]) -> None:
+        """
+        Adds (source, kind) pairs, leaving alone the ones that are there already
+        """
+
+        with self._connection:
+            self._connection.executemany('INSERT OR IGNORE INTO sources VALUES (?, ?, ?, ?, ?)',
+                                         [(source.path, source.name, source.page_size, kind, source.total)
+                                          for source, kind in sources])
+
+    # ====
+    def add_tracks(self, track_ids: typing.Iterable[str]) -> None:
+        with self._connection:
+            self._connection.executemany('INSERT OR IGNORE INTO tracks VALUES (?)', ((id_,) for id_ in track_ids))
+
+    # ====
+    def unfinished_sources(self) -> typing.List[typing.Tuple[Source, str]]:
+        """
+        (source, kind) for every source with pages left to fetch; done_offsets are the pages it has already
+        """
+
+        done = {}
+        for path, offset in self._connection.execute('SELECT path, offset FROM pages'):
+            done.setdefault(path, set()).add(offset)
+
+        unfinished = []
+        for path, name, page_size, kind, total in self._connection.execute('SELECT * FROM sources'):
+            done_offsets = done.get(path, set())
+            if total is None or len(done_offsets) < -(-total // page_size):
+                unfinished.append((Source(name, path, page_size, total, done_offsets), kind))
+
+        return unfinished
+
+    # ====
+    def save_page(self, source: Source, offset: int, track_ids: typing.Iterable[str] = (),
+                  sources: typing.Iterable[typing.Tuple[Source, str]] = ()) -> None:
+        """
+        Records the page at :offset of :source as done, with the tracks or further sources found on it
+        """
+
+        with self._connection:
+            self._connection.execute('UPDATE sources SET total = ? WHERE path = ?', (source.total, source.path))
+            self._connection.execute('INSERT OR IGNORE INTO pages VALUES (?, ?)', (source.path, offset))
+            self._connection.executemany('INSERT OR IGNORE INTO tracks VALUES (?)', ((id_,) for id_ in track_ids))
+            self._connection.executemany('INSERT OR IGNORE INTO sources VALUES (?, ?, ?, ?, ?)',
+                                         [(child.path, child.name, child.page_size, kind, child.total)
+                                          for child, kind in sources])
+
+    # ====
+    def track_ids(self) -> typing.List[str]:
+        return [id_ for (id_,) in self._connection.execute('SELECT id FROM tracks')]
+
+# ========
+def parse_links(links: typing.Iterable[str]) -> typing.List[typing.Tuple[str, str]]:
+    """
+    (kind, ID) for each link, kind being album, artist, playlist or track. Raises ValueError for anything else.
+    """
+
+    parsed = []
+    for link in links:
+        match = link_regex.match(link.strip())
+        if match is None or match.group(1) is None:
+            raise ValueError(f'Not a link to a playlist, album, artist or track: {link}')
+        parsed.append((match.group(1), match.group(2)))
+
+    return parsed
+
+# ====
+def checkpoint_file_name(parsed_links: typing.Iterable[typing.Tuple[str, str]],
+                         database_file_name: typing.Union[None, str] = None) -> str:
+    """
+    Where the checkpoint for these links goes: next to the database, named after the links, so that the same links
+    resume the same bulk dislike whatever order they are given in
+    """
+
+    key = hashlib.blake2b('\n'.join(sorted(f'{kind}:{id_}' for kind, id_ in parsed_links)).encode('utf8'),
+                          digest_size=6).hexdigest()
+
+    directory = os.path.dirname(database_file_name or HeartbrokenDatabase.file_name)
+    return os.path.join(directory, f'heartbroken_bulk_{key}.db')
+
+# ====
+def initial_sources(parsed_links: typing.Iterable[typing.Tuple[str, str]]) -> typing.List[typing.Tuple[Source, str]]:
+    sources = []
+    for kind, id_ in parsed_links:
+        if kind == 'playlist':
+            sources.append((Source.playlist(id_), TRACKS))
+        elif kind == 'album':
+            sources.append((Source(f'Album {id_}', f'/albums/{id_}/tracks?', 50), TRACKS))
+        elif kind == 'artist':
+            sources.append((Source(f'Artist {id_}', f'/artists/{id_}/albums?include_groups=album,single', 50), ALBUMS))
+
+    return sources
+
+# ====
+def page_items(kind: str, items: typing.Iterable[dict]) -> typing.Tuple[typing.List[str],
+                                                                        typing.List[typing.Tuple[Source, str]]]:
+    """
+    The track IDs, or for :kind ALBUMS the sources of album tracks, on a page
+    """
+
+    track_ids, sources = [], []
+
+    for item in items:
+        if item is None:
+            continue
+
+        if kind == ALBUMS:
+            if item.get('id', None) is not None:
+                sources.append((Source(f'Album {item.get("name", item["id"])}', f'/albums/{item["id"]}/tracks?', 50,
+                                       item.get('total_tracks', None)), TRACKS))
+            continue
+
+        # Playlists wrap each track in an entry, albums list tracks as they are
+        track_json = item.get('track', None) if 'track' in item else item
+        if track_json and track_json.get('type', 'track') == 'track' and track_json.get('id', None) is not None:
+            track_ids.append(track_json['id'])
+
+    return track_ids, sources
+
+# ========
+async def expand(checkpoint: Checkpoint, pager: Pager) -> bool:
+    """
+    Fetches every page the checkpoint doesn't have yet, in rounds, since a round of artists' albums makes for a
+    round of albums' tracks. Returns False if some pages couldn't be fetched.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    while True:
+        unfinished = checkpoint.unfinished_sources()
+        if not unfinished:
+            return True
+
+        kinds = {source.path: kind for source, kind in unfinished}
+        print(f'Fetching {len(unfinished)} source(s)...')
+
+        saved_pages = 0
+        async for source, offset, items in pager.pages([source for source, _ in unfinished]):
+            if items is None:
+                continue
+
+            track_ids, sources = page_items(kinds[source.path], items)
+            await loop.run_in_executor(None, checkpoint.save_page, source, offset, track_ids, sources)
+            saved_pages += 1
+
+        if saved_pages == 0:
+            return False
+
+# ====
+async def run_bulk_dislike(access_token: str, links: typing.Sequence[str],
+                           database_file_name: typing.Union[None, str] = None, concurrency: int = SCAN_CONCURRENCY,
+                           api_url: str = SpotifyWrapper.api_url) -> int:
+    """
+    Raises ValueError if any of :links isn't one that can be disliked
+    """
+
+    parsed_links = parse_links(links)
+
+    file_name = checkpoint_file_name(parsed_links, database_file_name)
+    resuming = os.path.exists(file_name)
+
+    checkpoint = Checkpoint(file_name)
+    try:
+        if resuming:
+            print(f'Picking up where the last run left off ({file_name})')
+        else:
+            checkpoint.add_sources(initial_sources(parsed_links))
+            checkpoint.add_tracks(id_ for kind, id_ in parsed_links if kind == 'track')
+
+        http = AsyncHTTPClient(api_url, max_connections=concurrency)
+        pager = Pager(http, access_token, concurrency)
+
+        try:
+            expanded = await expand(checkpoint, pager)
+        finally:
+            await http.close()
+
+        if not expanded or checkpoint.unfinished_sources():
+            print('Some pages could not be fetched, nothing was disliked yet; run the same command again to retry them')
+            return 1
+
+        track_ids = checkpoint.track_ids()
+
+    finally:
+        checkpoint.close()
+
+    saved = HeartbrokenDatabase.save_heartbreaks(track_ids, database_file_name)
+    if saved is None:
+        print('Nothing was disliked; run the same command again to retry')
+        return 1
+
+    os.remove(file_name)
+
+    print(f'Disliked {saved} track(s) out of {len(track_ids)} ({len(track_ids) - saved} were disliked already), '
+          f'with {pager.requests_made} requests')
+    return 0
+
+# ========
+def main() -> int:
+    from libs import logs
+    from libs.accounts import DEFAULT_ACCOUNTS_DIRECTORY, AccountRegistry
+
+    # What the libraries log (rules loaded, database errors) goes to the console, as the rest of the output does
+    logging.basicConfig(level=logging.INFO, format=logs.CONSOLE_FORMAT, stream=sys.stdout)
+
+    parser = argparse.ArgumentParser(description='Dislike every track of playlists, albums or artists')
+    parser.add_argument('links', nargs='+', metavar='URL', help='Spotify links to playlists, albums, artists or tracks')
+    parser.add_argument('--concurrency', type=int, default=SCAN_CONCURRENCY,
+                        help=f'Requests in flight at once (default {SCAN_CONCURRENCY})')
+    parser.add_argument('--account', default=None, help='Dislike for this account of heartbroken.py --accounts')
+    parser.add_argument('--directory', default=DEFAULT_ACCOUNTS_DIRECTORY,
+                        help=f'Where the accounts are kept (default ./{DEFAULT_ACCOUNTS_DIRECTORY})')
+    args = parser.parse_args()
+
+    try:
+        parse_links(args.links)
+    except ValueError as ex:
+        parser.error(str(ex))
+
+    credentials_file_name = database_file_name = None
+
+    if args.account is not None:
+        account = AccountRegistry(args.directory).get(args.account)
+        if account is None:
+            print(f'No account named "{args.account}"')
+            return 1
+
+        credentials_file_name = account.credentials_file_name
+        database_file_name = account.database_file_name
+
+    elif not HeartbrokenDatabase.maybe_create_table():
+        return 1
+
+    client = SpotifyWrapper(credentials_file_name=credentials_file_name).initialize_spotify_client()
+    if client is None or client == -1:
+        print('Could not connect to Spotify; run Heartbroken once to connect your account')
+        return 1
+
+    try:
+        return asyncio.run(run_bulk_dislike(client.access_token, args.links, database_file_name, args.concurrency))
+    except KeyboardInterrupt:
+        print('\nStopped; run the same command again to pick up where it left off')
+        return 1
+
+# ====
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+import threading
+import time
+
+from libs.utils import StaticClass
+
+
+# ========
+class SystemClock (StaticClass):
+    """
+    Static class that exposes the real clock. This is the default wherever a clock can be injected;
+    anything that sleeps or reads the time should go through one so that it can be swapped for a VirtualClock.
+    """
+
+    # ========
+    @staticmethod
+    def time() -> float:
+        return time.time()
+
+    # ====
+    @staticmethod
+    def sleep(seconds: float) -> None:
+        time.sleep(seconds)
+
+    # ====
+    @staticmethod
+    def wait(event: threading.Event, timeout: float) -> bool:
+        """
+        Sleeps for up to :timeout seconds, returning early (with True) if :event is set
+        """
+        return event.wait(timeout)
+
+# ========
+class VirtualClock:
+    """
+    Clock whose time only moves forward when something sleeps on it, which lets a session that took
+    hours in real life play out in however long the code under test takes to run.
+
+    :speed controls how much real time a sleep takes: 0 (the default) never waits, 60 turns an hour into a minute
+    :real_time makes time spent outside of sleep() (HTTP requests, database checks) count as well. A sleep still
+    moves the clock by exactly as long as it was for, the real time it took included.
+    """
+
+    def __init__(self, start: float = 0.0, speed: float = 0.0, real_time: bool = False):
+        self.speed = speed
+
+        self._now  = start
+        self._lock = threading.Lock()
+
+        self._real_start = time.perf_counter() if real_time else None
+
+    # ====
+    def time(self) -> float:
+        if self._real_start is None:
+            return self._now
+        return self._now + (time.perf_counter() - self._real_start)
+
+    # ====
+    def sleep(self, seconds: float) -> None:
+        if seconds <= 0:
+            return
+
+        started = time.perf_counter()
+        if self.speed > 0:
+            time.sleep(seconds / self.speed)
+
+        self.advance(seconds - self._counted_since(started))
+
+    # ====
+    def wait(self, event: threading.Event, timeout: float) -> bool:
+        """
+        Like sleep(), but returns early (with True) if :event is set. Time only moves forward by as much as was waited.
+        """
+
+        if event.is_set():
+            return True
+
+        if self.speed <= 0:
+            self.advance(timeout)
+            return event.is_set()
+
+        started = time.perf_counter()
+        woken = event.wait(timeout / self.speed)
+        waited = timeout if not woken else (time.perf_counter() - started) * self.speed
+        self.advance(waited - self._counted_since(started))
+
+        return woken
+
+    # ====
+    def advance(self, seconds: float) -> None:
+        """
+        Moves the clock forward without waiting, regardless of :speed
+        """
+
+        with self._lock:
+            self._now += seconds
+
+    # ====
+    def _counted_since(self, started: float) -> float:
+        """
+        Real seconds since the perf_counter() reading :started that time() already counts, with :real_time
+        """
+
+        if self._real_start is None:
+            return 0.0
+        return time.perf_counter() - started
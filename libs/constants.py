@@ -8,3 +8,33 @@ class SpotifyAPI (StaticClass):
 
     REQUEST_INTERVAL_SECONDS: int = 1
     REQUEST_DELAY_COMPENSATION_MS: int = 500
+
+    TOKEN_REFRESH_MARGIN_SECONDS: int = 60  # The asyncio engine refreshes access tokens this long before they expire
+    TOKEN_REFRESH_ATTEMPTS: int = 20  # Tries at getting an access token from the Heartbroken servers before giving up
+    TOKEN_RETRY_SECONDS: int = 3      # Between those tries
+    LOOKAHEAD_TRACKS: int = 3  # Queued tracks the asyncio engine checks against the database ahead of time
+
+    PROFILE_SECONDS: int = 30  # How long "Profile the app loop" in the tray runs for
+
+
+class Command (StaticClass):
+    """
+    Static class that stores the names of messages the tray sends to the app loop over the control queue.
+    Messages are (command, payload) tuples.
+    """
+
+    WAKE:        str = 'wake'         # Payload: None. Sent after changing the shared Events, so the loop sees it now
+    NUDGE:       str = 'nudge'        # Payload: None. The tray menu was opened, so playing may start soon
+    DUMP_TRACE:  str = 'dump_trace'   # Payload: the tray's trace events
+    PRINT_STATS: str = 'print_stats'  # Payload: None
+    SHOW_LOG:    str = 'show_log'     # Payload: None. Opens the last lines logged, see libs.logs
+
+    # Multi-account mode prefixes the payload with the account's name: 'alice:track'
+    DISLIKE:   str = 'dislike'    # Payload: 'track', 'artist', or 'album'
+    UNDISLIKE: str = 'undislike'  # Payload: 'track', 'artist', or 'album'
+
+    SET_ACCOUNTS: str = 'set_accounts'  # Payload: names of the accounts a worker process serves, see libs.supervisor
+    SET_WORKERS:  str = 'set_workers'   # Payload: number of worker processes, see libs.supervisor
+
+    START_PROFILE:   str = 'start_profile'    # Payload: number of seconds to profile the app loop for
+    MEMORY_SNAPSHOT: str = 'memory_snapshot'  # Payload: None
@@ -0,0 +1,147 @@
+"""
+Control interface for headless mode (heartbroken.py --headless), over a Unix domain socket.
+
+Requests and responses are single lines of JSON:
+    -> {"command": "dislike", "argument": "track"}
+    <- {"ok": true, "message": "..."}
+
+Also a small client for it:
+    python -m libs.controlsocket dislike track
+    python -m libs.controlsocket pause
+"""
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import typing
+
+
+DEFAULT_SOCKET_PATH = 'heartbroken.sock'
+
+COMMANDS = ('status', 'pause', 'resume', 'dislike', 'undislike', 'stats', 'log', 'profile', 'memory', 'trace',
+            'workers', 'quit')
+
+
+# ========
+class _ControlRequestHandler (socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                response = self.server.dispatch(request['command'], request.get('argument', None))
+            except (ValueError, KeyError, TypeError):
+                response = {'ok': False, 'message': 'Malformed request'}
+
+            self.wfile.write((json.dumps(response) + '\n').encode('utf8'))
+
+# ====
+class ControlServer (socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves :handlers, a dict of command -> function(argument) that returns a message for the client.
+    Handlers raise ValueError to reject an argument.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path: str, handlers: typing.Dict[str, typing.Callable[[typing.Union[None, str]], str]]):
+        self.path = path
+        self.handlers = handlers
+
+        _remove_stale_socket(path)
+
+        # Only the user running Heartbroken gets to control it
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(path, _ControlRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    # ====
+    def dispatch(self, command: str, argument: typing.Union[None, str]) -> dict:
+        handler = self.handlers.get(command, None)
+        if handler is None:
+            return {'ok': False, 'message': f'Unknown command "{command}", expected one of: {", ".join(self.handlers)}'}
+
+        try:
+            return {'ok': True, 'message': handler(argument)}
+        except ValueError as ex:
+            return {'ok': False, 'message': str(ex)}
+
+    # ====
+    def close(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+# ====
+def _remove_stale_socket(path: str) -> None:
+    """
+    Removes a socket file left behind by an instance that was killed. Raises OSError if one is still running.
+    """
+
+    if not os.path.exists(path):
+        return
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            probe.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.unlink(path)
+        return
+
+    raise OSError(f'Heartbroken is already running with its control socket at {path}')
+
+# ========
+def serve(path: str, handlers: typing.Dict[str, typing.Callable[[typing.Union[None, str]], str]]) -> ControlServer:
+    """
+    Starts answering control requests at :path from a background thread
+    """
+
+    server = ControlServer(path, handlers)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# ====
+def send(command: str, argument: typing.Union[None, str] = None, path: str = DEFAULT_SOCKET_PATH) -> dict:
+    """
+    Sends one command to a headless instance and returns its response
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(path)
+        connection.sendall((json.dumps({'command': command, 'argument': argument}) + '\n').encode('utf8'))
+
+        with connection.makefile('r', encoding='utf8') as responses:
+            return json.loads(responses.readline())
+
+# ========
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Control a Heartbroken instance running with --headless')
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('argument', nargs='?', default=None,
+                        help='track, artist, or album for dislike and undislike; the number of worker processes for '
+                             'workers; how many lines for log')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET_PATH,
+                        help=f'Control socket of the instance (default {DEFAULT_SOCKET_PATH})')
+    args = parser.parse_args()
+
+    try:
+        response = send(args.command, args.argument, args.socket)
+    except (ConnectionRefusedError, FileNotFoundError):
+        print(f'No headless Heartbroken instance is listening at {args.socket}')
+        return 2
+
+    print(response['message'])
+    return 0 if response['ok'] else 1
+
+# ====
+if __name__ == '__main__':
+    sys.exit(main())
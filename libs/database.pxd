@@ -0,0 +1,8 @@
+# Augments database.py when it is compiled by buildtools/cython_setup.py; ignored by the interpreted build.
+
+cimport cython
+
+@cython.locals(literal=str)
+cpdef _sql_id_tuple(ids)
+
+cpdef str _verdict_from_row(row)
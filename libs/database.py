@@ -1,3 +1,4 @@
+import logging
 import re
 import sqlite3
 import typing
@@ -6,6 +7,9 @@ from libs.utils import StaticClass
 from libs.spotifywrapper import Track as SpotifyTrack
 
 
+logger = logging.getLogger(__name__)
+
+
 # ========
 class HeartbrokenDatabase (StaticClass):
     """
@@ -13,15 +17,16 @@ class HeartbrokenDatabase (StaticClass):
     """
 
     file_name = 'heartbroken.db'
-    tuple_filter_regex = re.compile("[^a-zA-Z\d', ()]")
+    tuple_filter_regex = re.compile(r"[^a-zA-Z\d', ()]")
 
     # ========
     @staticmethod
-    def is_heartbroken(current_track: SpotifyTrack) -> typing.Union[typing.Tuple[bool, str],
+    def is_heartbroken(current_track: SpotifyTrack,
+                       file_name: typing.Union[None, str] = None) -> typing.Union[typing.Tuple[bool, str],
                                                                     typing.Tuple[bool, None],
                                                                     typing.Tuple[None, None]]:
         """
-        Checks the database to see if the current track is disliked.
+        Checks the database (:file_name, or the default one) to see if the current track is disliked.
         Returns a tuple matching one of the following structures:
             (is_disliked, what_disliked)
                 || (True, 'artist' | 'album' | 'track') on match
@@ -29,21 +34,19 @@ class HeartbrokenDatabase (StaticClass):
                 || (None,  None) on error
         """
 
-        artist_ids = current_track.artist_ids
+        artist_ids = _sql_id_tuple(current_track.artist_ids)
         album_id   = current_track.album_id
         track_id   = current_track.id
 
+        if artist_ids is None:
+            logger.warning('One or more artist ids are invalid: %s', current_track.artist_ids)
+            return None, None
+
         try:
-            connection = sqlite3.connect(HeartbrokenDatabase.file_name)
+            connection = sqlite3.connect(file_name or HeartbrokenDatabase.file_name)
             result = None
 
             with connection:
-                artist_ids = str(tuple(artist_ids)).replace(',)', ')')
-
-                if HeartbrokenDatabase.tuple_filter_regex.match(artist_ids) is not None:
-                    print(f'One or more artist ids are invalid: {artist_ids}')
-                    return None, None
-
                 command = f'''SELECT
                                 artist_id IN {artist_ids},
                                 album_id = :album_id,
@@ -56,31 +59,82 @@ class HeartbrokenDatabase (StaticClass):
                             )
                             LIMIT 1'''
 
-                result = connection.execute(command, {'artist_ids': artist_ids, 'album_id': album_id, 'track_id': track_id})
+                result = connection.execute(command, {'album_id': album_id, 'track_id': track_id})
                 result = result.fetchone()
 
             connection.close()
 
             if result is not None:
-                return True, ('artist' if result[0] else 'album' if result[1] else 'track')
+                return True, _verdict_from_row(result)
 
             return False, None
 
         except sqlite3.IntegrityError as ex:
-            print('Database error while trying to check if the item is disliked:')
-            print(ex)
+            logger.error('Database error while trying to check if the item is disliked:\n%s', ex)
             return None, None
 
+    # ====
+    @staticmethod
+    def are_heartbroken(tracks: typing.Sequence[SpotifyTrack],
+                        file_name: typing.Union[None, str] = None) -> typing.List[typing.Tuple[
+                                                                         typing.Union[None, bool],
+                                                                         typing.Union[None, str]]]:
+        """
+        is_heartbroken() for many tracks at once, e.g. a page of a playlist, with one query.
+        Returns a verdict per track, in the same order; (None, None) for all of them on error, or for a track with
+        invalid IDs.
+        """
+
+        valid = [_sql_id_tuple(track.artist_ids + [track.album_id, track.id]) is not None for track in tracks]
+        checked = [track for track, is_valid in zip(tracks, valid) if is_valid]
+
+        artist_ids = _sql_id_tuple(artist_id for track in checked for artist_id in track.artist_ids)
+        album_ids  = _sql_id_tuple(track.album_id for track in checked)
+        track_ids  = _sql_id_tuple(track.id for track in checked)
+
+        try:
+            connection = sqlite3.connect(file_name or HeartbrokenDatabase.file_name)
+
+            with connection:
+                rows = connection.execute(f'''SELECT artist_id, album_id, track_id
+                                              FROM heartbroken
+                                              WHERE (
+                                                  artist_id IN {artist_ids}
+                                                  OR album_id IN {album_ids}
+                                                  OR track_id IN {track_ids}
+                                              )''').fetchall()
+
+            connection.close()
+
+        except sqlite3.Error as ex:
+            logger.error('Database error while trying to check if the items are disliked:\n%s', ex)
+            return [(None, None)] * len(tracks)
+
+        # Each row has one of the three set, and NULL for the others
+        disliked_artists = {row[0] for row in rows} - {None}
+        disliked_albums  = {row[1] for row in rows} - {None}
+        disliked_tracks  = {row[2] for row in rows} - {None}
+
+        verdicts = []
+        for track, is_valid in zip(tracks, valid):
+            row = (any(artist_id in disliked_artists for artist_id in track.artist_ids),
+                   track.album_id in disliked_albums, track.id in disliked_tracks)
+
+            verdicts.append((None, None) if not is_valid else
+                            (True, _verdict_from_row(row)) if any(row) else (False, None))
+
+        return verdicts
+
     # ========
     @staticmethod
-    def maybe_create_table() -> bool:
+    def maybe_create_table(file_name: typing.Union[None, str] = None) -> bool:
         """
-        Creates the dislikes table.
+        Creates the dislikes table in :file_name, or the default database.
         Returns True on success and False on failure.
         """
 
         try:
-            connection = sqlite3.connect(HeartbrokenDatabase.file_name)
+            connection = sqlite3.connect(file_name or HeartbrokenDatabase.file_name)
             with connection:
                 # Spotify track IDs are 22-char base-62 strings
                 connection.execute('''CREATE TABLE IF NOT EXISTS heartbroken(
@@ -91,9 +145,8 @@ class HeartbrokenDatabase (StaticClass):
             connection.close()
 
         except sqlite3.IntegrityError as ex:
-            print('\n\n!!! HEARTBROKEN ENCOUNTERED A FATAL ERROR: !!!\n')
-            print('Error while trying to create the database:')
-            print(ex)
+            logger.critical('!!! HEARTBROKEN ENCOUNTERED A FATAL ERROR: !!!\n'
+                            'Error while trying to create the database:\n%s', ex)
             return False
 
         return True
@@ -102,7 +155,8 @@ class HeartbrokenDatabase (StaticClass):
     @staticmethod
     def save_heartbreak(track_id:  typing.Union[None, str] = None,
                         artist_id: typing.Union[None, str] = None,
-                        album_id:  typing.Union[None, str] = None) -> bool:
+                        album_id:  typing.Union[None, str] = None,
+                        file_name: typing.Union[None, str] = None) -> bool:
         """
         Saves a disliked ID to the database. More than one argument can be provided, but it would be redundant.
         Returns True on success and False on failure.
@@ -112,23 +166,47 @@ class HeartbrokenDatabase (StaticClass):
             raise Exception('No id was specified when calling save_heartbreak()')
 
         try:
-            connection = sqlite3.connect(HeartbrokenDatabase.file_name)
+            connection = sqlite3.connect(file_name or HeartbrokenDatabase.file_name)
             with connection:
                 connection.execute('INSERT OR IGNORE INTO heartbroken VALUES (?, ?, ?)', (artist_id, album_id, track_id))
             connection.close()
 
         except sqlite3.IntegrityError as ex:
-            print('Error while trying to write to the database:')
-            print(ex)
+            logger.error('Error while trying to write to the database:\n%s', ex)
             return False
 
         return True
 
+    # ====
+    @staticmethod
+    def save_heartbreaks(track_ids: typing.Iterable[str],
+                         file_name: typing.Union[None, str] = None) -> typing.Union[None, int]:
+        """
+        Saves many disliked track IDs in one transaction; all of them or, on failure, none.
+        Returns how many weren't disliked already, or None on failure.
+        """
+
+        try:
+            connection = sqlite3.connect(file_name or HeartbrokenDatabase.file_name)
+            with connection:
+                changes_before = connection.total_changes
+                connection.executemany('INSERT OR IGNORE INTO heartbroken VALUES (NULL, NULL, ?)',
+                                       ((track_id,) for track_id in track_ids))
+                saved = connection.total_changes - changes_before
+            connection.close()
+
+        except sqlite3.Error as ex:
+            logger.error('Error while trying to write to the database:\n%s', ex)
+            return None
+
+        return saved
+
     # ========
     @staticmethod
     def remove_heartbreak(track_id:  typing.Union[None, str] = None,
                           artist_id: typing.Union[None, str] = None,
-                          album_id:  typing.Union[None, str] = None) -> bool:
+                          album_id:  typing.Union[None, str] = None,
+                          file_name: typing.Union[None, str] = None) -> bool:
         """
         Saves a disliked ID to the database. More than one argument can be provided, but it would be redundant.
         Returns True on success and False on failure.
@@ -142,14 +220,34 @@ class HeartbrokenDatabase (StaticClass):
         track_id  = '_' if track_id is None else track_id
 
         try:
-            connection = sqlite3.connect(HeartbrokenDatabase.file_name)
+            connection = sqlite3.connect(file_name or HeartbrokenDatabase.file_name)
             with connection:
                 connection.execute("DELETE FROM heartbroken WHERE artist_id = (?) OR track_id = (?) OR album_id = (?)", (artist_id, track_id, album_id))
             connection.close()
 
         except sqlite3.IntegrityError as ex:
-            print('Error while trying to write to the database:')
-            print(ex)
+            logger.error('Error while trying to write to the database:\n%s', ex)
             return False
 
         return True
+
+# ========
+def _sql_id_tuple(ids: typing.Iterable[str]) -> typing.Union[str, None]:
+    """
+    Formats Spotify IDs as an SQL tuple literal for use with IN: ['a', 'b'] -> "('a', 'b')". Missing IDs are dropped.
+    Returns None if any ID contains something other than base-62 characters, as it would be injected into the query.
+    """
+
+    literal = str(tuple([id_ for id_ in ids if id_ is not None])).replace(',)', ')')
+
+    if HeartbrokenDatabase.tuple_filter_regex.search(literal) is not None:
+        return None
+
+    return literal
+
+# ====
+def _verdict_from_row(row: typing.Sequence[int]) -> str:
+    """
+    Maps a row of the is_heartbroken() query, (artist matched, album matched, track matched), to what was disliked
+    """
+    return 'artist' if row[0] else 'album' if row[1] else 'track'
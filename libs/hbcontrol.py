@@ -1,116 +1,289 @@
 from argparse import ArgumentError
+import logging
 import typing
 
-from libs.tokenhandler import TokenHandler
+from libs import leakage, metrics
 from libs.database import HeartbrokenDatabase
-from libs.spotifywrapper import SpotifyWrapper
+from libs.metadata import MetadataCache
+from libs.rules import RuleSet
+from libs.spotifywrapper import SpotifyWrapper, Track
+
+
+logger = logging.getLogger(__name__)
+
+# The rules in heartbroken_rules.json, for the single-account app loop
+default_rules = RuleSet()
+
+# Genres and audio features for the rules that go by them; only read once such a rule is loaded
+default_metadata = MetadataCache()
 
 
 # ========
 def skip_if_heartbroken(spotify: SpotifyWrapper) -> typing.Union[None, bool]:
     """
-    Takes a Spotify wrapper instance and checks inside a loop if tracks are disliked.
-    That is, if multiple tracks in a row are disliked, all will be skipped with this
-    function.
+    Takes a Spotify wrapper instance and checks if the current track is disliked, skipping it if so.
+    That is, if multiple tracks in a row are disliked, each poll skips one of them: True means a track was just
+    skipped, and the caller should poll again once spotify.seconds_until_settled() have passed.
+
+    Returns None if nothing is playing or something went wrong, and False if what is playing isn't disliked
 
     NECESSARY SIDE EFFECT: This also updates the current track
     """
 
-    spotify.update_current_track()
+    # current_track is left as it was by a failed poll, which after a skip is the track that was just skipped
+    if spotify.update_current_track() == -1:
+        return None
 
     current_track  = spotify.current_track
     previous_track = spotify.previous_track
 
     if current_track is None:
+        spotify.skipped_track_ids.clear()
         return None
 
     if previous_track is not None and current_track.id == previous_track.id:
         return False
 
-    tracks_skipped = set()
-    while True:
-        is_heartbroken, what_heartbroken = HeartbrokenDatabase.is_heartbroken(spotify.current_track)
+    detected_at = spotify.clock.time()
+
+    started = metrics.timer()
+    is_heartbroken, what_heartbroken = HeartbrokenDatabase.is_heartbroken(current_track)
+    metrics.observe_phase('is_heartbroken', started)
+
+    # The app loop fetches metadata ahead of time (prefetch_metadata()), this is for a track that it missed
+    if not is_heartbroken and needs_metadata(current_track):
+        fetch_metadata(spotify, [current_track])
+
+    is_heartbroken, what_heartbroken = apply_rules(current_track, (is_heartbroken, what_heartbroken))
+
+    current_track.track_heartbroken  = what_heartbroken == 'track'
+    current_track.album_heartbroken  = what_heartbroken == 'album'
+    current_track.artist_heartbroken = what_heartbroken == 'artist'
+
+    if not is_heartbroken:
+        spotify.skipped_track_ids.clear()
+        return is_heartbroken
+
+    # Prevent infinite loops
+    if current_track.id in spotify.skipped_track_ids:
+        logger.warning('Current track has been skipped previously in the current queue; '
+                       'stopping playback to prevent an infinite loop')
+        spotify.skipped_track_ids.clear()
+        spotify.stop_playback()
+        return None
+
+    logger.info(skip_message(current_track, what_heartbroken))
+    spotify.skipped_track_ids.add(current_track.id)
+
+    started = metrics.timer()
+    spotify.skip_confirmed_at = None
+    skipped = spotify.skip_current_track()
+    metrics.observe_phase('skip_current_track', started)
+
+    # Only skips Spotify accepted are counted
+    if spotify.skip_confirmed_at is not None:
+        metrics.count('heartbroken_skips_total', reason=what_heartbroken)
+        leakage.record(what_heartbroken, current_track.progress_ms,
+                       int((spotify.skip_confirmed_at - detected_at) * 1000))
+
+    if skipped == -1:
+        logger.error('Something went wrong while skipping disliked %s (%s)', what_heartbroken, current_track.url)
+        spotify.skipped_track_ids.discard(current_track.id)
+        return None
+
+    return True
+
+# ====
+def apply_rules(track: Track, verdict: typing.Tuple[typing.Union[None, bool], typing.Union[None, str]],
+                rule_set: typing.Union[None, RuleSet] = None,
+                metadata: typing.Union[None, MetadataCache] = None) -> typing.Tuple[typing.Union[None, bool],
+                                                                                    typing.Union[None, str]]:
+    """
+    Checks a track that isn't disliked by ID against the name rules (:rule_set, or heartbroken_rules.json), with
+    the genres and audio features in :metadata (or heartbroken_metadata.db). Takes and returns
+    HeartbrokenDatabase.is_heartbroken()'s verdict, which becomes (True, 'rule') on a match.
+    """
+
+    if verdict[0]:
+        return verdict
+
+    started = metrics.timer()
+    track.matched_rule = (rule_set or default_rules).match(track, metadata or default_metadata)
+    metrics.observe_phase('rules', started)
+
+    return verdict if track.matched_rule is None else (True, 'rule')
+
+# ====
+def metadata_requests(tracks: typing.Sequence[Track], rule_set: typing.Union[None, RuleSet] = None,
+                      metadata: typing.Union[None, MetadataCache] = None) -> typing.List[str]:
+    """
+    The API paths that get what the rules need to check :tracks and :metadata doesn't have yet; none unless there
+    are rules on genres or audio features
+    """
+
+    compiled = (rule_set or default_rules).compiled
+    if not compiled.needs_genres and not compiled.needs_features:
+        return []
+
+    tracks = [track for track in tracks if track is not None and track.id is not None]
 
-        spotify.current_track.track_heartbroken  = what_heartbroken == 'track'
-        spotify.current_track.album_heartbroken  = what_heartbroken == 'album'
-        spotify.current_track.artist_heartbroken = what_heartbroken == 'artist'
+    return (metadata or default_metadata).requests_for(
+        [track.id for track in tracks],
+        [artist_id for track in tracks for artist_id in track.artist_ids] if compiled.needs_genres else (),
+        features=compiled.needs_features)
 
-        if not is_heartbroken:
+# ====
+def needs_metadata(track: Track, rule_set: typing.Union[None, RuleSet] = None,
+                   metadata: typing.Union[None, MetadataCache] = None) -> bool:
+    return bool(metadata_requests([track], rule_set, metadata))
+
+# ====
+def fetch_metadata(spotify: SpotifyWrapper, tracks: typing.Sequence[Track],
+                   rule_set: typing.Union[None, RuleSet] = None,
+                   metadata: typing.Union[None, MetadataCache] = None) -> int:
+    """
+    Fetches what metadata_requests() says is missing, in batches. Returns the number of requests made.
+    """
+
+    metadata = metadata or default_metadata
+
+    paths = metadata_requests(tracks, rule_set, metadata)
+    for path in paths:
+        started = metrics.timer()
+        result = spotify.get_json(path)
+        metrics.observe_phase('metadata_http', started)
+
+        if result is None:  # The client isn't initialized
             break
 
-        print('Skipping disliked {}: {}'.format(
-            what_heartbroken,
-            {'track':  current_track.name,
-             'album':  current_track.album,
-             'artist': current_track.artists
-            }[what_heartbroken]
-        ) + f' ({current_track.url})')
+        metadata.store_response(path, *result)
+
+    return len(paths)
+
+# ====
+def prefetch_metadata(spotify: SpotifyWrapper, rule_set: typing.Union[None, RuleSet] = None,
+                      metadata: typing.Union[None, MetadataCache] = None) -> int:
+    """
+    Fetches metadata for the current track and the ones queued after it, so that checking them later on doesn't wait
+    for it. Does nothing unless there are rules on genres or audio features. Returns the number of requests made.
+    """
+
+    compiled = (rule_set or default_rules).compiled
+    if not compiled.needs_genres and not compiled.needs_features:
+        return 0
 
-        prev_track = current_track
-        tracks_skipped.add(current_track.id)
+    tracks = [spotify.current_track]
 
-        next_track = spotify.skip_current_track()
-        if next_track == -1:
-            print(f'Something went wrong while skipping disliked {what_heartbroken} ({prev_track.url}')
-            return None
+    result = spotify.get_json('/me/player/queue')
+    if result is not None and result[0] == 200 and isinstance(result[1], dict):
+        tracks += [Track({'item': item, 'is_playing': True}) for item in result[1].get('queue', None) or ()
+                   if item is not None]
 
-        elif next_track is None:
-            return None
+    return 1 + fetch_metadata(spotify, tracks, rule_set, metadata)
 
-        # Prevent infinite loops
-        if spotify.current_track.id in tracks_skipped:
-            print('Current track has been skipped previously in the current queue; stopping playback to prevent an infinite loop')
-            spotify.stop_playback()
-            return None
+# ====
+def skip_message(current_track: Track, what_heartbroken: str) -> str:
+    if what_heartbroken == 'rule':
+        return f'Skipping track matching {current_track.matched_rule}: {current_track.name} ({current_track.url})'
 
-    return is_heartbroken
+    what = {'track': current_track.name, 'album': current_track.album, 'artist': current_track.artists}[what_heartbroken]
+    return f'Skipping disliked {what_heartbroken}: {what} ({current_track.url})'
 
 # ========
-def handle_heartbreak(track:  bool = False, artist: bool = False, album:  bool = False) -> None:
+def _current_track(spotify: SpotifyWrapper, refresh: bool) -> typing.Union[Track, None]:
     """
-    Writes dislike information to the database. Arguments determine what is disliked and are mutually exclusive.
-    NECESSARY SIDE EFFECT: This also updates the current track
+    The track the app loop last saw, or with :refresh, whatever is playing right now (the loop stops polling while
+    auto-skip is paused, so what it last saw may be long gone)
+    """
+
+    if not refresh and spotify.current_track is not None:
+        return spotify.current_track
+
+    if spotify.is_token_expired() and spotify.initialize_spotify_client() in (None, -1):
+        return None
+
+    current_track = spotify.update_current_track()
+    return None if current_track == -1 else current_track
+
+# ========
+def save_heartbreak(current_track: Track, track: bool = False, artist: bool = False, album: bool = False,
+                    database_file_name: typing.Union[None, str] = None) -> bool:
+    """
+    Dislikes the track, its artists, or its album in the database (:database_file_name, or the default one).
+    Returns False if that failed.
+    """
+
+    if artist:
+        db_success = True
+        for artist_id in current_track.artist_ids:
+            db_success = db_success and HeartbrokenDatabase.save_heartbreak(artist_id=artist_id,
+                                                                            file_name=database_file_name)
+        return db_success
+
+    elif album:
+        return HeartbrokenDatabase.save_heartbreak(album_id=current_track.album_id, file_name=database_file_name)
+
+    return HeartbrokenDatabase.save_heartbreak(track_id=current_track.id, file_name=database_file_name)
+
+# ====
+def clear_heartbreak(current_track: Track, track: bool = False, artist: bool = False, album: bool = False,
+                     database_file_name: typing.Union[None, str] = None) -> bool:
+    """
+    Un-dislikes the track, its artists, or its album in the database (:database_file_name, or the default one).
+    Returns False if that failed.
+    """
+
+    if artist:
+        db_success = True
+        for artist_id in current_track.artist_ids:
+            db_success = db_success and HeartbrokenDatabase.remove_heartbreak(artist_id=artist_id,
+                                                                              file_name=database_file_name)
+        return db_success
+
+    return HeartbrokenDatabase.remove_heartbreak(track_id=current_track.id if track else None,
+                                                 album_id=current_track.album_id if album else None,
+                                                 file_name=database_file_name)
+
+# ========
+def handle_heartbreak(spotify: SpotifyWrapper, track:  bool = False, artist: bool = False, album:  bool = False,
+                      refresh: bool = False) -> None:
+    """
+    Writes dislike information to the database and skips the track. Arguments determine what is disliked and are
+    mutually exclusive. Runs in the app loop, against its session and the track it is looking at, which the loop's
+    next poll brings up to date once Spotify has caught up with the skip.
     """
 
     arg_true_count = len([arg for arg in (track, artist, album) if arg])
     if   arg_true_count > 1:  raise ArgumentError('Only one argument to handle_heartbreak() can be True')
     elif arg_true_count == 0: raise ArgumentError('One argument to handle_heartbreak() must be True')
 
-    current_track = SpotifyWrapper.get_current_track_static(TokenHandler.client_id)
+    current_track = _current_track(spotify, refresh)
 
     item_type = "track" if track else "artist" if artist else "album"
     if current_track is None:
-        print(f'Cannot dislike {item_type}, nothing is playing!')
+        logger.warning('Cannot dislike %s, nothing is playing!', item_type)
         return
 
-    track_id   = current_track.id         if track  else None
-    artist_ids = current_track.artist_ids if artist else []
-    album_id   = current_track.album_id   if album  else None
-
-    if artist:
-        db_success = True
-        for artist_id in artist_ids:
-            db_success = db_success and HeartbrokenDatabase.save_heartbreak(artist_id=artist_id)
-
-    elif album:
-        db_success = HeartbrokenDatabase.save_heartbreak(album_id=album_id)
-    else:
-        db_success = HeartbrokenDatabase.save_heartbreak(track_id=track_id)
+    if not save_heartbreak(current_track, track, artist, album):
+        logger.error('Sorry, something went wrong while disliking the %s', item_type)
+        return
 
-    if not db_success:
-        print(f'Sorry, something went wrong while disliking the {item_type}')
+    # A skip is already on its way and the track in hand may be gone; skipping again would skip whatever came next
+    if spotify.seconds_until_settled() > 0:
+        logger.info('Sucessfully disliked %s (%s)', item_type, current_track.url)
         return
 
-    print(f'Sucessfully disliked {item_type}, skipping... ({current_track.url}')
+    logger.info('Sucessfully disliked %s, skipping... (%s)', item_type, current_track.url)
 
-    api_success = SpotifyWrapper.skip_current_track_static(TokenHandler.client_id)
-    if not api_success:
-        print(f'Sorry, something went wrong while skipping the current {item_type} ({current_track.url}')
+    if spotify.skip_current_track() == -1:
+        logger.error('Sorry, something went wrong while skipping the current %s (%s)', item_type, current_track.url)
 
 # ========
-def handle_clear_heartbreak(track: bool = False, artist: bool = False, album:  bool = False) -> None:
+def handle_clear_heartbreak(spotify: SpotifyWrapper, track: bool = False, artist: bool = False, album:  bool = False,
+                            refresh: bool = False) -> None:
     """
     Deletes dislikes from the database. Arguments determine what is disliked and are mutually exclusive.
+    Runs in the app loop, against its session and the track it is looking at.
     NECESSARY SIDE EFFECT: This also updates the current track
     """
 
@@ -118,28 +291,15 @@ def handle_clear_heartbreak(track: bool = False, artist: bool = False, album:  b
     if   arg_true_count > 1:  raise ArgumentError('Only one argument to handle_clear_heartbreak() can be True')
     elif arg_true_count == 0: raise ArgumentError('One argument to handle_clear_heartbreak() must be True')
 
-    current_track = SpotifyWrapper.get_current_track_static(TokenHandler.client_id)
-
-    track_id   = current_track.id         if track  else None
-    artist_ids = current_track.artist_ids if artist else []
-    album_id   = current_track.album_id   if album  else None
+    current_track = _current_track(spotify, refresh)
 
     item_type = "track" if track else "artist(s)" if artist else "album"
 
     if current_track is None:
-        print(f'Cannot un-dislike {item_type}, nothing is playing!')
+        logger.warning('Cannot un-dislike %s, nothing is playing!', item_type)
         return
 
-    if artist:
-        db_success = True
-        for artist_id in artist_ids:
-            db_success = db_success and HeartbrokenDatabase.remove_heartbreak(artist_id=artist_id)
-
-    else:
-        db_success = HeartbrokenDatabase.remove_heartbreak(track_id=track_id,
-                                                           album_id=album_id)
-
-    if db_success:
-        print(f'Sucessfully un-disliked {item_type}')
+    if clear_heartbreak(current_track, track, artist, album):
+        logger.info('Sucessfully un-disliked %s', item_type)
     else:
-        print(f'Sorry, something went wrong while un-disliking the {item_type} ({current_track.url})')
+        logger.error('Sorry, something went wrong while un-disliking the %s (%s)', item_type, current_track.url)
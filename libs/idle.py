@@ -0,0 +1,160 @@
+"""
+How often to look for playback while nothing is playing, in place of a fixed back-off.
+
+The Web API can't say when playback starts, so the only way to catch a resume within a second or two is to poll
+about that often. IdleWatch spends those polls where a resume is likely and keeps the rest cheap, going by what the
+last poll saw of the player:
+
+    PAUSED    a device is active but not playing music (paused, or playing a podcast). It is one tap away from playing
+              again, so the track is polled every RESUME_POLL_SECONDS for PAUSED_WATCH_SECONDS after the pause,
+              every LONG_PAUSE_POLL_SECONDS up to LONG_PAUSE_SECONDS, and every IDLE_POLL_SECONDS after that.
+    INACTIVE  no device is active, and nothing plays until one is. The device list (/me/player/devices) is checked
+              every IDLE_POLL_SECONDS instead of the track: a device turning active means playback started, and a new
+              device showing up (the app was opened) means it is likely to.
+
+A new device, and the user doing something in the tray or over the control socket (NUDGING_COMMANDS), start a watch
+of NUDGE_WATCH_SECONDS during which the track is polled every RESUME_POLL_SECONDS, whatever the state. Failed polls
+back off along FAILURE_BACKOFF_SECONDS on top of all this.
+"""
+
+import logging
+import typing
+
+from libs import constants
+from libs.clock import SystemClock
+
+
+PLAYING  = 'playing'
+PAUSED   = 'paused'
+INACTIVE = 'inactive'
+
+RESUME_POLL_SECONDS     = 2        # While a resume is likely
+PAUSED_WATCH_SECONDS    = 10 * 60
+LONG_PAUSE_POLL_SECONDS = 10
+LONG_PAUSE_SECONDS      = 60 * 60
+IDLE_POLL_SECONDS       = 30
+NUDGE_WATCH_SECONDS     = 2 * 60
+
+FAILURE_BACKOFF_SECONDS = (1, 2, 5, 10, 30, 60)  # The last one repeats
+
+# Messages that mean someone is at the tray or the control socket, see constants.Command
+NUDGING_COMMANDS = (constants.Command.WAKE, constants.Command.NUDGE, constants.Command.DISLIKE,
+                    constants.Command.UNDISLIKE)
+
+logger = logging.getLogger(__name__)
+
+
+# ========
+class IdleWatch:
+    """
+    Tells the app loop how long to wait before the next poll while nothing is playing, and whether that poll should
+    check the device list rather than the track. :name prefixes what it logs, for multi-account mode.
+    """
+
+    def __init__(self, clock=SystemClock, name: typing.Union[None, str] = None):
+        self.clock = clock
+        self.name  = name
+
+        self.state = None  # PLAYING, PAUSED or INACTIVE, by the last poll that got an answer
+        self.devices_readable = True  # False for accounts connected before reading playback state was allowed
+
+        self._state_since = clock.time()
+        self._watch_until = None
+        self._failures    = 0
+        self._device_ids  = None  # IDs of the devices in the last device list
+
+    # ========
+    @property
+    def checks_devices(self) -> bool:
+        """
+        True when the next poll should be of the device list instead of the track
+        """
+        return self.state == INACTIVE and self.devices_readable and not self._watching() and self._failures == 0
+
+    # ====
+    def observe(self, player_state: typing.Union[None, str]) -> None:
+        """
+        Takes in what a poll of the track saw: PLAYING, PAUSED or INACTIVE, or None if it failed
+        """
+
+        if player_state is None:
+            self._failures += 1
+            return
+
+        self._failures = 0
+
+        if player_state != self.state:
+            self.state = player_state
+            self._state_since = self.clock.time()
+
+    # ====
+    def observe_devices(self, status_code: int, body: typing.Any) -> bool:
+        """
+        Takes in the response to a poll of the device list, decoded. Returns True if the track should be polled
+        straight away, because a device is active or the list couldn't be read.
+        """
+
+        # Tokens from before the device list needed user-read-playback-state can't read it; reconnecting fixes that
+        if status_code == 403:
+            prefix = '' if self.name is None else f'[{self.name}] '
+            logger.warning('%sIdle device checks are off: the account needs to be connected again to allow reading '
+                           'its devices', prefix)
+            self.devices_readable = False
+            return True
+
+        if status_code != 200 or not isinstance(body, dict):
+            self._failures += 1
+            return False
+
+        self._failures = 0
+
+        devices = [device for device in body.get('devices', None) or [] if isinstance(device, dict)]
+        device_ids = frozenset(device.get('id', None) for device in devices)
+
+        # Someone opened Spotify somewhere, so playing is likely to start soon
+        if self._device_ids is not None and not device_ids <= self._device_ids:
+            self._watch_until = self.clock.time() + NUDGE_WATCH_SECONDS
+        self._device_ids = device_ids
+
+        return any(device.get('is_active', False) for device in devices)
+
+    # ====
+    def nudge(self) -> bool:
+        """
+        Watches closely for a while, since playback may be about to start. Returns True if nothing is playing, in
+        which case the loop should poll straight away.
+        """
+
+        self._watch_until = self.clock.time() + NUDGE_WATCH_SECONDS
+        return self.state != PLAYING
+
+    # ========
+    def next_delay(self) -> float:
+        """
+        Seconds to wait before the next poll while nothing is playing, or after a poll failed
+        """
+
+        # Nothing is known yet, or playing has only just stopped
+        if self.state in (None, PLAYING) or self._watching():
+            delay = RESUME_POLL_SECONDS
+
+        elif self.state == PAUSED:
+            paused_for = self.clock.time() - self._state_since
+            if paused_for < PAUSED_WATCH_SECONDS:
+                delay = RESUME_POLL_SECONDS
+            elif paused_for < LONG_PAUSE_SECONDS:
+                delay = LONG_PAUSE_POLL_SECONDS
+            else:
+                delay = IDLE_POLL_SECONDS
+
+        else:
+            delay = IDLE_POLL_SECONDS
+
+        if self._failures > 0:
+            delay = max(delay, FAILURE_BACKOFF_SECONDS[min(self._failures, len(FAILURE_BACKOFF_SECONDS)) - 1])
+
+        return max(delay, constants.SpotifyAPI.REQUEST_INTERVAL_SECONDS)
+
+    # ====
+    def _watching(self) -> bool:
+        return self._watch_until is not None and self.clock.time() < self._watch_until
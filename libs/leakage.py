@@ -0,0 +1,63 @@
+import collections
+import typing
+
+from libs import utils
+
+
+# Most recent skips kept per reason; percentiles are over these
+MAX_SAMPLES = 1000
+
+# What was disliked -> milliseconds of each disliked track that played before the skip went through
+_samples = {}
+
+
+# ========
+def record(reason: str, detected_progress_ms: int, detection_to_skip_ms: int) -> None:
+    """
+    Records one skip: how far into the track it was when the loop saw it, plus how long the loop took from then until
+    Spotify accepted the skip
+    """
+
+    if reason not in _samples:
+        _samples[reason] = collections.deque(maxlen=MAX_SAMPLES)
+
+    _samples[reason].append(max(0, detected_progress_ms) + max(0, detection_to_skip_ms))
+
+# ====
+def reset() -> None:
+    _samples.clear()
+
+# ========
+def summary() -> typing.Dict[str, dict]:
+    """
+    Leaked milliseconds of audio per reason: {'track': {'count': 12, 'p50': ..., 'p90': ..., 'p99': ..., 'max': ...}}
+    """
+
+    result = {}
+    for reason, samples in sorted(_samples.items()):
+        samples = list(samples)
+        result[reason] = {'count': len(samples),
+                          'p50':   utils.percentile(samples, .5),
+                          'p90':   utils.percentile(samples, .9),
+                          'p99':   utils.percentile(samples, .99),
+                          'max':   max(samples)}
+
+    return result
+
+# ====
+def report() -> str:
+    """
+    summary() as a table for the console
+    """
+
+    stats = summary()
+    if len(stats) == 0:
+        return 'Nothing has been skipped yet'
+
+    lines = ['Disliked audio played before skipping (ms):',
+             f'    {"":8}{"skips":>7}{"p50":>8}{"p90":>8}{"p99":>8}{"max":>8}']
+
+    for reason, row in stats.items():
+        lines.append(f'    {reason:8}{row["count"]:>7}{row["p50"]:>8}{row["p90"]:>8}{row["p99"]:>8}{row["max"]:>8}')
+
+    return '\n'.join(lines)
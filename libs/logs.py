@@ -0,0 +1,141 @@
+"""
+Logging for the app loop and everything it calls, in place of printing straight to the console.
+
+Modules log through logging.getLogger(__name__) as usual. start() gives the root logger a single handler that puts
+records on a queue, unformatted, so logging from the loop costs no more than the append; a QueueListener thread
+formats them and writes them out to the console, to heartbroken.log (rotated at MAX_LOG_BYTES, LOG_BACKUPS kept),
+and to a ring buffer of the last RECENT_RECORDS lines that the tray ("Show recent log") and the control socket
+("log") show. A console that is hidden, slow or blocked only holds up that thread.
+
+Until start() is called, as in the command line tools and the devtools, logging behaves as it does by default.
+"""
+
+import collections
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import typing
+
+
+LOG_FILE_NAME  = 'heartbroken.log'
+MAX_LOG_BYTES  = 1024 * 1024
+LOG_BACKUPS    = 3
+RECENT_RECORDS = 500
+
+CONSOLE_FORMAT = '%(message)s'  # The console reads as it did with print()
+FILE_FORMAT    = '%(asctime)s %(levelname)-7s %(name)s: %(message)s'
+
+_listener   = None
+_recent     = None
+_started_in = None  # Process ID; a forked worker inherits the handler, but not the thread that empties its queue
+
+
+# ========
+class _EnqueueHandler (logging.handlers.QueueHandler):
+    """
+    Hands records to the listener as they are. The stock QueueHandler formats every record on the calling thread so
+    that it can be pickled, which a queue within one process doesn't need.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+# ====
+class _RingBufferHandler (logging.Handler):
+    def __init__(self, capacity: int):
+        super().__init__()
+        self.lines = collections.deque(maxlen=capacity)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.lines.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+# ========
+def start(file_name: typing.Union[None, str] = LOG_FILE_NAME, level: int = logging.INFO, console: bool = True) -> None:
+    """
+    Sends everything logged from now on through the queue. :file_name None means no log file, and :console False
+    nothing on the console. Calling it again in the same process does nothing until stop().
+    """
+
+    global _listener, _recent, _started_in
+
+    if _listener is not None and _started_in == os.getpid():
+        return
+
+    handlers = []
+
+    if console:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+        handlers.append(console_handler)
+
+    if file_name is not None:
+        try:
+            file_handler = logging.handlers.RotatingFileHandler(file_name, maxBytes=MAX_LOG_BYTES,
+                                                                backupCount=LOG_BACKUPS, encoding='utf8')
+        except OSError as ex:
+            print(f'Could not open {file_name} for logging, only logging to the console: {ex}')
+        else:
+            file_handler.setFormatter(logging.Formatter(FILE_FORMAT))
+            handlers.append(file_handler)
+
+    _recent = _RingBufferHandler(RECENT_RECORDS)
+    _recent.setFormatter(logging.Formatter(FILE_FORMAT))
+    handlers.append(_recent)
+
+    records = queue.SimpleQueue()
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_EnqueueHandler(records))
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    _started_in = os.getpid()
+
+# ====
+def stop() -> None:
+    """
+    Writes out whatever is still queued and stops the writer thread
+    """
+
+    global _listener
+
+    if _listener is None:
+        return
+
+    _listener.stop()
+    _listener = None
+
+    for handler in list(logging.getLogger().handlers):
+        if isinstance(handler, _EnqueueHandler):
+            logging.getLogger().removeHandler(handler)
+
+# ========
+def recent(count: typing.Union[None, int] = None) -> typing.List[str]:
+    """
+    The last :count lines logged (or all the ring buffer holds), oldest first; none before start()
+    """
+
+    if _recent is None:
+        return []
+
+    lines = list(_recent.lines)
+    return lines if count is None else lines[-count:]
+
+# ====
+def save_recent(file_name: str = 'heartbroken_recent_log.txt') -> str:
+    """
+    Writes recent() to :file_name, for the tray to open. Returns the path.
+    """
+
+    with open(file_name, 'w', encoding='utf8') as f:
+        f.write('\n'.join(recent()) + '\n')
+
+    return file_name
@@ -0,0 +1,209 @@
+"""
+Artist genres and track audio features, for name rules that go by them (see libs.rules).
+
+Track only has what /me/player/currently-playing returns, so this is fetched separately through the batch endpoints,
+/artists (50 IDs per request) and /audio-features (100 IDs per request), and kept in heartbroken_metadata.db next to
+heartbroken.db. Genres are refetched after GENRES_TTL_SECONDS; a recording's features never change, so they are
+kept for much longer.
+
+The loops request metadata for the tracks coming up in the queue as soon as a track starts (requests_for() and
+store_response()), so by the time a track plays, checking it is a dictionary lookup. The whole cache is held in
+memory, the database only lets it survive restarts.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import typing
+import urllib.parse
+
+
+ARTISTS_PER_REQUEST  = 50
+FEATURES_PER_REQUEST = 100
+
+GENRES_TTL_SECONDS   = 30 * 24 * 3600
+FEATURES_TTL_SECONDS = 365 * 24 * 3600
+
+# The numbers /audio-features has for a track, which rules can compare against
+AUDIO_FEATURES = ('acousticness', 'danceability', 'energy', 'instrumentalness', 'liveness', 'loudness',
+                  'speechiness', 'tempo', 'valence')
+
+logger = logging.getLogger(__name__)
+
+
+# ========
+class MetadataCache:
+    """
+    Genres by artist ID and audio features by track ID, in memory and in :file_name. Thread-safe.
+    """
+
+    file_name = 'heartbroken_metadata.db'
+
+    def __init__(self, file_name: typing.Union[None, str] = None):
+        self.file_name = file_name or MetadataCache.file_name
+
+        # Set to False once Spotify refuses /audio-features, which it does for apps registered after November 2024
+        self.features_available = True
+
+        self._genres   = None  # Artist ID -> (genres, fetched at); loaded on first use
+        self._features = None  # Track ID -> ({feature: value}, fetched at)
+        self._lock     = threading.Lock()
+
+    # ========
+    def genres(self, artist_ids: typing.Sequence[str]) -> typing.Union[None, typing.List[str]]:
+        """
+        Every genre of the artists, or None if any of them isn't cached
+        """
+
+        self._load()
+
+        genres = []
+        for artist_id in artist_ids:
+            entry = self._genres.get(artist_id, None)
+            if entry is None:
+                return None
+            genres.extend(entry[0])
+
+        return genres
+
+    # ====
+    def features(self, track_id: str) -> typing.Union[None, typing.Dict[str, float]]:
+        """
+        The track's audio features, {} if Spotify has none for it, or None if they aren't cached
+        """
+
+        self._load()
+
+        entry = self._features.get(track_id, None)
+        return None if entry is None else entry[0]
+
+    # ========
+    def requests_for(self, track_ids: typing.Iterable[str], artist_ids: typing.Iterable[str],
+                     features: bool = True) -> typing.List[str]:
+        """
+        API paths that fetch whatever the cache is missing or has let expire for these tracks and artists, in as few
+        requests as the batch limits allow. Audio features are left out without :features.
+        """
+
+        self._load()
+        now = time.time()
+
+        artist_ids = _missing(artist_ids, self._genres, GENRES_TTL_SECONDS, now)
+        paths = [f'/artists?ids={",".join(batch)}' for batch in _batches(artist_ids, ARTISTS_PER_REQUEST)]
+
+        if features and self.features_available:
+            track_ids = _missing(track_ids, self._features, FEATURES_TTL_SECONDS, now)
+            paths += [f'/audio-features?ids={",".join(batch)}' for batch in _batches(track_ids, FEATURES_PER_REQUEST)]
+
+        return paths
+
+    # ====
+    def store_response(self, path: str, status_code: int, body: typing.Any) -> None:
+        """
+        Caches what came back for one of requests_for()'s paths
+        """
+
+        endpoint, _, query = path.partition('?')
+        requested = [id_ for id_ in urllib.parse.parse_qs(query).get('ids', [''])[0].split(',') if id_]
+
+        if endpoint == '/audio-features' and status_code == 403:
+            logger.warning('Spotify no longer provides audio features to this app, rules that use them will not match')
+            self.features_available = False
+            return
+
+        if not 200 <= status_code < 300 or not isinstance(body, dict):
+            return
+
+        self._load()
+        now = time.time()
+
+        # IDs Spotify has nothing for come back as null; they are cached as having nothing, so they aren't asked again
+        if endpoint == '/artists':
+            rows = {artist_id: ((), now) for artist_id in requested}
+            rows.update({artist['id']: (tuple(artist.get('genres', None) or ()), now)
+                         for artist in body.get('artists', None) or () if artist is not None})
+            self._store('genres', self._genres, rows)
+
+        elif endpoint == '/audio-features':
+            rows = {track_id: ({}, now) for track_id in requested}
+            rows.update({features['id']: ({name: features[name] for name in AUDIO_FEATURES if name in features}, now)
+                         for features in body.get('audio_features', None) or () if features is not None})
+            self._store('features', self._features, rows)
+
+    # ========
+    def _load(self) -> None:
+        if self._genres is not None:
+            return
+
+        with self._lock:
+            if self._genres is not None:
+                return
+
+            genres, features = {}, {}
+
+            try:
+                connection = sqlite3.connect(self.file_name)
+                with connection:
+                    _create_tables(connection)
+
+                    for artist_id, value, fetched_at in connection.execute('SELECT id, value, fetched_at FROM genres'):
+                        genres[artist_id] = (tuple(json.loads(value)), fetched_at)
+
+                    for track_id, value, fetched_at in connection.execute('SELECT id, value, fetched_at FROM features'):
+                        features[track_id] = (json.loads(value), fetched_at)
+                connection.close()
+
+            except sqlite3.Error as ex:
+                logger.error('Could not read the metadata cache, starting with an empty one: %s', ex)
+
+            self._features = features
+            self._genres = genres
+
+    # ====
+    def _store(self, table: str, cache: dict, rows: typing.Dict[str, typing.Tuple[typing.Any, float]]) -> None:
+        if not rows:
+            return
+
+        with self._lock:
+            cache.update(rows)
+
+            try:
+                connection = sqlite3.connect(self.file_name)
+                with connection:
+                    connection.executemany(f'INSERT OR REPLACE INTO {table} VALUES (?, ?, ?)',
+                                           [(id_, json.dumps(value), fetched_at)
+                                            for id_, (value, fetched_at) in rows.items()])
+                connection.close()
+
+            except sqlite3.Error as ex:
+                logger.error('Could not save to the metadata cache: %s', ex)
+
+# ========
+def _create_tables(connection: sqlite3.Connection) -> None:
+    for table in ('genres', 'features'):
+        connection.execute(f'''CREATE TABLE IF NOT EXISTS {table}(
+                                 id CHAR PRIMARY KEY,
+                                 value TEXT NOT NULL,
+                                 fetched_at REAL NOT NULL
+                             )''')
+
+# ====
+def _missing(ids: typing.Iterable[str], cache: dict, ttl_seconds: float, now: float) -> typing.List[str]:
+    """
+    The IDs that aren't in :cache or have been there for longer than :ttl_seconds, without repeats
+    """
+
+    missing = []
+    for id_ in ids:
+        entry = cache.get(id_, None)
+        if id_ is not None and id_ not in missing and (entry is None or now - entry[1] > ttl_seconds):
+            missing.append(id_)
+
+    return missing
+
+# ====
+def _batches(ids: typing.Sequence[str], size: int) -> typing.Iterator[typing.Sequence[str]]:
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
@@ -0,0 +1,186 @@
+import bisect
+import threading
+import time
+import typing
+
+from libs import tracing
+
+
+# Off unless enable() is called; every recording function returns immediately while disabled
+ENABLED = False
+
+# Upper bounds in seconds. Covers everything from a database check to the longest back-off sleep.
+PHASE_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+_COUNTER_HELP = {
+    'heartbroken_api_calls_total':    'Spotify API calls made by the app loop, by endpoint and HTTP status',
+    'heartbroken_skips_total':        'Skips Spotify accepted, by what was disliked',
+    'heartbroken_rate_limited_total': 'Spotify API calls rejected with HTTP 429'
+}
+
+
+# ========
+class Histogram:
+    """
+    Fixed-bucket histogram; observing a value is a binary search and two additions
+    """
+
+    def __init__(self, buckets: typing.Sequence[float] = PHASE_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts  = [0] * (len(self.buckets) + 1)  # The last one is +Inf
+        self.sum     = 0.0
+        self.count   = 0
+
+    # ====
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+# ====
+_phases   = {}  # Phase name -> Histogram
+_counters = {}  # (metric name, ((label, value), ...)) -> count
+
+
+# ========
+def enable() -> None:
+    global ENABLED
+    ENABLED = True
+
+# ========
+def timer() -> typing.Union[float, None]:
+    """
+    Marks the start of a phase; pass the result to observe_phase() when it ends.
+    Returns None while both metrics and tracing are disabled.
+    """
+    return time.perf_counter() if ENABLED or tracing.ENABLED else None
+
+# ====
+def observe_phase(phase: str, started: typing.Union[float, None]) -> None:
+    """
+    Records the time since :started, as returned by timer(), against :phase.
+    The phase also becomes a span in the timeline if tracing is enabled.
+    """
+
+    if started is None:
+        return
+
+    ended = time.perf_counter()
+    observe(phase, ended - started)
+    tracing.record(phase, started, ended)
+
+# ====
+def observe(phase: str, seconds: float) -> None:
+    """
+    Records a duration that was not measured with timer(), like a sleep
+    """
+
+    if not ENABLED:
+        return
+
+    histogram = _phases.get(phase, None)
+    if histogram is None:
+        histogram = _phases[phase] = Histogram()
+
+    histogram.observe(seconds)
+
+# ========
+def count(name: str, **labels: typing.Any) -> None:
+    """
+    Increments the counter :name (one of _COUNTER_HELP) for the given labels
+    """
+
+    if not ENABLED:
+        return
+
+    key = (name, tuple(sorted(labels.items())))
+    _counters[key] = _counters.get(key, 0) + 1
+
+# ====
+def api_call(endpoint: str, status_code: int) -> None:
+    """
+    Counts a Spotify API response
+    """
+
+    if not ENABLED:
+        return
+
+    count('heartbroken_api_calls_total', endpoint=endpoint, status=status_code)
+    if status_code == 429:
+        count('heartbroken_rate_limited_total')
+
+# ====
+def counters() -> typing.Dict[typing.Tuple[str, tuple], int]:
+    """
+    A copy of every counter, keyed by (metric name, ((label, value), ...)), e.g. for reporting to another process
+    """
+    return dict(_counters)
+
+# ========
+def _format_labels(labels: typing.Iterable[typing.Tuple[str, typing.Any]]) -> str:
+    labels = ','.join(f'{key}="{value}"' for key, value in labels)
+    return '{' + labels + '}' if labels else ''
+
+# ====
+def render() -> str:
+    """
+    Everything recorded so far, in the Prometheus text exposition format
+    """
+
+    lines = ['# HELP heartbroken_phase_seconds Time spent in each phase of the app loop',
+             '# TYPE heartbroken_phase_seconds histogram']
+
+    for phase, histogram in sorted(_phases.items()):
+        cumulative = 0
+        for bound, bucket_count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+            cumulative += bucket_count
+            lines.append(f'heartbroken_phase_seconds_bucket{_format_labels((("phase", phase), ("le", bound)))} {cumulative}')
+
+        lines.append(f'heartbroken_phase_seconds_sum{_format_labels((("phase", phase),))} {histogram.sum}')
+        lines.append(f'heartbroken_phase_seconds_count{_format_labels((("phase", phase),))} {histogram.count}')
+
+    for name, help_text in _COUNTER_HELP.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+
+        for (counter_name, labels), value in sorted(_counters.items(), key=lambda item: str(item[0])):
+            if counter_name == name:
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+# ========
+def serve(port: int) -> 'http.server.HTTPServer':
+    """
+    Enables metrics and serves them at http://127.0.0.1:<port>/metrics from a background thread
+    """
+
+    # Most runs never serve metrics, so http.server is left out of startup
+    import http.server
+
+    class MetricsRequestHandler (http.server.BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+
+            body = render().encode('utf8')
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # ====
+        def log_message(self, format, *args) -> None:
+            # Mutes default console logging of requests
+            pass
+
+    enable()
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), MetricsRequestHandler)
+    server.daemon_threads = True
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
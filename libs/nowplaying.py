@@ -0,0 +1,227 @@
+"""
+Sources that tell the app loop when to check what is playing (heartbroken.py --now-playing).
+
+PollingSource is the default: the loop asks the Web API every SpotifyAPI.REQUEST_INTERVAL_SECONDS.
+
+MprisSource listens to the Spotify client on a Linux desktop instead, which announces every track change over MPRIS
+(D-Bus). The loop checks the Web API as soon as a PropertiesChanged signal comes in, once to learn the new track's
+album and artists (MPRIS only has their names) and again to skip it if it is disliked, and otherwise leaves the API
+alone. While the client isn't playing, which includes playing on another device, it polls like PollingSource does.
+
+MprisSource needs jeepney (pip install jeepney) and a session bus, and polls if either is missing.
+"""
+
+import logging
+import re
+import threading
+import typing
+
+if typing.TYPE_CHECKING:
+    from libs.spotifywrapper import Track
+
+
+SPOTIFY_BUS_NAME = 'org.mpris.MediaPlayer2.spotify'
+MPRIS_PATH       = '/org/mpris/MediaPlayer2'
+PLAYER_INTERFACE = 'org.mpris.MediaPlayer2.Player'
+
+# The Web API can lag behind the client by a moment after a change; until it agrees, polls come this often
+CATCH_UP_SECONDS = .25
+CATCH_UP_POLLS   = 8
+
+LISTEN_TIMEOUT_SECONDS = 1  # How often the listener thread checks whether it should stop
+
+logger = logging.getLogger(__name__)
+
+# 'spotify:track:<id>' from older clients, '/com/spotify/track/<id>' from newer ones
+track_id_regex = re.compile(r'[:/]track[:/]([A-Za-z0-9]+)$')
+
+
+# ========
+class PollingSource:
+    """
+    Polls the Web API at a fixed interval; what the loop did before there were sources
+    """
+
+    name = 'polling'
+
+    def start(self, on_change: typing.Callable[[], None]) -> None:
+        """
+        :on_change is called, from any thread, when has_changed() turns True
+        """
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    # ====
+    def has_changed(self) -> bool:
+        """
+        True once for every change seen since the last call; the loop then checks what is playing straight away
+        """
+        return False
+
+    # ====
+    def next_poll_delay(self, current_track: 'Track', delay: float) -> typing.Union[None, float]:
+        """
+        How long to wait before polling again after a poll found :current_track playing, :delay being the usual
+        interval. None means not until has_changed().
+        """
+        return delay
+
+# ========
+class MprisSource (PollingSource):
+    """
+    Follows the Spotify client's MPRIS signals on the D-Bus :bus ('SESSION', or an address) and polls only when
+    they report a change
+    """
+
+    name = 'mpris'
+
+    def __init__(self, bus: str = 'SESSION', bus_name: str = SPOTIFY_BUS_NAME):
+        self.bus      = bus
+        self.bus_name = bus_name
+
+        # What the client last reported
+        self.is_playing = False
+        self.track_id   = None
+
+        self._owner          = None  # Unique bus name of the client, which is what signals come from
+        self._connection     = None
+        self._changed        = threading.Event()
+        self._stopped        = threading.Event()
+        self._catch_up_polls = 0
+
+    # ========
+    def start(self, on_change: typing.Callable[[], None]) -> None:
+        try:
+            from jeepney import DBusAddress, MatchRule, MessageType, Properties, message_bus
+            from jeepney.io.blocking import open_dbus_connection
+        except ImportError:
+            logger.warning('Following the Spotify client over MPRIS needs jeepney (pip install jeepney), '
+                           'polling instead')
+            return
+
+        owner_changes = MatchRule(type='signal', sender='org.freedesktop.DBus', interface='org.freedesktop.DBus',
+                                  member='NameOwnerChanged', path='/org/freedesktop/DBus')
+        owner_changes.add_arg_condition(0, self.bus_name)
+
+        property_changes = MatchRule(type='signal', sender=self.bus_name, interface='org.freedesktop.DBus.Properties',
+                                     member='PropertiesChanged', path=MPRIS_PATH)
+        property_changes.add_arg_condition(0, PLAYER_INTERFACE)
+
+        try:
+            connection = open_dbus_connection(self.bus)
+
+            for rule in (owner_changes, property_changes):
+                connection.send_and_get_reply(message_bus.AddMatch(rule))
+
+            # An error reply means the client isn't running yet; NameOwnerChanged says when it is
+            reply = connection.send_and_get_reply(message_bus.GetNameOwner(self.bus_name))
+            if reply.header.message_type == MessageType.method_return:
+                self._owner = reply.body[0]
+
+                player = DBusAddress(MPRIS_PATH, bus_name=self._owner, interface=PLAYER_INTERFACE)
+                reply = connection.send_and_get_reply(Properties(player).get_all())
+                if reply.header.message_type == MessageType.method_return:
+                    self._update(reply.body[0])
+
+        except (OSError, KeyError, ValueError) as ex:
+            logger.warning('Could not follow the Spotify client over MPRIS (%s), polling instead', ex)
+            return
+
+        self._connection = connection
+        threading.Thread(target=self._listen, args=(connection, on_change), name='mpris', daemon=True).start()
+
+        client_state = 'not running' if self._owner is None else ('playing' if self.is_playing else 'not playing')
+        logger.info('Following the Spotify client over MPRIS (currently %s)', client_state)
+
+    # ====
+    def stop(self) -> None:
+        self._stopped.set()
+
+    # ====
+    def has_changed(self) -> bool:
+        if not self._changed.is_set():
+            return False
+
+        self._changed.clear()
+        return True
+
+    # ====
+    def next_poll_delay(self, current_track: 'Track', delay: float) -> typing.Union[None, float]:
+        # Whatever is playing isn't playing here, or MPRIS isn't available
+        if self._connection is None or not self.is_playing:
+            return delay
+
+        if current_track.id != self.track_id:
+            if self._catch_up_polls < CATCH_UP_POLLS:
+                self._catch_up_polls += 1
+                return CATCH_UP_SECONDS
+
+            # Something MPRIS and the Web API don't agree on, like an ad
+            return delay
+
+        return None
+
+    # ========
+    def _listen(self, connection, on_change: typing.Callable[[], None]) -> None:
+        from jeepney import HeaderFields
+
+        try:
+            while not self._stopped.is_set():
+                try:
+                    message = connection.receive(timeout=LISTEN_TIMEOUT_SECONDS)
+                except TimeoutError:
+                    continue
+
+                fields = message.header.fields
+                member = fields.get(HeaderFields.member, None)
+
+                if member == 'NameOwnerChanged':
+                    # The client started or quit; it signals what it plays once it starts
+                    self._owner = message.body[2] or None
+                    changed = self._update({'PlaybackStatus': ('s', 'Stopped'), 'Metadata': ('a{sv}', {})})
+
+                elif member == 'PropertiesChanged' and fields.get(HeaderFields.sender, None) == self._owner:
+                    changed = self._update(message.body[1])
+
+                else:
+                    changed = False
+
+                if changed:
+                    self._changed.set()
+                    on_change()
+
+        except (OSError, ValueError) as ex:
+            logger.warning('Lost the MPRIS connection to the Spotify client (%s), polling instead', ex)
+            self._connection = None
+            self._changed.set()
+            on_change()
+
+        finally:
+            connection.close()
+
+    # ====
+    def _update(self, properties: typing.Dict[str, typing.Tuple[str, typing.Any]]) -> bool:
+        """
+        Takes in the player's changed properties, as (signature, value) variants. Returns True if the playback
+        status or the track changed.
+        """
+
+        is_playing, track_id = self.is_playing, self.track_id
+
+        if 'PlaybackStatus' in properties:
+            is_playing = properties['PlaybackStatus'][1] == 'Playing'
+
+        if 'Metadata' in properties:
+            _, track_id = properties['Metadata'][1].get('mpris:trackid', (None, ''))
+            match = track_id_regex.search(track_id)
+            track_id = None if match is None else match.group(1)
+
+        if (is_playing, track_id) == (self.is_playing, self.track_id):
+            return False
+
+        self.is_playing, self.track_id = is_playing, track_id
+        self._catch_up_polls = 0
+
+        return True
@@ -0,0 +1,54 @@
+"""
+The local web server that receives Spotify's OAuth callback. Only imported while the OAuth flow runs.
+"""
+
+import http.server
+import multiprocessing
+import typing
+
+
+# ========
+def run_server(auth_queue: multiprocessing.Queue) -> typing.NoReturn:
+    """
+    Waits for a connection, gets the access token token from the request, then tosses it in the auth queue.
+    This thread should be laid to rest once the queue has an item.
+    """
+
+    httpd = _QueuingHTTPServer(('127.0.0.1', 8551), _AuthRequestHandler, auth_queue)
+
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+class _QueuingHTTPServer(http.server.HTTPServer):
+    """
+    Simple extension of http.server.HTTPServer that allows passing in a queue
+    """
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 queue: multiprocessing.Queue, bind_and_activate=True):
+        http.server.HTTPServer.__init__(self, server_address, RequestHandlerClass, bind_and_activate)
+        self.auth_queue = queue
+
+
+class _AuthRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Handles receipt of the OAuth token and returns an HTML page that will either exit on its own or instruct the user to do so.
+    """
+
+    def do_GET(self) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.end_headers()
+
+        # Depending on the browser this may or may not auto-close the window after auth has finished.
+        self.wfile.write(bytes('<!DOCTYPE html><html><head><script>window.close();</script><style>*{background-color:black;color:white;font-size:24pt;}</head><body>Authentication complete. You may close this page.</body></html>', 'utf8'))
+
+        self.server.auth_queue.put(self.path.strip('/callback?code='))
+
+    # ========
+    def log_message(self, format, *args) -> None:
+        # Mutes default console logging of requests
+        pass
@@ -0,0 +1,97 @@
+import io
+import logging
+import time
+import typing
+
+
+PROFILE_REPORT_LINES = 40  # Functions listed in the text report next to each .prof
+MEMORY_REPORT_LINES  = 25  # Allocation sites listed in each memory report
+TRACEMALLOC_FRAMES   = 10
+
+logger = logging.getLogger(__name__)
+
+_profiler        = None
+_profile_ends_at = None
+_memory_baseline = None
+
+
+# ========
+def start_profile(seconds: float) -> None:
+    """
+    Starts profiling the calling thread. finish_profile_if_due() must be called from that same thread to stop it.
+    """
+
+    global _profiler, _profile_ends_at
+
+    import cProfile
+
+    if _profiler is not None:
+        logger.warning('A profile is already being recorded')
+        return
+
+    _profiler = cProfile.Profile()
+    _profile_ends_at = time.monotonic() + seconds
+    _profiler.enable()
+
+    logger.info('Profiling the app loop for %g seconds...', seconds)
+
+# ====
+def finish_profile_if_due() -> typing.Union[None, str]:
+    """
+    Stops the running profile once its time is up and writes it out as a .prof file (for snakeviz, pstats, etc.) with
+    a plain text summary next to it. Returns the path of the .prof, or None if nothing was written.
+    """
+
+    global _profiler, _profile_ends_at
+
+    if _profiler is None or time.monotonic() < _profile_ends_at:
+        return None
+
+    import pstats
+
+    _profiler.disable()
+
+    path = time.strftime('heartbroken_profile_%Y%m%d-%H%M%S.prof')
+    _profiler.dump_stats(path)
+
+    summary = io.StringIO()
+    pstats.Stats(_profiler, stream=summary).sort_stats('cumulative').print_stats(PROFILE_REPORT_LINES)
+    with open(path[:-len('.prof')] + '.txt', 'w') as f:
+        f.write(summary.getvalue())
+
+    _profiler = None
+    _profile_ends_at = None
+
+    return path
+
+# ========
+def memory_snapshot() -> typing.Union[None, str]:
+    """
+    The first call starts tracemalloc and takes a baseline snapshot. Every call after that writes the allocation
+    sites that grew the most since the baseline to a text report and returns its path.
+    """
+
+    global _memory_baseline
+
+    import tracemalloc
+
+    if _memory_baseline is None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+
+        _memory_baseline = tracemalloc.take_snapshot()
+        return None
+
+    snapshot = tracemalloc.take_snapshot()
+    differences = snapshot.compare_to(_memory_baseline, 'lineno')
+    current, peak = tracemalloc.get_traced_memory()
+
+    path = time.strftime('heartbroken_memory_%Y%m%d-%H%M%S.txt')
+    with open(path, 'w') as f:
+        print(f'Traced memory: {current / 1024:.1f} KiB now, {peak / 1024:.1f} KiB peak', file=f)
+        print(f'Top {MEMORY_REPORT_LINES} allocation sites by growth since the baseline:\n', file=f)
+
+        for difference in differences[:MEMORY_REPORT_LINES]:
+            print(difference, file=f)
+
+    return path
@@ -30,12 +30,14 @@ class SysTrayIcon(object):
                  hover_text,
                  menu_options,
                  on_quit=None,
+                 on_menu=None,
                  default_menu_index=None,
                  window_class_name=None):
         
         self.icon = icon
         self.hover_text = hover_text
         self.on_quit = on_quit
+        self.on_menu = on_menu
 
         menu_options += ( ('Quit', self.QUIT, True), )
         
@@ -170,6 +172,8 @@ class SysTrayIcon(object):
         
     # ----
     def show_menu(self):
+        if not self.on_menu is None: self.on_menu(self)
+
         menu = win32gui.CreatePopupMenu()
         self.create_menu(menu, self.menu_options)
         
@@ -0,0 +1,400 @@
+"""
+Record-and-replay of Spotify player sessions.
+
+Recording (`heartbroken.py --record-trace PATH`) writes every player request the app loop makes, and its response,
+to a JSON lines trace file. Replaying (`python -m libs.replay PATH`) runs the unmodified app loop against that trace
+with the HTTP layer and the clock swapped out, so a full day of listening can be reproduced in seconds and polling
+strategies can be compared by their skip latency and API call counts.
+
+Replay uses the dislikes in heartbroken.db in the current directory.
+"""
+
+import argparse
+import bisect
+import collections
+import contextlib
+import io
+import json
+import sys
+import threading
+import time
+import typing
+import urllib.parse
+
+from libs import leakage, logs, utils
+from libs.clock import SystemClock, VirtualClock
+from libs.spotifywrapper import SpotifyWrapper
+
+
+TRACE_FORMAT  = 'heartbroken-trace'
+TRACE_VERSION = 1
+
+
+# ========
+def _endpoint(url: str) -> str:
+    """
+    Strips the scheme, host, and API version from a request URL: https://api.spotify.com/v1/me/player -> /me/player
+    """
+
+    path = urllib.parse.urlsplit(url).path
+    return path[3:] if path.startswith('/v1/') else path
+
+# ====
+def _compact_player_payload(body: typing.Union[dict, None]) -> typing.Union[dict, None]:
+    """
+    Keeps only the parts of a player response that Track reads, which keeps a day-long trace to a few megabytes
+    """
+
+    if type(body) != dict:
+        return body
+
+    compact = {key: body[key] for key in ('is_playing', 'progress_ms', 'currently_playing_type') if key in body}
+
+    item = body.get('item', None)
+    if type(item) == dict:
+        compact['item'] = {
+            'id':          item.get('id', None),
+            'name':        item.get('name', None),
+            'type':        item.get('type', None),
+            'duration_ms': item.get('duration_ms', None),
+            'album':       {'id':   utils._deep_get(item, ('album', 'id'),   None),
+                            'name': utils._deep_get(item, ('album', 'name'), None)},
+            'artists':     [{'id': a.get('id', None), 'name': a.get('name', None)} for a in item.get('artists', [])]
+        }
+
+    return compact
+
+# ========
+class TraceRecorder:
+    """
+    Appends request/response events to a trace file, timestamped relative to the start of the recording
+    """
+
+    def __init__(self, trace_path: str, clock=SystemClock):
+        self.clock      = clock
+        self.started_at = clock.time()
+
+        self.last_track_id = None
+
+        self._file = open(trace_path, 'w')
+        self._write({'format': TRACE_FORMAT, 'version': TRACE_VERSION, 'started_at': self.started_at})
+
+    # ====
+    def record(self, method: str, url: str, response) -> None:
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+
+        path = _endpoint(url)
+        if path == '/me/player/currently-playing':
+            body = _compact_player_payload(body)
+            self.last_track_id = utils._deep_get(body, ('item', 'id'), None)
+
+        self._write({
+            't':        round(self.clock.time() - self.started_at, 3),
+            'method':   method,
+            'path':     path,
+            'status':   response.status_code,
+            'track_id': self.last_track_id,
+            'body':     body
+        })
+
+    # ====
+    def _write(self, event: dict) -> None:
+        # Flushed every time so that a trace survives the app being killed
+        self._file.write(json.dumps(event, separators=(',', ':')) + '\n')
+        self._file.flush()
+
+# ====
+class _RecordingSession:
+    """
+    Stands in front of an OAuth session and records everything that goes through it
+    """
+
+    def __init__(self, session, recorder: TraceRecorder):
+        self._session = session
+        self._recorder = recorder
+
+    def get(self, url, *args, **kwargs):
+        return self._request('GET', url, self._session.get(url, *args, **kwargs))
+
+    def post(self, url, *args, **kwargs):
+        return self._request('POST', url, self._session.post(url, *args, **kwargs))
+
+    def put(self, url, *args, **kwargs):
+        return self._request('PUT', url, self._session.put(url, *args, **kwargs))
+
+    def _request(self, method, url, response):
+        self._recorder.record(method, url, response)
+        return response
+
+# ====
+class RecordingSpotifyWrapper (SpotifyWrapper):
+    """
+    SpotifyWrapper that records all of its API traffic to :trace_path
+    """
+
+    def __init__(self, trace_path: str, clock=SystemClock):
+        super().__init__(clock)
+        self.recorder = TraceRecorder(trace_path, clock)
+
+    # ====
+    def initialize_spotify_client(self, margin_seconds: float = 1):
+        client = super().initialize_spotify_client(margin_seconds)
+
+        if client is None or client == -1:
+            return client
+
+        self.client = _RecordingSession(client, self.recorder)
+        return self.client
+
+# ========
+class Trace:
+    """
+    A loaded trace file, indexed for lookups by time
+    """
+
+    def __init__(self, trace_path: str):
+        self.path = trace_path
+
+        self.times     = []  # Timestamps of currently-playing responses, ascending
+        self.responses = []  # (status, body) for each of the above
+        self.track_ids = []
+
+        # Recorded skip outcomes by the track that was being skipped
+        self.skip_statuses = {}
+
+        with open(trace_path) as f:
+            header = json.loads(f.readline())
+            if header.get('format', None) != TRACE_FORMAT:
+                raise ValueError(f'{trace_path} is not a Heartbroken trace file')
+
+            for line in f:
+                event = json.loads(line)
+
+                if event['path'] == '/me/player/currently-playing':
+                    self.times.append(event['t'])
+                    self.responses.append((event['status'], event['body']))
+                    self.track_ids.append(utils._deep_get(event['body'], ('item', 'id'), None))
+
+                elif event['path'] == '/me/player/next' and event['track_id'] is not None:
+                    self.skip_statuses[event['track_id']] = event['status']
+
+        self.duration = self.times[-1] if len(self.times) > 0 else 0
+
+        # For every response: when the track in it started showing up, and the first response with a different track
+        self.run_starts = []
+        self.next_runs  = [None] * len(self.times)
+
+        for index, track_id in enumerate(self.track_ids):
+            if index > 0 and self.track_ids[index - 1] == track_id:
+                self.run_starts.append(self.run_starts[-1])
+            else:
+                self.run_starts.append(self.times[index])
+
+        for index in range(len(self.times) - 2, -1, -1):
+            if self.track_ids[index + 1] != self.track_ids[index]:
+                self.next_runs[index] = index + 1
+            else:
+                self.next_runs[index] = self.next_runs[index + 1]
+
+# ====
+class _ReplayResponse:
+    """
+    The parts of requests.Response that SpotifyWrapper uses
+    """
+
+    def __init__(self, status_code: int, body: typing.Any = None):
+        self.status_code = status_code
+        self._body = body
+        self.text = '' if body is None else json.dumps(body)
+
+    def json(self) -> typing.Any:
+        if self._body is None:
+            raise json.JSONDecodeError('Expecting value', '', 0)
+        return self._body
+
+# ====
+class ReplaySession:
+    """
+    Answers player requests from a Trace instead of the Spotify API.
+
+    Requests are mapped onto the trace by the clock: a poll sees the last response recorded at or before that point,
+    with its progress moved forward to match. Skipping jumps ahead to the next track that was recorded, so a build
+    that skips faster than the recorded one gets through the session sooner.
+    """
+
+    def __init__(self, trace: Trace, clock: VirtualClock, finished: threading.Event):
+        self.trace    = trace
+        self.clock    = clock
+        self.finished = finished
+
+        self._offset = trace.times[0] - clock.time() if len(trace.times) > 0 else 0
+
+        self.api_calls         = collections.Counter()
+        self.skip_latencies_ms = []
+
+    # ====
+    def get(self, url, *args, **kwargs):
+        return self._request('GET', url)
+
+    def post(self, url, *args, **kwargs):
+        return self._request('POST', url)
+
+    def put(self, url, *args, **kwargs):
+        return self._request('PUT', url)
+
+    # ====
+    def _trace_time(self) -> float:
+        trace_time = self.clock.time() + self._offset
+
+        if trace_time > self.trace.duration:
+            self.finished.set()
+
+        return trace_time
+
+    # ====
+    def _request(self, method: str, url: str) -> _ReplayResponse:
+        path = _endpoint(url)
+        self.api_calls[f'{method} {path}'] += 1
+
+        trace_time = self._trace_time()
+        index = bisect.bisect_right(self.trace.times, trace_time) - 1
+
+        if path == '/me/player/currently-playing':
+            return self._currently_playing(index, trace_time)
+
+        if path == '/me/player/next':
+            return self._skip(index, trace_time)
+
+        if path == '/me/player/devices':
+            return self._devices(index)
+
+        return _ReplayResponse(204)
+
+    # ====
+    def _currently_playing(self, index: int, trace_time: float) -> _ReplayResponse:
+        if index < 0:
+            return _ReplayResponse(204)
+
+        status, body = self.trace.responses[index]
+
+        if status == 200 and type(body) == dict and body.get('is_playing', False):
+            elapsed_ms = int((trace_time - self.trace.times[index]) * 1000)
+            duration_ms = utils._deep_get(body, ('item', 'duration_ms'), None)
+
+            body = dict(body)
+            body['progress_ms'] = body.get('progress_ms', 0) + elapsed_ms
+            if duration_ms is not None:
+                body['progress_ms'] = min(body['progress_ms'], duration_ms)
+
+        return _ReplayResponse(status, body)
+
+    # ====
+    def _devices(self, index: int) -> _ReplayResponse:
+        """
+        The device list as the trace implies it: one device, active unless the last response said none was
+        """
+
+        is_active = index >= 0 and self.trace.responses[index][0] != 204
+        return _ReplayResponse(200, {'devices': [{'id': 'replay', 'name': 'Replay', 'is_active': is_active}]})
+
+    # ====
+    def _skip(self, index: int, trace_time: float) -> _ReplayResponse:
+        if index < 0:
+            return _ReplayResponse(204)
+
+        track_id = self.trace.track_ids[index]
+        self.skip_latencies_ms.append(int((trace_time - self.trace.run_starts[index]) * 1000))
+
+        next_index = self.trace.next_runs[index]
+        if next_index is None:
+            self._offset += self.trace.duration - trace_time
+            self.finished.set()
+        else:
+            self._offset += self.trace.times[next_index] - trace_time
+
+        return _ReplayResponse(self.trace.skip_statuses.get(track_id, 204))
+
+# ====
+class ReplaySpotifyWrapper (SpotifyWrapper):
+    """
+    SpotifyWrapper that talks to a ReplaySession and never needs credentials
+    """
+
+    def __init__(self, session: ReplaySession):
+        super().__init__(session.clock)
+        self.session = session
+
+    def initialize_spotify_client(self, margin_seconds: float = 1):
+        self.client = self.session
+        return self.client
+
+    def is_token_expired(self, margin_seconds: float = 1) -> bool:
+        return False
+
+# ========
+def replay(trace_path: str, speed: float = 0.0, verbose: bool = False) -> dict:
+    """
+    Runs the app loop against the trace at :trace_path and returns statistics about the run
+    """
+
+    import heartbroken
+    from libs.database import HeartbrokenDatabase
+
+    HeartbrokenDatabase.maybe_create_table()
+    leakage.reset()
+
+    clock    = VirtualClock(speed=speed)
+    finished = threading.Event()
+    session  = ReplaySession(Trace(trace_path), clock, finished)
+
+    app_loop_should_run = threading.Event()
+    app_loop_should_run.set()
+
+    wall_start = time.perf_counter()
+    cpu_start  = time.process_time()
+
+    with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+        exit_code = heartbroken.app_loop(app_loop_should_run, finished, ReplaySpotifyWrapper(session))
+
+    latencies = session.skip_latencies_ms
+
+    return {
+        'trace':             trace_path,
+        'exit_code':         exit_code,
+        'simulated_seconds': round(clock.time(), 3),
+        'wall_seconds':      round(time.perf_counter() - wall_start, 3),
+        'cpu_seconds':       round(time.process_time() - cpu_start, 3),
+        'api_calls':         dict(session.api_calls),
+        'api_calls_total':   sum(session.api_calls.values()),
+        'skips':             len(latencies),
+        'leaked_audio_ms':   leakage.summary(),
+        'skip_latency_ms':   {'p50': utils.percentile(latencies, .5),
+                              'p90': utils.percentile(latencies, .9),
+                              'p99': utils.percentile(latencies, .99),
+                              'max': max(latencies, default=None)}
+    }
+
+# ========
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Replay a Heartbroken trace through the app loop')
+    parser.add_argument('trace', help='Trace file recorded with heartbroken.py --record-trace')
+    parser.add_argument('--speed', type=float, default=0.0,
+                        help='Simulated seconds per real second; 0 (default) runs as fast as possible')
+    parser.add_argument('--verbose', action='store_true', help='Show the app loop\'s console output')
+    args = parser.parse_args()
+
+    if args.verbose:
+        logs.start(file_name=None)
+
+    report = replay(args.trace, args.speed, args.verbose)
+    logs.stop()
+
+    print(json.dumps(report, indent=2))
+    return 0
+
+# ====
+if __name__ == '__main__':
+    sys.exit(main())
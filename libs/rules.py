@@ -0,0 +1,378 @@
+"""
+Name rules: skipping tracks by what their name, album or artists say rather than by ID.
+
+Rules live in heartbroken_rules.json (next to heartbroken.db, or in each account's directory with --accounts):
+    [
+        {"field": "name",    "contains": "live"},
+        {"field": "name",    "contains": "8D audio"},
+        {"field": "name",    "regex": "\\\\bremix(ed)?\\\\b"},
+        {"field": "artists", "regex": "^DJ "},
+        {"field": "genres",  "contains": "hardstyle"},
+        {"feature": "speechiness", "above": 0.66}
+    ]
+
+:field is name, album or artists, matched against those attributes of spotifywrapper.Track; artists is the list as
+Heartbroken prints it, "A, B, and C". Matching ignores case. Regexes can't refer to their own groups (\\1), set flags
+for the whole pattern ((?i)) or share group names, as they are all combined into one.
+
+genres is every genre of the track's artists, "dance pop, electropop, ...", and :feature is one of
+metadata.AUDIO_FEATURES, compared with "above" or "below". Neither is part of Track: they come from libs.metadata's
+cache, and a rule that needs them doesn't match until the cache has them.
+
+Every "contains" goes into one Aho-Corasick automaton shared by the three fields, and the regexes of each field into
+one alternation, so a check costs a walk over the track's names whatever the number of rules. The file is compiled
+when it changes, and checked for changes at most every RELOAD_CHECK_SECONDS.
+"""
+
+import collections
+import json
+import logging
+import os
+import re
+import sys
+import time
+import typing
+
+from libs.metadata import AUDIO_FEATURES
+
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+
+if typing.TYPE_CHECKING:
+    from libs.metadata import MetadataCache
+    from libs.spotifywrapper import Track
+
+
+FIELDS = ('name', 'album', 'artists')
+METADATA_FIELDS = ('genres',)  # Fields that come from libs.metadata instead of Track
+
+RELOAD_CHECK_SECONDS = 5
+
+logger = logging.getLogger(__name__)
+
+
+# ========
+class Rule:
+    def __init__(self, field: str, kind: str, pattern: str = '', threshold: float = 0.0):
+        self.field     = field
+        self.kind      = kind  # 'contains' or 'regex', or 'above' or 'below' for audio features
+        self.pattern   = pattern
+        self.threshold = threshold  # Only for audio features
+
+    # ====
+    def __str__(self) -> str:
+        if self.kind in ('above', 'below'):
+            return f'{self.field} {self.kind} {self.threshold:g}'
+
+        return f'{self.field} {"contains" if self.kind == "contains" else "matches"} "{self.pattern}"'
+
+    # ====
+    @staticmethod
+    def from_json(rule_json: typing.Any) -> 'Rule':
+        """
+        Raises ValueError for anything that isn't a valid rule
+        """
+
+        if isinstance(rule_json, dict) and 'feature' in rule_json:
+            return Rule._feature_from_json(rule_json)
+
+        if not isinstance(rule_json, dict) or rule_json.get('field', None) not in FIELDS + METADATA_FIELDS:
+            raise ValueError(f'Expected a "field" out of {", ".join(FIELDS + METADATA_FIELDS)} '
+                             f'or a "feature": {rule_json!r}')
+
+        kinds = [kind for kind in ('contains', 'regex') if kind in rule_json]
+        if len(kinds) != 1 or not isinstance(rule_json[kinds[0]], str) or rule_json[kinds[0]] == '':
+            raise ValueError(f'Expected either "contains" or "regex" with some text: {rule_json!r}')
+
+        rule = Rule(rule_json['field'], kinds[0], rule_json[kinds[0]])
+
+        if rule.kind == 'regex':
+            try:
+                parsed = sre_parse.parse(rule.pattern)
+                re.compile(rule.pattern)
+            except re.error as ex:
+                raise ValueError(f'Invalid regex {rule.pattern!r}: {ex}') from None
+
+            # Once combined, a group number or name would point at whichever rule's group has it
+            if _refers_to_groups(parsed):
+                raise ValueError(f'Regexes can\'t refer to their own groups (\\1, (?P=name), (?(1)...)), as they are '
+                                 f'all combined into one: {rule.pattern!r}')
+
+        return rule
+
+    # ====
+    @staticmethod
+    def _feature_from_json(rule_json: dict) -> 'Rule':
+        if rule_json['feature'] not in AUDIO_FEATURES:
+            raise ValueError(f'Expected a "feature" out of {", ".join(AUDIO_FEATURES)}: {rule_json!r}')
+
+        kinds = [kind for kind in ('above', 'below') if kind in rule_json]
+        if len(kinds) != 1 or isinstance(rule_json[kinds[0]], bool) or \
+                not isinstance(rule_json[kinds[0]], (int, float)):
+            raise ValueError(f'Expected either "above" or "below" with a number: {rule_json!r}')
+
+        return Rule(rule_json['feature'], kinds[0], threshold=float(rule_json[kinds[0]]))
+
+# ====
+def _refers_to_groups(node: typing.Any) -> bool:
+    """
+    Whether a regex parsed by sre_parse has a backreference or a condition on a group anywhere in it
+    """
+
+    if isinstance(node, sre_parse.SubPattern):
+        node = node.data
+
+    if not isinstance(node, (list, tuple)):
+        return False
+
+    # Opcodes are singletons, which keeps them apart from the plain ints elsewhere in the tree
+    if len(node) == 2 and (node[0] is sre_parse.GROUPREF or node[0] is sre_parse.GROUPREF_EXISTS):
+        return True
+
+    return any(_refers_to_groups(item) for item in node)
+
+# ========
+class AhoCorasick:
+    """
+    Finds which of many literals occur in a text in one pass over the text. Each literal is tagged with the fields it
+    applies to, so one automaton serves them all.
+    """
+
+    def __init__(self, literals: typing.Iterable[typing.Tuple[str, str, Rule]]):
+        # One entry per state; state 0 is the root
+        self._goto   = [{}]    # Character -> next state
+        self._fail   = [0]     # Longest proper suffix of this state's text that is also a state
+        self._output = [{}]    # Field -> first rule ending here or at any suffix of it
+
+        for literal, field, rule in literals:
+            state = 0
+            for character in literal:
+                next_state = self._goto[state].get(character, None)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][character] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append({})
+                state = next_state
+
+            self._output[state].setdefault(field, rule)
+
+        # Breadth first, so every state's fail target is finished before the state itself
+        pending = collections.deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+
+            for character, next_state in self._goto[state].items():
+                pending.append(next_state)
+
+                fallback = self._fail[state]
+                while fallback and character not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+
+                self._fail[next_state] = self._goto[fallback].get(character, 0)
+                self._output[next_state] = {**self._output[self._fail[next_state]], **self._output[next_state]}
+
+    # ====
+    def search(self, text: str, field: str) -> typing.Union[None, Rule]:
+        """
+        The rule of the first literal for :field found in :text, which has to be lowercase
+        """
+
+        goto, fail, output = self._goto, self._fail, self._output
+
+        state = 0
+        for character in text:
+            while state and character not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(character, 0)
+
+            if output[state]:
+                rule = output[state].get(field, None)
+                if rule is not None:
+                    return rule
+
+        return None
+
+# ========
+class CompiledRules:
+    """
+    A list of rules compiled for matching. Raises ValueError if the regexes of a field can't be combined.
+    """
+
+    def __init__(self, rules: typing.Sequence[Rule]):
+        self.rules = list(rules)
+
+        self._literals = AhoCorasick((rule.pattern.lower(), rule.field, rule) for rule in rules
+                                     if rule.kind == 'contains')
+        self._has_literals = any(rule.kind == 'contains' for rule in rules)
+
+        self._regexes = {}  # Field -> (combined pattern, [(pattern, rule), ...])
+        for field in FIELDS + METADATA_FIELDS:
+            field_rules = [rule for rule in rules if rule.field == field and rule.kind == 'regex']
+            if field_rules:
+                try:
+                    combined = re.compile('|'.join(f'(?:{rule.pattern})' for rule in field_rules), re.IGNORECASE)
+                except re.error as ex:
+                    raise ValueError(f'Could not combine the {field} regexes, which can\'t set flags for the whole '
+                                     f'pattern or share group names: {ex}') from None
+
+                self._regexes[field] = (combined, [(re.compile(rule.pattern, re.IGNORECASE), rule)
+                                                   for rule in field_rules])
+
+        self._feature_rules = [rule for rule in rules if rule.kind in ('above', 'below')]
+
+        # What matching needs from libs.metadata, so the loops only fetch that
+        self.needs_genres   = any(rule.field in METADATA_FIELDS for rule in rules)
+        self.needs_features = bool(self._feature_rules)
+
+    # ====
+    def match(self, track: 'Track', metadata: typing.Union[None, 'MetadataCache'] = None) -> typing.Union[None, Rule]:
+        """
+        The first rule :track matches, if any. Rules on genres and audio features only match with :metadata, and
+        only once it has them.
+        """
+
+        for field in FIELDS:
+            rule = self._match_text(field, getattr(track, field, None))
+            if rule is not None:
+                return rule
+
+        if metadata is None:
+            return None
+
+        if self.needs_genres:
+            genres = metadata.genres(track.artist_ids or ())
+            rule = self._match_text('genres', ', '.join(genres)) if genres else None
+            if rule is not None:
+                return rule
+
+        if self.needs_features:
+            features = metadata.features(track.id) if track.id is not None else None
+            for rule in self._feature_rules if features else ():
+                value = features.get(rule.field, None)
+                if value is not None and (value > rule.threshold if rule.kind == 'above' else value < rule.threshold):
+                    return rule
+
+        return None
+
+    # ====
+    def _match_text(self, field: str, text: typing.Union[None, str]) -> typing.Union[None, Rule]:
+        if not text:
+            return None
+
+        if self._has_literals:
+            rule = self._literals.search(text.lower(), field)
+            if rule is not None:
+                return rule
+
+        regexes = self._regexes.get(field, None)
+        if regexes is not None and regexes[0].search(text) is not None:
+            # Which one it was only matters for the log, so only then are they tried one by one
+            return next(rule for pattern, rule in regexes[1] if pattern.search(text) is not None)
+
+        return None
+
+# ========
+class RuleSet:
+    """
+    The rules in :file_name, recompiled whenever the file changes. A file that's missing means no rules; one that
+    can't be read keeps the rules from before.
+    """
+
+    file_name = 'heartbroken_rules.json'
+
+    def __init__(self, file_name: typing.Union[None, str] = None):
+        self.file_name = file_name or RuleSet.file_name
+
+        self.compiled = CompiledRules([])
+
+        self._modified_at = None  # The file's mtime when it was last compiled
+        self._checked_at  = None
+
+    # ====
+    def match(self, track: 'Track', metadata: typing.Union[None, 'MetadataCache'] = None) -> typing.Union[None, Rule]:
+        now = time.monotonic()
+        if self._checked_at is None or now - self._checked_at >= RELOAD_CHECK_SECONDS:
+            self._checked_at = now
+            self.reload_if_changed()
+
+        if not self.compiled.rules:
+            return None
+
+        return self.compiled.match(track, metadata)
+
+    # ====
+    def reload_if_changed(self) -> bool:
+        """
+        Returns True if the rules were recompiled
+        """
+
+        try:
+            modified_at = os.stat(self.file_name).st_mtime_ns
+        except FileNotFoundError:
+            modified_at = None
+
+        if modified_at == self._modified_at:
+            return False
+
+        self._modified_at = modified_at
+
+        if modified_at is None:
+            self.compiled = CompiledRules([])
+            return True
+
+        try:
+            self.compiled = CompiledRules(load_rules(self.file_name))
+        except (OSError, ValueError) as ex:
+            logger.error('Could not load the rules in %s, keeping the ones from before: %s', self.file_name, ex)
+            return False
+
+        logger.info('Loaded %d rule(s) from %s', len(self.compiled.rules), self.file_name)
+        return True
+
+# ========
+def load_rules(file_name: str) -> typing.List[Rule]:
+    """
+    Raises OSError if the file can't be read and ValueError if it isn't a list of valid rules
+    """
+
+    with open(file_name, encoding='utf8') as f:
+        rules_json = json.load(f)
+
+    if not isinstance(rules_json, list):
+        raise ValueError('Expected a list of rules')
+
+    return [Rule.from_json(rule_json) for rule_json in rules_json]
+
+# ========
+def main() -> int:
+    """
+    Checks a rules file: python -m libs.rules [heartbroken_rules.json]
+    """
+
+    file_name = sys.argv[1] if len(sys.argv) > 1 else RuleSet.file_name
+
+    try:
+        rules = load_rules(file_name)
+        CompiledRules(rules)
+    except (OSError, ValueError) as ex:
+        print(f'{file_name}: {ex}')
+        return 1
+
+    counts = collections.Counter((rule.field, rule.kind) for rule in rules)
+    print(f'{file_name}: {len(rules)} rule(s)')
+    for field in FIELDS + METADATA_FIELDS:
+        print(f'    {field:8}{counts[field, "contains"]:>6} contains{counts[field, "regex"]:>6} regex')
+
+    feature_rules = [rule for rule in rules if rule.kind in ('above', 'below')]
+    if feature_rules:
+        print(f'    {len(feature_rules)} audio feature rule(s): {", ".join(map(str, feature_rules))}')
+
+    return 0
+
+# ====
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,389 @@
+"""
+Checks your Liked Songs and playlists against your dislikes and name rules ahead of time, so they can be cleaned up
+instead of skipped as they play:
+
+    python -m libs.scanner                          # Liked Songs and every playlist in your library
+    python -m libs.scanner --no-playlists           # Only Liked Songs
+    python -m libs.scanner --playlist URL [URL...]  # Only these playlists
+
+Every track Heartbroken would skip goes into heartbroken_scan.csv (--output) along with where it is and why, written
+as soon as its page has been checked.
+
+Pages are fetched by Pager, SCAN_CONCURRENCY at a time over one AsyncHTTPClient; once a 429 comes back, every request
+waits out its Retry-After. The rest of a playlist's pages are requested as soon as its first page says how many there
+are. Each page is checked with one query (HeartbrokenDatabase.are_heartbroken()) and dropped once it is written, and
+at most SCAN_CONCURRENCY pages wait to be checked, so memory stays flat however large the library is.
+
+Rules on genres and audio features only match tracks whose metadata Heartbroken has already seen (see libs.metadata);
+the scanner doesn't fetch it.
+
+Reading the library and playlists needs permissions that accounts connected before the scanner was added don't have;
+delete heartbroken_auth.json and run Heartbroken again to connect with them.
+"""
+
+import argparse
+import asyncio
+import collections
+import csv
+import logging
+import os
+import re
+import sys
+import time
+import typing
+import urllib.parse
+
+from libs import hbcontrol
+from libs.asynchttp import AsyncHTTPClient
+from libs.database import HeartbrokenDatabase
+from libs.rules import RuleSet
+from libs.spotifywrapper import SpotifyWrapper, Track
+
+
+SCAN_CONCURRENCY = 4  # Requests in flight at once
+MAX_ATTEMPTS     = 5  # Per page, counting retries after network errors, 429s and 5xxs
+
+DEFAULT_REPORT_FILE_NAME = 'heartbroken_scan.csv'
+
+# Only what the scan needs of each playlist entry, which is a fraction of the full response
+PLAYLIST_FIELDS = 'total,items(track(id,name,type,album(id,name),artists(id,name)))'
+
+# Links as Spotify shares them (https://open.spotify.com/playlist/<id>?si=..., spotify:playlist:<id>), or bare IDs
+link_regex = re.compile(r'^(?:(?:https?://open\.spotify\.com/|spotify:)(?:[\w-]+/)?'
+                        r'(album|artist|playlist|track)[:/])?([A-Za-z0-9]{22})(?:\?.*)?$')
+
+logger = logging.getLogger(__name__)
+
+
+# ========
+class Source:
+    """
+    Something paged through: :path is requested with &limit= and &offset= added on. :total is the number of items,
+    if known before the first page. Pages whose offsets are in :done_offsets are left out.
+    """
+
+    def __init__(self, name: str, path: str, page_size: int, total: typing.Union[None, int] = None,
+                 done_offsets: typing.Container[int] = ()):
+        self.name         = name
+        self.path         = path
+        self.page_size    = page_size
+        self.total        = total
+        self.done_offsets = done_offsets
+
+    # ====
+    @staticmethod
+    def liked_songs() -> 'Source':
+        return Source('Liked Songs', '/me/tracks?', 50)
+
+    # ====
+    @staticmethod
+    def playlist(playlist_id: str, name: typing.Union[None, str] = None,
+                 total: typing.Union[None, int] = None) -> 'Source':
+        fields = urllib.parse.quote(PLAYLIST_FIELDS, safe=',')
+        return Source(name or f'Playlist {playlist_id}', f'/playlists/{playlist_id}/tracks?fields={fields}', 100,
+                      total)
+
+    # ====
+    def page_path(self, offset: int) -> str:
+        separator = '' if self.path.endswith('?') else '&'
+        return f'{self.path}{separator}limit={self.page_size}&offset={offset}'
+
+# (source, offset, items), see Pager.pages()
+Page = typing.Tuple[Source, int, typing.Union[None, typing.List[dict]]]
+
+# ========
+class Pager:
+    """
+    Fetches pages of Spotify's paged endpoints with at most :concurrency requests in flight, backing off as told
+    when rate limited. Also expands links for bulk dislikes (see libs.bulkdislike).
+    """
+
+    def __init__(self, http: AsyncHTTPClient, access_token: str, concurrency: int = SCAN_CONCURRENCY):
+        self.http        = http
+        self.headers     = {'Authorization': f'Bearer {access_token}'}
+        self.concurrency = concurrency
+
+        self.requests_made = 0
+        self.rate_limited  = 0  # 429s received
+
+        self._resume_at = 0  # Event loop time before which nothing is sent, after a 429
+
+    # ========
+    async def get(self, path: str) -> typing.Tuple[typing.Union[None, int], typing.Any]:
+        """
+        Returns the status code and decoded body, retrying after 429s, 5xxs and network errors.
+        (None, None) if it never got through.
+        """
+
+        loop = asyncio.get_running_loop()
+
+        for attempt in range(MAX_ATTEMPTS):
+            while self._resume_at > loop.time():
+                await asyncio.sleep(self._resume_at - loop.time())
+
+            try:
+                self.requests_made += 1
+                response = await self.http.request('GET', path, self.headers)
+            except OSError as ex:
+                logger.warning('Network error while calling %s: %s', path, ex)
+                await asyncio.sleep(2 ** attempt / 2)
+                continue
+
+            if response.status_code == 429:
+                self.rate_limited += 1
+                try:
+                    retry_after = float(response.headers.get('retry-after', '1'))
+                except ValueError:
+                    retry_after = 1
+                self._resume_at = max(self._resume_at, loop.time() + retry_after)
+                continue
+
+            if response.status_code >= 500:
+                await asyncio.sleep(2 ** attempt / 2)
+                continue
+
+            try:
+                return response.status_code, response.json()
+            except ValueError:
+                return response.status_code, None
+
+        return None, None
+
+    # ====
+    async def pages(self, sources: typing.Iterable[Source]) -> typing.AsyncIterator[Page]:
+        """
+        Yields (source, offset, items) for every page of every source, in whatever order they arrive; items is None
+        for a page that couldn't be fetched. Pages are only fetched while there is room for them to wait, so a slow
+        consumer holds up the fetching rather than pages piling up.
+        """
+
+        pending = collections.deque()
+        for source in sources:
+            offsets = [0] if source.total is None else range(0, source.total, source.page_size)
+            pending.extend((source, offset) for offset in offsets if offset not in source.done_offsets)
+
+        outstanding = len(pending)  # Pages queued or in flight that haven't been yielded yet
+        results = asyncio.Queue(maxsize=self.concurrency)
+        wake = asyncio.Event()
+
+        async def fetch_pages():
+            nonlocal outstanding
+
+            while True:
+                while not pending:
+                    await wake.wait()
+                    wake.clear()
+
+                source, offset = pending.popleft()
+                status_code, body = await self.get(source.page_path(offset))
+
+                items = None
+                if status_code == 200 and isinstance(body, dict):
+                    items = body.get('items', None) or []
+
+                    # Only the first page says how many more there are
+                    if source.total is None:
+                        source.total = body.get('total', None) or 0
+                        more = [(source, later) for later in range(source.page_size, source.total, source.page_size)
+                                if later not in source.done_offsets]
+                        pending.extend(more)
+                        outstanding += len(more)
+                        wake.set()
+
+                elif status_code == 403:
+                    logger.error('Not allowed to read %s; if this is your own, connect the account again', source.name)
+
+                elif status_code is not None:
+                    logger.error('Could not read %s (HTTP %s): %s', source.name, status_code, body)
+
+                await results.put((source, offset, items))
+
+        workers = [asyncio.ensure_future(fetch_pages()) for _ in range(self.concurrency)]
+        try:
+            while outstanding:
+                page = await results.get()
+                outstanding -= 1
+                yield page
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    # ====
+    async def items(self, source: Source) -> typing.List[dict]:
+        """
+        Every item of :source, for sources small enough to hold at once
+        """
+
+        items = []
+        async for _, _, page in self.pages([source]):
+            items.extend(page or ())
+        return items
+
+# ========
+async def library_playlists(pager: Pager) -> typing.List[Source]:
+    """
+    The playlists in the library, created or followed
+    """
+
+    playlists = await pager.items(Source('Your playlists', '/me/playlists?', 50))
+
+    return [Source.playlist(playlist['id'], playlist.get('name', None),
+                            (playlist.get('tracks', None) or {}).get('total', None))
+            for playlist in playlists if playlist is not None and playlist.get('id', None) is not None]
+
+# ====
+def page_tracks(offset: int, items: typing.Iterable[dict]) -> typing.List[typing.Tuple[int, Track]]:
+    """
+    The tracks on a page of Liked Songs or a playlist, numbered from 1 by position; removed tracks, local files and
+    podcast episodes are left out
+    """
+
+    tracks = []
+    for position, item in enumerate(items, offset + 1):
+        track_json = (item or {}).get('track', None)
+        if not track_json or track_json.get('type', 'track') != 'track' or track_json.get('id', None) is None:
+            continue
+        tracks.append((position, Track({'item': track_json, 'is_playing': True})))
+
+    return tracks
+
+# ========
+async def scan(sources: typing.Sequence[Source], report: typing.TextIO, pager: Pager,
+               database_file_name: typing.Union[None, str] = None,
+               rule_set: typing.Union[None, RuleSet] = None) -> collections.Counter:
+    """
+    Checks every track of :sources and writes the ones Heartbroken would skip to :report, as CSV.
+    Returns counts of tracks, pages, pages that failed, and skips by reason.
+    """
+
+    loop = asyncio.get_running_loop()
+    counts = collections.Counter()
+
+    writer = csv.writer(report)
+    writer.writerow(('source', 'position', 'reason', 'track', 'artists', 'album', 'url'))
+
+    async for source, offset, items in pager.pages(sources):
+        if items is None:
+            counts['failed pages'] += 1
+            continue
+
+        counts['pages'] += 1
+
+        tracks = page_tracks(offset, items)
+        verdicts = await loop.run_in_executor(None, HeartbrokenDatabase.are_heartbroken, [track for _, track in tracks],
+                                              database_file_name)
+
+        for (position, track), verdict in zip(tracks, verdicts):
+            counts['tracks'] += 1
+
+            is_heartbroken, what_heartbroken = hbcontrol.apply_rules(track, verdict, rule_set)
+            if not is_heartbroken:
+                continue
+
+            counts[what_heartbroken] += 1
+            reason = f'matches {track.matched_rule}' if what_heartbroken == 'rule' else f'disliked {what_heartbroken}'
+            writer.writerow((source.name, position, reason, track.name, track.artists, track.album, track.url))
+
+        report.flush()
+
+    return counts
+
+# ====
+async def run_scan(access_token: str, sources: typing.Union[None, typing.Sequence[Source]], liked_songs: bool,
+                   report_file_name: str, database_file_name: typing.Union[None, str] = None,
+                   rule_set: typing.Union[None, RuleSet] = None, concurrency: int = SCAN_CONCURRENCY,
+                   api_url: str = SpotifyWrapper.api_url) -> int:
+    """
+    Scans :sources, or every playlist in the library if None, plus Liked Songs with :liked_songs
+    """
+
+    started = time.perf_counter()
+
+    http = AsyncHTTPClient(api_url, max_connections=concurrency)
+    pager = Pager(http, access_token, concurrency)
+
+    try:
+        sources = list(await library_playlists(pager) if sources is None else sources)
+        if liked_songs:
+            sources.insert(0, Source.liked_songs())
+
+        print(f'Scanning {len(sources)} source(s)...')
+
+        with open(report_file_name, 'w', newline='', encoding='utf8') as report:
+            counts = await scan(sources, report, pager, database_file_name, rule_set)
+
+    finally:
+        await http.close()
+
+    skips = sum(counts[reason] for reason in ('track', 'album', 'artist', 'rule'))
+    print(f'Checked {counts["tracks"]} track(s) on {counts["pages"]} page(s) in {time.perf_counter() - started:.1f}s'
+          f' ({pager.requests_made} requests, {pager.rate_limited} rate limited)')
+    print(f'{skips} would be skipped: {counts["track"]} disliked tracks, {counts["album"]} from disliked albums, '
+          f'{counts["artist"]} from disliked artists, {counts["rule"]} matching rules')
+    print(f'Wrote them to {os.path.abspath(report_file_name)}')
+
+    if counts['failed pages']:
+        print(f'{counts["failed pages"]} page(s) could not be read, the report is missing their tracks')
+        return 1
+
+    return 0
+
+# ========
+def main() -> int:
+    from libs import logs
+    from libs.accounts import DEFAULT_ACCOUNTS_DIRECTORY, AccountRegistry
+
+    # What the libraries log (rules loaded, database errors) goes to the console, as the rest of the output does
+    logging.basicConfig(level=logging.INFO, format=logs.CONSOLE_FORMAT, stream=sys.stdout)
+
+    parser = argparse.ArgumentParser(description='Find the tracks in your library and playlists that Heartbroken '
+                                                 'would skip')
+    parser.add_argument('--playlist', nargs='+', default=None, metavar='URL',
+                        help='Scan these playlists instead of every one in your library')
+    parser.add_argument('--no-playlists', action='store_true', help='Only scan Liked Songs')
+    parser.add_argument('--no-liked-songs', action='store_true', help="Don't scan Liked Songs")
+    parser.add_argument('--output', default=DEFAULT_REPORT_FILE_NAME,
+                        help=f'Where to write the report (default ./{DEFAULT_REPORT_FILE_NAME})')
+    parser.add_argument('--concurrency', type=int, default=SCAN_CONCURRENCY,
+                        help=f'Requests in flight at once (default {SCAN_CONCURRENCY})')
+    parser.add_argument('--account', default=None, help='Scan for this account of heartbroken.py --accounts')
+    parser.add_argument('--directory', default=DEFAULT_ACCOUNTS_DIRECTORY,
+                        help=f'Where the accounts are kept (default ./{DEFAULT_ACCOUNTS_DIRECTORY})')
+    args = parser.parse_args()
+
+    sources = None
+    if args.no_playlists:
+        sources = []
+
+    elif args.playlist is not None:
+        sources = []
+        for link in args.playlist:
+            match = link_regex.match(link.strip())
+            if match is None or match.group(1) not in (None, 'playlist'):
+                parser.error(f'Not a playlist link: {link}')
+            sources.append(Source.playlist(match.group(2)))
+
+    credentials_file_name = database_file_name = None
+    rule_set = hbcontrol.default_rules
+
+    if args.account is not None:
+        account = AccountRegistry(args.directory).get(args.account)
+        if account is None:
+            print(f'No account named "{args.account}"')
+            return 1
+
+        credentials_file_name = account.credentials_file_name
+        database_file_name = account.database_file_name
+        rule_set = RuleSet(os.path.join(account.directory, RuleSet.file_name))
+
+    client = SpotifyWrapper(credentials_file_name=credentials_file_name).initialize_spotify_client()
+    if client is None or client == -1:
+        print('Could not connect to Spotify; run Heartbroken once to connect your account')
+        return 1
+
+    return asyncio.run(run_scan(client.access_token, sources, not args.no_liked_songs, args.output,
+                                database_file_name, rule_set, args.concurrency))
+
+# ====
+if __name__ == '__main__':
+    sys.exit(main())
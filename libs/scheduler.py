@@ -0,0 +1,98 @@
+import heapq
+import itertools
+import threading
+import typing
+
+from libs.clock import SystemClock
+
+
+# ========
+class Scheduler:
+    """
+    Runs callbacks at given times on one thread, from a heap of timers. Between timers it waits on an Event rather
+    than sleeping, so wake() (from any thread or, through a control queue, any process) gets the loop's attention
+    immediately instead of when the current wait would have ended.
+
+    All times are by :clock, so replays and benchmarks can drive the scheduler with a VirtualClock.
+    """
+
+    def __init__(self, clock=SystemClock):
+        self.clock = clock
+
+        self._timers  = []  # Heap of (due, sequence, name, callback)
+        self._counter = itertools.count()  # Tie-breaker that keeps timers due at the same time in order
+        self._wake_event = threading.Event()
+
+    # ====
+    def call_later(self, delay: float, name: str, callback: typing.Callable[[], None]) -> None:
+        """
+        Runs :callback after :delay seconds. :name identifies the timer for cancel() and in the timeline.
+        """
+
+        heapq.heappush(self._timers, (self.clock.time() + delay, next(self._counter), name, callback))
+
+    # ====
+    def cancel(self, name: str) -> None:
+        self._timers = [timer for timer in self._timers if timer[2] != name]
+        heapq.heapify(self._timers)
+
+    # ====
+    def is_scheduled(self, name: str) -> bool:
+        return any(timer[2] == name for timer in self._timers)
+
+    # ====
+    def run_due(self) -> None:
+        """
+        Runs every callback whose time has come, in order. Callbacks may schedule more timers.
+        """
+
+        now = self.clock.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, _, callback = heapq.heappop(self._timers)
+            callback()
+
+    # ====
+    def seconds_until_next(self) -> typing.Union[None, float]:
+        if not self._timers:
+            return None
+        return max(0.0, self._timers[0][0] - self.clock.time())
+
+    # ========
+    def wait(self, max_seconds: float, timers: bool = True) -> bool:
+        """
+        Waits until the next timer is due, wake() is called, or :max_seconds pass, whichever is first.
+        Returns True if it was woken. Without :timers, only wake() and :max_seconds end the wait, for while the
+        timers aren't being run; one that is overdue would otherwise end every wait straight away.
+        """
+
+        timeout = self.seconds_until_next() if timers else None
+        timeout = max_seconds if timeout is None else min(timeout, max_seconds)
+
+        woken = self.clock.wait(self._wake_event, timeout)
+        self._wake_event.clear()
+
+        return woken
+
+    # ====
+    def wake(self) -> None:
+        """
+        Thread-safe; cuts the current or next wait() short
+        """
+        self._wake_event.set()
+
+# ========
+def forward_control_messages(control_queue, inbox, scheduler: Scheduler) -> threading.Thread:
+    """
+    Starts a thread that moves messages from :control_queue (which may be a multiprocessing.Queue fed by another
+    process) to :inbox and wakes :scheduler for each, so the loop never has to poll the queue
+    """
+
+    def forward():
+        while True:
+            inbox.put(control_queue.get())
+            scheduler.wake()
+
+    thread = threading.Thread(target=forward, name='control queue', daemon=True)
+    thread.start()
+
+    return thread
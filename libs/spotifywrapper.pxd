@@ -0,0 +1,24 @@
+# Augments spotifywrapper.py when it is compiled by buildtools/cython_setup.py; ignored by the interpreted build.
+# Every attribute set on a Track, here or elsewhere, has to be declared below.
+
+cdef class Track:
+    cdef public object _data
+    cdef public object _track_data
+
+    cdef public bint is_playing
+    cdef public long long time_remaining_ms
+    cdef public long long progress_ms
+
+    cdef public object name
+    cdef public object id
+    cdef public object url
+    cdef public object type
+    cdef public object album
+    cdef public object album_id
+    cdef public object artists
+    cdef public list artist_ids
+
+    cdef public object track_heartbroken
+    cdef public object album_heartbroken
+    cdef public object artist_heartbroken
+    cdef public object matched_rule
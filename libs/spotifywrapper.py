@@ -1,13 +1,18 @@
+# cython: boundscheck=False, wraparound=False
 import json
-import time
+import logging
 import typing
 
 import requests_oauthlib
 
-from libs import constants, utils
+from libs import constants, idle, metrics, utils
+from libs.clock import SystemClock
 from libs.tokenhandler import TokenHandler, OAuthManager
 
 
+logger = logging.getLogger(__name__)
+
+
 class Track:
     """
     Wrapper for data related to Spotify tracks
@@ -19,7 +24,8 @@ class Track:
 
         self.is_playing = self._data.get('is_playing', False)
         if self.is_playing == False or self._track_data is None:
-            self._time_remaining_ms = -1
+            self.time_remaining_ms = -1
+            self.progress_ms = 0
             self.name = None
             self.id = None
             self.url = None
@@ -32,6 +38,7 @@ class Track:
         else:
             self.time_remaining_ms = self._track_data.get('duration_ms', -1) - self._data.get('progress_ms', 0) \
                                      if self.is_playing == True else -1
+            self.progress_ms = self._data.get('progress_ms', None) or 0
 
             self.name       = self._track_data.get('name', None)
             self.id         = self._track_data.get('id',   None)
@@ -48,6 +55,7 @@ class Track:
         self.track_heartbroken  = None
         self.album_heartbroken  = None
         self.artist_heartbroken = None
+        self.matched_rule       = None  # The name rule it was skipped for, see libs.rules
 
     # ====
     def __str__(self) -> str:
@@ -68,14 +76,18 @@ class Track:
         Turns an array of artist names into a English list
         """
 
-        artists = [a for a in artists if type(a) == str and a != '']
+        artists = [a for a in artists if type(a) is str and a != '']
+        count   = len(artists)
 
-        if len(artists) == 1:
+        # No negative indexing, wraparound is off for the compiled build (see top of file)
+        if count == 0:
+            return ''
+        if count == 1:
             return artists[0]
-        if len(artists) == 2:
-            return ' and '.join(artists)
+        if count == 2:
+            return artists[0] + ' and ' + artists[1]
         else:
-            return ', '.join(artists[:-1]) + ', and ' + artists[-1]
+            return ', '.join(artists[:count - 1]) + ', and ' + artists[count - 1]
 
 # ========
 class SpotifyWrapper:
@@ -85,26 +97,40 @@ class SpotifyWrapper:
 
     api_url = "https://api.spotify.com/v1"
 
-    def __init__(self):
+    def __init__(self, clock=SystemClock, credentials_file_name: typing.Union[None, str] = None):
         self.client_id = TokenHandler.client_id
+        self.clock     = clock  # Anything with time(), sleep() and wait(), see libs.clock
+
+        # Which account's tokens to use; None is the default credentials file (see libs.accounts)
+        self.credentials_file_name = credentials_file_name
 
-        self.client  = None
-        self.backoff = SpotifyWrapper.not_playing_backoff()
-        self.backing_off = False
+        self.client = None
+
+        # What the last poll saw: idle.PLAYING, idle.PAUSED or idle.INACTIVE, or None if it failed
+        self.player_state = None
 
         self.previous_track = None
         self.current_track  = None
 
+        # When Spotify last accepted a skip, by self.clock
+        self.skip_confirmed_at = None
+
+        # Until when, by self.clock, what Spotify says is playing may still be the track it was just told to skip
+        self.settles_at = None
+
+        # Tracks skipped one after the other since something that isn't disliked played, see hbcontrol
+        self.skipped_track_ids = set()
+
     # ====
-    def initialize_spotify_client(self) -> typing.Union[None, int, requests_oauthlib.OAuth2Session]:
+    def initialize_spotify_client(self, margin_seconds: float = 1) -> typing.Union[None, int, requests_oauthlib.OAuth2Session]:
         """
         Refreshes the access token and returns an OAuth instance on success, None if the refresh failed, or -1
-        if something went wrong with the OAuth server
+        if something went wrong with the OAuth server. :margin_seconds is passed on to TokenHandler.refresh_access_token()
 
         Side effect: initializes self.client (duh ;))
         """
 
-        access_token = TokenHandler.refresh_access_token()
+        access_token = TokenHandler.refresh_access_token(margin_seconds, self.credentials_file_name)
 
         if access_token is None:
             return None
@@ -116,6 +142,13 @@ class SpotifyWrapper:
 
         return self.client
 
+    # ====
+    def is_token_expired(self, margin_seconds: float = 1) -> bool:
+        """
+        Returns a boolean indicating if the client's access token needs to be refreshed
+        """
+        return TokenHandler.is_token_expired(margin_seconds, self.credentials_file_name)
+
    # ====
     def needs_initialized_client(func: typing.Callable) -> typing.Callable:
         """
@@ -124,7 +157,7 @@ class SpotifyWrapper:
 
         def initialized_checker(self, *func_arguments):
             if self.client is None:
-                print(f'Oops! Spotify client was uninitialized while trying to call {func.__name__}!')
+                logger.error('Oops! Spotify client was uninitialized while trying to call %s!', func.__name__)
                 return
             return func(self, *func_arguments)
 
@@ -138,33 +171,46 @@ class SpotifyWrapper:
 
         Returns None if nothing is playing and -1 on failure
 
-        Side effect: sets self.current_track and self._previous track
+        Side effect: sets self.current_track, self._previous track and self.player_state
             Note: self.previous_track is not overwritten if it is the same as self.current_track
         """
 
-        response = self.client.get(f"{SpotifyWrapper.api_url}/me/player/currently-playing")
+        started  = metrics.timer()
+        response = self.client.get(f"{self.api_url}/me/player/currently-playing")
+        metrics.observe_phase('currently_playing_http', started)
+        metrics.api_call('/me/player/currently-playing', response.status_code)
 
         if response.status_code >= 300 or response.status_code < 200:
-            print('Something went wrong while requesting the current song:')
-            print(f'HTTP {response.status_code} : {response.text}')
+            logger.error('Something went wrong while requesting the current song:\nHTTP %s : %s',
+                         response.status_code, response.text)
+            self.player_state = None
             return -1
 
         try:
+            started = metrics.timer()
             track = Track(response.json())
+            metrics.observe_phase('json_decode', started)
 
         except json.JSONDecodeError:
+            # No device is active
             if response.status_code == 204:
+                self.current_track = None
+                self.player_state  = idle.INACTIVE
                 return None
             else:
-                print('Something unexpected happened while requesting the current song:')
-                print(f'HTTP {response.status_code} : {response.text}')
+                logger.error('Something unexpected happened while requesting the current song:\nHTTP %s : %s',
+                             response.status_code, response.text)
+                self.player_state = None
                 return -1
 
         # A podcast or nothing is being listened to
         if track.type == 'show' or not track.is_playing:
             self.current_track = None
+            self.player_state  = idle.PAUSED
             return None
 
+        self.player_state = idle.PLAYING
+
         # Do not wipe out previous track if song is on repeat
         if self.current_track is not None and self.current_track.id != track.id:
             self.previous_track = self.current_track
@@ -175,33 +221,51 @@ class SpotifyWrapper:
 
     # ====
     @needs_initialized_client
-    def skip_current_track(self) -> typing.Union[Track, int]:
+    def skip_current_track(self) -> typing.Union[bool, int]:
         """
         Skips the track that is currently playing
-        Returns either a Track for the new track or -1 on failure
+        Returns True once Spotify has been told to move on, or -1 on failure
+
+        What is playing isn't looked at again here: Spotify needs REQUEST_DELAY_COMPENSATION_MS to catch up, and
+        rather than sleep through that, the caller polls again once seconds_until_settled() have passed
 
-        SIDE EFFECT: Updates the current track
+        Side effect: sets self.settles_at
         """
 
-        response = self.client.post(f"{SpotifyWrapper.api_url}/me/player/next")
+        response = self.client.post(f"{self.api_url}/me/player/next")
+        metrics.api_call('/me/player/next', response.status_code)
+
+        if 200 <= response.status_code < 300:
+            self.skip_confirmed_at = self.clock.time()
 
         if response.status_code == 403:
             error_message = response.json().get('error', {}).get('message', None)
 
             # User interacted with Spotify (skip, pause) while we were processing,
-            # so wait for things to settle and then return the current track
+            # so let things settle and then look at what is playing
             if error_message == 'Player command failed: Restriction violated':
-                time.sleep(constants.SpotifyAPI.REQUEST_DELAY_COMPENSATION_MS / 1000)
-                return self.update_current_track()
+                self.settles_at = self.clock.time() + constants.SpotifyAPI.REQUEST_DELAY_COMPENSATION_MS / 1000
+                return True
 
         if response.status_code >= 300 or response.status_code < 200:
-            print('Something went wrong while trying to skip the current song:')
-            print(f'HTTP {response.status_code} : "{response.text or "<no message>"}"')
+            logger.error('Something went wrong while trying to skip the current song:\nHTTP %s : "%s"',
+                         response.status_code, response.text or '<no message>')
             return -1
 
-        time.sleep(constants.SpotifyAPI.REQUEST_DELAY_COMPENSATION_MS / 1000)
+        self.settles_at = self.clock.time() + constants.SpotifyAPI.REQUEST_DELAY_COMPENSATION_MS / 1000
 
-        return self.update_current_track()
+        return True
+
+    # ====
+    def seconds_until_settled(self) -> float:
+        """
+        How long until Spotify has caught up with the last skip, 0 if it has
+        """
+
+        if self.settles_at is None:
+            return 0
+
+        return max(0, self.settles_at - self.clock.time())
 
     # ====
     @needs_initialized_client
@@ -213,11 +277,12 @@ class SpotifyWrapper:
         Side effect: sets self.previous_track and self.current_track (the latter to None)
         """
 
-        response = self.client.put(f"{SpotifyWrapper.api_url}/me/player/pause")
+        response = self.client.put(f"{self.api_url}/me/player/pause")
+        metrics.api_call('/me/player/pause', response.status_code)
 
         if response.status_code >= 300 or response.status_code < 200:
-            print('Something went wrong while trying to stop playback:')
-            print(f'HTTP {response.status_code} : "{response.text or "<no message>"}"')
+            logger.error('Something went wrong while trying to stop playback:\nHTTP %s : "%s"',
+                         response.status_code, response.text or '<no message>')
             return -1
 
         self.previous_track = self.current_track
@@ -225,98 +290,17 @@ class SpotifyWrapper:
 
         return True
 
-    # ========
-    @staticmethod
-    def get_current_track_static(client_id: str) -> typing.Union[Track, bool, None]:
-        """
-        Provides an encapsulated method for getting the current track from threads without access to the wrapper instance.
-        Returns a Track for the current track, None if nothing is playing, or False on failure
-        """
-
-        access_token = TokenHandler.refresh_access_token()
-
-        # Something went wrong during the oauth process
-        if access_token is None or access_token == -1:
-            print('Could not establish OAuth session with Spotify; is your account connected?')
-            return False
-
-        client = OAuthManager.build_oauth_session(client_id, access_token)
-        response = client.get(f"{SpotifyWrapper.api_url}/me/player/currently-playing")
-
-        if response.status_code >= 300 or response.status_code < 200:
-            print('Something went wrong while trying to skip the current song:')
-            print(f'HTTP {response.status_code} : "{response.text or "<no message>"}"')
-            return False
-
-        # Gotta love consistent APIs
-        if response.status_code == 204:
-            return None
-
-        json_data = response.json()
-        track = Track(json_data)
-
-        if track.type == 'show' or not track.is_playing:
-            return None
-
-        return track
-
-    # ========
-    @staticmethod
-    def skip_current_track_static(client_id: str) -> bool:
-        """
-        Provides an encapsulated method for skipping the current track from threads without access to the wrapper instance.
-        Returns True on success and False on failure
-        """
-
-        access_token = TokenHandler.refresh_access_token()
-
-        # Something went wrong during the oauth process
-        if access_token is None or access_token == -1:
-            print('Could not establish OAuth session with Spotify; is your account connected?')
-            return False
-
-        client = OAuthManager.build_oauth_session(client_id, access_token)
-        response = client.post(f"{SpotifyWrapper.api_url}/me/player/next")
-
-        if response.status_code >= 300 or response.status_code < 200:
-            print('Something went wrong while trying to skip the current song:')
-            print(f'HTTP {response.status_code} : "{response.text or "<no message>"}"')
-            return False
-
-        return True
-
-    # ========
-    def get_backoff(self) -> int:
-        """
-        Get number of seconds to wait for before trying the next API call, which increases with time
-        """
-        self.backing_off = True
-        return next(self.backoff)
-
-    # ====
-    def reset_backoff(self) -> None:
-        """
-        Set API call attempt wait time back to its initial value
-        """
-        self.backing_off = False
-        self.backoff = SpotifyWrapper.not_playing_backoff()
-
     # ====
-    @staticmethod
-    def not_playing_backoff() -> typing.Generator[int, None, None]:
+    @needs_initialized_client
+    def get_json(self, path: str) -> typing.Tuple[int, typing.Any]:
         """
-        Tracks the number of seconds to wait for before trying the next API call, which increases with time.
-        This is handled internally, use get_backoff() and reset_backoff() to access it.
-
-        1*4 => 2*4 => 5*2 => 10 => 15 => 30 => 45 => 60 forever
+        GETs :path (e.g. '/me/player/queue') and returns the status code and the decoded body, None if there is none
         """
 
-        for _ in range(4): yield 1
-        for _ in range(4): yield 2
-        for _ in range(2): yield 5
-
-        for val in (10, 15, 30, 45):
-            yield val
+        response = self.client.get(f"{self.api_url}{path}")
+        metrics.api_call(path.partition('?')[0], response.status_code)
 
-        while True:
-            yield 60
+        try:
+            return response.status_code, response.json()
+        except json.JSONDecodeError:
+            return response.status_code, None
@@ -0,0 +1,498 @@
+"""
+Supervisor for multi-account mode across several cores (heartbroken.py --accounts DIR --workers N).
+
+Accounts are split between worker processes, each serving its share with libs.accounts.serve_accounts(). A
+consistent hash ring decides which worker serves an account, so adding a worker only moves the accounts that now hash
+to it, about 1/N of them. Moved accounts are handed over without restarting anyone (Command.SET_ACCOUNTS).
+
+The supervisor also:
+    - restarts a worker that dies, with the same accounts, backing off if it keeps dying
+    - picks up accounts that are added to or removed from DIR
+    - collects every worker's counters and serves health and throughput at /health (JSON) and /metrics (Prometheus)
+"""
+
+import bisect
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+import typing
+
+from libs import accounts, constants, logs, metrics
+from libs.spotifywrapper import SpotifyWrapper
+
+
+RING_REPLICAS        = 100  # Points per worker on the hash ring; more spreads accounts more evenly
+SUPERVISE_SECONDS    = .5   # How often workers are checked on and messages handled
+STATS_SECONDS        = 5    # How often workers report their counters
+RESCAN_SECONDS       = 30   # How often DIR is checked for added and removed accounts
+HEALTHY_RUN_SECONDS  = 60   # A worker that ran this long before dying is restarted straight away
+MAX_RESTART_DELAY    = 60
+SHUTDOWN_SECONDS     = 10   # How long workers get to stop before they are terminated
+
+POLL_ENDPOINT = '/me/player/currently-playing'
+
+logger = logging.getLogger(__name__)
+
+
+# ========
+class HashRing:
+    """
+    Consistent hashing of keys onto nodes. Each node is placed at RING_REPLICAS points around the ring and a key
+    belongs to the first node point at or after its own hash.
+    """
+
+    def __init__(self, nodes: typing.Iterable[typing.Hashable] = (), replicas: int = RING_REPLICAS):
+        self.replicas = replicas
+
+        self._points = []  # Sorted hashes
+        self._nodes  = {}  # Hash -> node
+
+        for node in nodes:
+            self.add(node)
+
+    # ====
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode('utf8'), digest_size=8).digest(), 'big')
+
+    # ====
+    def add(self, node: typing.Hashable) -> None:
+        for replica in range(self.replicas):
+            point = HashRing._hash(f'{node}#{replica}')
+            self._nodes[point] = node
+            bisect.insort(self._points, point)
+
+    # ====
+    def remove(self, node: typing.Hashable) -> None:
+        for replica in range(self.replicas):
+            point = HashRing._hash(f'{node}#{replica}')
+            if self._nodes.pop(point, None) is not None:
+                self._points.remove(point)
+
+    # ====
+    def node_for(self, key: str) -> typing.Union[None, typing.Hashable]:
+        if not self._points:
+            return None
+
+        index = bisect.bisect_left(self._points, HashRing._hash(key)) % len(self._points)
+        return self._nodes[self._points[index]]
+
+# ========
+class Worker:
+    """
+    One worker process's slot: which accounts it serves, and what the supervisor knows about it
+    """
+
+    def __init__(self, worker_id: int):
+        self.id = worker_id
+
+        self.accounts      = frozenset()
+        self.process       = None
+        self.control_queue = None
+        self.stop          = None  # multiprocessing.Event, set to stop just this worker
+
+        self.started_at    = None
+        self.restarts      = 0
+        self.crash_streak  = 0     # Deaths in a row that came soon after starting
+        self.start_after   = 0.0   # time.monotonic() before which it is not restarted
+        self.gave_up_on    = None  # Accounts it exited with 2 for; it is only started again once they change
+
+        self.counters         = {}  # Its latest metrics.counters()
+        self.reported_at      = None
+        self.polls_per_second = 0.0
+
+    # ====
+    @property
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+# ========
+def worker_main(worker_id: int, accounts_directory: str, account_names: typing.Sequence[str], app_loop_should_run,
+                stop, control_queue, stats_queue, api_url: str) -> typing.NoReturn:
+    """
+    Target of each worker process
+    """
+
+    logs.start(os.path.join(accounts_directory, f'heartbroken_worker_{worker_id}.log'))
+    metrics.enable()
+
+    def report():
+        while not stop.wait(STATS_SECONDS):
+            stats_queue.put((worker_id, metrics.counters()))
+
+    threading.Thread(target=report, name='stats', daemon=True).start()
+
+    selected = [account for account in accounts.AccountRegistry(accounts_directory).accounts()
+                if account.name in account_names and account.is_connected]
+
+    sys.exit(accounts.run(accounts_directory, selected, app_loop_should_run, stop, control_queue, api_url=api_url))
+
+# ========
+class Supervisor:
+    """
+    Runs the accounts under :accounts_directory on :worker_count worker processes.
+    :api_url points the workers at a local mock API (see devtools.check_supervisor).
+    """
+
+    def __init__(self, accounts_directory: str, worker_count: int, api_url: str = SpotifyWrapper.api_url):
+        self.registry = accounts.AccountRegistry(accounts_directory)
+        self.api_url  = api_url
+
+        # Set == running; shared with every worker
+        self.app_loop_should_run = multiprocessing.Event()
+        self.app_loop_should_run.set()
+
+        self.stats_queue = multiprocessing.Queue()
+
+        self.ring          = HashRing()
+        self.workers       = {}  # Worker id -> Worker; ids are 0 to worker_count - 1
+        self.account_names = []  # Connected accounts, sorted. Replaced in place, as the control socket reads it.
+
+        self.started_at     = time.monotonic()
+        self._rescanned_at  = None
+        self._lock          = threading.Lock()  # health() and render_metrics() are called from the HTTP thread
+
+        self.set_worker_count(worker_count)
+
+    # ========
+    def run(self, shutdown: threading.Event, control_queue: typing.Union[None, queue.Queue] = None) -> int:
+        """
+        Supervises the workers until :shutdown is set. :control_queue takes the same messages as the app loop's
+        (see constants.Command), plus SET_WORKERS.
+        """
+
+        logger.info('Supervising %d worker process(es)', len(self.workers))
+
+        try:
+            while not shutdown.is_set():
+                if self._rescanned_at is None or time.monotonic() - self._rescanned_at >= RESCAN_SECONDS:
+                    self.rescan()
+
+                self._collect_stats()
+                self._handle_control_messages(control_queue)
+                self._check_workers()
+
+                shutdown.wait(SUPERVISE_SECONDS)
+        finally:
+            self._stop_workers(list(self.workers.values()))
+
+        return 0
+
+    # ====
+    def rescan(self) -> None:
+        """
+        Picks up accounts that were added to or removed from the accounts directory
+        """
+
+        self._rescanned_at = time.monotonic()
+
+        names = sorted(account.name for account in self.registry.accounts() if account.is_connected)
+        if names != self.account_names:
+            self.account_names[:] = names
+            self._rebalance()
+
+    # ====
+    def set_worker_count(self, worker_count: int) -> None:
+        """
+        Adds or retires workers and moves the accounts whose worker changed. Only about 1/N of them move per worker
+        added or removed.
+        """
+
+        with self._lock:
+            for worker_id in range(len(self.workers), worker_count):
+                self.workers[worker_id] = Worker(worker_id)
+                self.ring.add(worker_id)
+
+            retired = [self.workers.pop(worker_id) for worker_id in range(worker_count, len(self.workers))]
+            for worker in retired:
+                self.ring.remove(worker.id)
+
+        # Hand the retired workers' accounts over first, then stop them
+        self._rebalance()
+        self._stop_workers(retired)
+
+    # ====
+    def worker_for(self, account_name: str) -> typing.Union[None, Worker]:
+        worker_id = self.ring.node_for(account_name)
+        return None if worker_id is None else self.workers[worker_id]
+
+    # ====
+    def _rebalance(self) -> None:
+        assignments = {worker_id: set() for worker_id in self.workers}
+        for name in self.account_names:
+            assignments[self.ring.node_for(name)].add(name)
+
+        # Workers losing accounts are told first, so an account is never served by two workers for long
+        changed = [worker for worker in self.workers.values() if worker.accounts != assignments[worker.id]]
+        changed.sort(key=lambda worker: len(assignments[worker.id]) - len(worker.accounts))
+
+        for worker in changed:
+            worker.accounts = frozenset(assignments[worker.id])
+
+            if worker.is_alive:
+                worker.control_queue.put((constants.Command.SET_ACCOUNTS, sorted(worker.accounts)))
+
+        if changed:
+            logger.info('Rebalanced %d account(s) over %d worker(s): %s', len(self.account_names), len(self.workers),
+                        ', '.join(f'{worker.id}: {len(worker.accounts)}' for worker in self.workers.values()))
+
+    # ========
+    def _start(self, worker: Worker) -> None:
+        worker.control_queue = multiprocessing.Queue()
+        worker.stop          = multiprocessing.Event()
+        worker.started_at    = time.monotonic()
+        worker.gave_up_on    = None
+
+        worker.process = multiprocessing.Process(
+            target=worker_main, name=f'heartbroken worker {worker.id}',
+            args=(worker.id, self.registry.directory, sorted(worker.accounts), self.app_loop_should_run, worker.stop,
+                  worker.control_queue, self.stats_queue, self.api_url)
+        )
+        worker.process.start()
+
+    # ====
+    def _check_workers(self) -> None:
+        """
+        Starts workers that have accounts but no process, and restarts ones that died
+        """
+
+        now = time.monotonic()
+
+        for worker in list(self.workers.values()):
+            if worker.is_alive:
+                continue
+
+            if worker.process is not None:
+                exit_code = worker.process.exitcode
+                ran_for   = now - worker.started_at
+                worker.process = None
+
+                if exit_code == 2:
+                    logger.error('Worker %s stopped, none of its accounts could refresh their tokens', worker.id)
+                    worker.gave_up_on = worker.accounts
+
+                elif worker.accounts:
+                    logger.warning('Worker %s exited with code %s after %.0fs, restarting it',
+                                   worker.id, exit_code, ran_for)
+
+                    worker.crash_streak = 0 if ran_for >= HEALTHY_RUN_SECONDS else worker.crash_streak + 1
+                    worker.start_after  = now + min(MAX_RESTART_DELAY, 2 ** worker.crash_streak - 1)
+                    worker.restarts    += 1
+
+            if worker.accounts and worker.accounts != worker.gave_up_on and now >= worker.start_after:
+                self._start(worker)
+
+    # ====
+    def _stop_workers(self, workers: typing.Sequence[Worker]) -> None:
+        for worker in workers:
+            if worker.is_alive:
+                worker.stop.set()
+                worker.control_queue.put((constants.Command.WAKE, None))
+
+        deadline = time.monotonic() + SHUTDOWN_SECONDS
+        for worker in workers:
+            if worker.process is None:
+                continue
+
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+    # ====
+    def _handle_control_messages(self, control_queue: typing.Union[None, queue.Queue]) -> None:
+        if control_queue is None:
+            return
+
+        while True:
+            try:
+                command, payload = control_queue.get_nowait()
+            except queue.Empty:
+                return
+
+            if command == constants.Command.WAKE:
+                for worker in self.workers.values():
+                    if worker.is_alive:
+                        worker.control_queue.put((command, payload))
+
+            elif command in (constants.Command.DISLIKE, constants.Command.UNDISLIKE):
+                worker = self.worker_for(payload.partition(':')[0])
+                if worker is not None and worker.is_alive:
+                    worker.control_queue.put((command, payload))
+                else:
+                    logger.warning('The worker for %s is not running, try again in a moment', payload.partition(':')[0])
+
+            elif command == constants.Command.SET_WORKERS:
+                self.set_worker_count(payload)
+
+            else:
+                logger.warning('"%s" is not available with --workers, as every worker is its own process', command)
+
+    # ====
+    def _collect_stats(self) -> None:
+        while True:
+            try:
+                worker_id, counters = self.stats_queue.get_nowait()
+            except queue.Empty:
+                return
+
+            worker = self.workers.get(worker_id, None)
+            if worker is None:
+                continue
+
+            now = time.monotonic()
+
+            with self._lock:
+                polls = _count(counters, 'heartbroken_api_calls_total', endpoint=POLL_ENDPOINT)
+                previous_polls = _count(worker.counters, 'heartbroken_api_calls_total', endpoint=POLL_ENDPOINT)
+
+                # A restarted worker starts counting from 0 again
+                if worker.reported_at is not None and polls >= previous_polls:
+                    worker.polls_per_second = (polls - previous_polls) / max(now - worker.reported_at, 1e-6)
+
+                worker.counters    = counters
+                worker.reported_at = now
+
+    # ========
+    def health(self) -> dict:
+        """
+        Health and throughput of every worker. It is healthy if every worker with accounts is running and has
+        reported its stats recently.
+        """
+
+        now = time.monotonic()
+        workers = []
+
+        with self._lock:
+            for worker in self.workers.values():
+                reported_ago = None if worker.reported_at is None else round(now - worker.reported_at, 1)
+                workers.append({
+                    'id':               worker.id,
+                    'pid':              worker.process.pid if worker.is_alive else None,
+                    'alive':            worker.is_alive,
+                    'accounts':         len(worker.accounts),
+                    'restarts':         worker.restarts,
+                    'polls_per_second': round(worker.polls_per_second, 2),
+                    'skips':            _count(worker.counters, 'heartbroken_skips_total'),
+                    'api_errors':       sum(value for (name, labels), value in worker.counters.items()
+                                            if name == 'heartbroken_api_calls_total'
+                                            and not 200 <= dict(labels).get('status', 200) < 300),
+                    'reported_seconds_ago': reported_ago
+                })
+
+        healthy = all(worker['alive'] and worker['reported_seconds_ago'] is not None
+                      and worker['reported_seconds_ago'] <= 3 * STATS_SECONDS
+                      for worker in workers if worker['accounts'] > 0)
+
+        return {
+            'healthy':          healthy,
+            'uptime_seconds':   round(now - self.started_at, 1),
+            'accounts':         len(self.account_names),
+            'polls_per_second': round(sum(worker['polls_per_second'] for worker in workers), 2),
+            'workers':          workers
+        }
+
+    # ====
+    def render_metrics(self) -> str:
+        """
+        Every worker's counters with a worker label, plus the state of each worker, in the Prometheus text format
+        """
+
+        lines = []
+
+        with self._lock:
+            for name, help_text in (('heartbroken_worker_up', 'Whether the worker process is running'),
+                                    ('heartbroken_worker_accounts', 'Accounts assigned to the worker'),
+                                    ('heartbroken_worker_restarts_total', 'Times the worker was restarted')):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {"counter" if name.endswith("_total") else "gauge"}')
+
+                for worker in self.workers.values():
+                    value = {'heartbroken_worker_up':             int(worker.is_alive),
+                             'heartbroken_worker_accounts':       len(worker.accounts),
+                             'heartbroken_worker_restarts_total': worker.restarts}[name]
+                    lines.append(f'{name}{metrics._format_labels((("worker", worker.id),))} {value}')
+
+            for name, help_text in metrics._COUNTER_HELP.items():
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} counter')
+
+                for worker in self.workers.values():
+                    for (counter_name, labels), value in sorted(worker.counters.items(), key=lambda item: str(item[0])):
+                        if counter_name == name:
+                            lines.append(f'{name}{metrics._format_labels((("worker", worker.id),) + labels)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    # ====
+    def report(self) -> str:
+        """
+        health() as a table for the console
+        """
+
+        health = self.health()
+        lines = [f'{health["accounts"]} account(s), {health["polls_per_second"]} polls/s, '
+                 + ('healthy' if health['healthy'] else 'UNHEALTHY'),
+                 f'    {"worker":8}{"pid":>8}{"accounts":>10}{"polls/s":>9}{"skips":>7}{"errors":>8}{"restarts":>10}']
+
+        for worker in health['workers']:
+            lines.append(f'    {worker["id"]:<8}{str(worker["pid"] or "-"):>8}{worker["accounts"]:>10}'
+                         f'{worker["polls_per_second"]:>9}{worker["skips"]:>7}{worker["api_errors"]:>8}'
+                         f'{worker["restarts"]:>10}')
+
+        return '\n'.join(lines)
+
+# ========
+def _count(counters: dict, name: str, **labels: typing.Any) -> int:
+    """
+    Sums the counters called :name whose labels include :labels
+    """
+
+    return sum(value for (counter_name, counter_labels), value in counters.items()
+               if counter_name == name and labels.items() <= dict(counter_labels).items())
+
+# ========
+def serve_status(supervisor: Supervisor, port: int) -> 'http.server.HTTPServer':
+    """
+    Serves supervisor.health() at http://127.0.0.1:<port>/health and render_metrics() at /metrics from a background
+    thread
+    """
+
+    import http.server
+
+    class StatusRequestHandler (http.server.BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path == '/health':
+                health = supervisor.health()
+                status, content_type = (200 if health['healthy'] else 503), 'application/json'
+                body = json.dumps(health).encode('utf8')
+
+            elif self.path == '/metrics':
+                status, content_type = 200, 'text/plain; version=0.0.4; charset=utf-8'
+                body = supervisor.render_metrics().encode('utf8')
+
+            else:
+                self.send_error(404)
+                return
+
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # ====
+        def log_message(self, format, *args) -> None:
+            # Mutes default console logging of requests
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), StatusRequestHandler)
+    server.daemon_threads = True
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,18 +1,21 @@
 import json
+import logging
 import multiprocessing
 import queue
 import time
 import typing
-import webbrowser
-import http.server
 import urllib.parse
 
 import requests
 import requests_oauthlib
 
+from libs import metrics
 from libs.utils import StaticClass
 
 
+logger = logging.getLogger(__name__)
+
+
 # ========
 class TokenHandler (StaticClass):
     """
@@ -21,38 +24,44 @@ class TokenHandler (StaticClass):
 
     client_id    = "{inject_client_id}"  # Spotify API client id
     token_url    = "{inject_token_url}"  # URL from which access tokens will be received (handled remotely to protect client secret)
-    auth_scope   = "user-read-currently-playing user-modify-playback-state"
+    auth_scope   = "user-read-currently-playing user-read-playback-state user-modify-playback-state " \
+                   "user-library-read playlist-read-private playlist-read-collaborative"  # The last three for libs.scanner
     redirect_uri = "http://127.0.0.1:8551/callback"
 
     credentials_file_name = 'heartbroken_auth.json'
 
     # ========
     @staticmethod
-    def is_token_expired() -> bool:
+    def is_token_expired(margin_seconds: float = 1, credentials_file_name: typing.Union[None, str] = None) -> bool:
         """
-        Loads the credentials from their file and returns a boolean indicating if they are expired
+        Loads the credentials from their file and returns a boolean indicating if they are expired,
+        or will be within :margin_seconds
         """
 
-        tokens = TokenHandler.load_credentials_from_file()
-        return tokens['expires_at'] - time.time() <= 1
+        tokens = TokenHandler.load_credentials_from_file(credentials_file_name)
+        return tokens['expires_at'] - time.time() <= margin_seconds
 
     # ========
     @staticmethod
-    def refresh_access_token() -> typing.Union[None, str, int]:
+    def refresh_access_token(margin_seconds: float = 1,
+                             credentials_file_name: typing.Union[None, str] = None) -> typing.Union[None, str, int]:
         """
         Load an access token from its file and return it if it is not expired.
-            If is are expired, request a new access token from the Heartbroken servers.
-                Try 20 times over 60 seconds before forcing the program to exit with code 3.
+            If is are expired, request a new access token from the Heartbroken servers, once. Trying again is up to
+            the caller, which can wait for that without holding up anything else (see constants.SpotifyAPI).
 
         Once an access token has been aquired, write the releveant data to its file and return the access token.
 
+        :margin_seconds refreshes tokens that are about to expire as well, see is_token_expired()
+        :credentials_file_name picks the account in multi-account mode (see libs.accounts); defaults to the only one
+
         Returns None if the refresh token is missing from its file or the file is missing entirely
         Returns the access token on success
         Returns -1 on failure
         """
 
         try:
-            tokens = TokenHandler.load_credentials_from_file()
+            tokens = TokenHandler.load_credentials_from_file(credentials_file_name)
             needs_oauth = False
         except FileNotFoundError:
             needs_oauth = True
@@ -61,40 +70,35 @@ class TokenHandler (StaticClass):
             return None
 
         # Access token is not yet expired
-        if not TokenHandler.is_token_expired():
+        if not TokenHandler.is_token_expired(margin_seconds, credentials_file_name):
             return tokens['access_token']
 
-        print('Access token expired, acquiring new token...')
+        logger.info('Access token expired, acquiring new token...')
+        started = metrics.timer()
 
         data = {
             'auth_key':      '{inject_auth_key}',
             'refresh_token': tokens['refresh_token']
         }
 
-        for attempt in range(21):
-            access_token_request = requests.post(TokenHandler.token_url, json=data)
+        access_token_request = requests.post(TokenHandler.token_url, json=data)
 
-            if access_token_request.status_code == 200:
-                break
+        if access_token_request.status_code != 200:
+            logger.warning('Failed to get access token from Heartbroken servers: HTTP %s',
+                           access_token_request.status_code)
+            return -1
 
-            elif access_token_request.status_code != 200 and attempt < 20:
-                print(f'Failed to get access token from Heartbroken servers (attempt {attempt}/10)')
-                time.sleep(3)
-
-            else:
-                print('FATAL: Something went wrong while getting a Spotify access token from the Heartbroken servers:')
-                print(f'HTTP {access_token_request.status_code}')
-                return -1
+        metrics.observe_phase('token_refresh', started)
 
         access_token_dict = access_token_request.json()
         access_token_dict['refresh_token'] = tokens['refresh_token']
-        TokenHandler.save_credentials_to_file(access_token_dict)
+        TokenHandler.save_credentials_to_file(access_token_dict, credentials_file_name)
 
         return access_token_dict['access_token']
 
     # ========
     @staticmethod
-    def save_credentials_to_file(access_token_dict) -> dict:
+    def save_credentials_to_file(access_token_dict, credentials_file_name: typing.Union[None, str] = None) -> dict:
         """
         Write the access token, expiry time info, and refresh token to the credentials file, then return them.
         """
@@ -102,19 +106,19 @@ class TokenHandler (StaticClass):
         access_token_dict['expires_at'] = time.time() + int(access_token_dict['expires_in'])
         access_token_json = str(access_token_dict).replace("'", '"')
 
-        with open(TokenHandler.credentials_file_name, 'w') as f:
+        with open(credentials_file_name or TokenHandler.credentials_file_name, 'w') as f:
             print(access_token_json, file=f)
 
         return access_token_dict
 
     # ========
     @staticmethod
-    def load_credentials_from_file() -> dict:
+    def load_credentials_from_file(credentials_file_name: typing.Union[None, str] = None) -> dict:
         """
         Load the access token, expiry time info, and refresh token from the credentials file, then return them.
         """
 
-        with open(TokenHandler.credentials_file_name) as f:
+        with open(credentials_file_name or TokenHandler.credentials_file_name) as f:
             return json.loads(f.read())
 
 
@@ -127,14 +131,20 @@ class OAuthManager (StaticClass):
 
     # ========
     @staticmethod
-    def do_spotify_oauth() -> typing.Generator[typing.Union[multiprocessing.Process, None, dict], None, None]:
+    def do_spotify_oauth(credentials_file_name: typing.Union[None, str] = None
+                         ) -> typing.Generator[typing.Union[multiprocessing.Process, None, dict], None, None]:
         """
         Run Spotify OAuth flow. Runs a temporary web server in a separate thread to receive the callback.
+        The tokens are saved to :credentials_file_name, or the default credentials file.
         This function returns a generator that yields two values separately
             1) The server process
             2) Either None, indicating failure, or a dict containing all the access tokens
         """
 
+        # Only needed on first run, so they stay out of every normal startup
+        import webbrowser
+        from libs import oauthserver
+
         auth_code_params = {
             "response_type": "code",
             "client_id":     TokenHandler.client_id,
@@ -143,7 +153,7 @@ class OAuthManager (StaticClass):
         }
 
         auth_queue = multiprocessing.Queue()
-        server_process = multiprocessing.Process(target=OAuthManager._run_server, args=(auth_queue,))
+        server_process = multiprocessing.Process(target=oauthserver.run_server, args=(auth_queue,))
         server_process.start()
 
         yield server_process
@@ -161,7 +171,7 @@ class OAuthManager (StaticClass):
 
         # We waited 60 seconds and got no requests
         if attempt_count == 119:
-            print('\n\nTimed out while waiting for OAuth callback from Spotify. Exiting.\n\n')
+            logger.error('Timed out while waiting for OAuth callback from Spotify. Exiting.')
 
             # Clean up after OAuth server
             auth_queue.close()
@@ -180,7 +190,8 @@ class OAuthManager (StaticClass):
 
         refresh_token_request = requests.post(TokenHandler.token_url, json=data)
         if refresh_token_request.status_code != 200:
-            print(f'Encountered error while connecting to the Heartbroken servers: HTTP {refresh_token_request.status_code} : {refresh_token_request.text})')
+            logger.error('Encountered error while connecting to the Heartbroken servers: HTTP %s : %s',
+                         refresh_token_request.status_code, refresh_token_request.text)
             yield None
 
         # Clean up after OAuth server
@@ -188,7 +199,7 @@ class OAuthManager (StaticClass):
         server_process.terminate()
 
         refresh_token_dict = refresh_token_request.json()
-        TokenHandler.save_credentials_to_file(refresh_token_dict)
+        TokenHandler.save_credentials_to_file(refresh_token_dict, credentials_file_name)
 
         yield refresh_token_dict
 
@@ -200,50 +211,3 @@ class OAuthManager (StaticClass):
         """
         return requests_oauthlib.OAuth2Session(client_id=client_id,
                                                token={"access_token": access_token})
-
-    # ========
-    @staticmethod
-    def _run_server(auth_queue: multiprocessing.Queue) -> typing.NoReturn:
-        """
-        Waits for a connection, gets the access token token from the request, then tosses it in the auth queue.
-        This thread should be laid to rest once the queue has an item.
-        """
-
-        httpd = _QueuingHTTPServer(('127.0.0.1', 8551), _AuthRequestHandler, auth_queue)
-
-        try:
-            httpd.serve_forever()
-        except KeyboardInterrupt:
-            pass
-
-
-class _QueuingHTTPServer(http.server.HTTPServer):
-    """
-    Simple extension of http.server.HTTPServer that allows passing in a queue
-    """
-
-    def __init__(self, server_address, RequestHandlerClass,
-                 queue: multiprocessing.Queue, bind_and_activate=True):
-        http.server.HTTPServer.__init__(self, server_address, RequestHandlerClass, bind_and_activate)
-        self.auth_queue = queue
-
-
-class _AuthRequestHandler(http.server.BaseHTTPRequestHandler):
-    """
-    Handles receipt of the OAuth token and returns an HTML page that will either exit on its own or instruct the user to do so.
-    """
-
-    def do_GET(self) -> None:
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html')
-        self.end_headers()
-
-        # Depending on the browser this may or may not auto-close the window after auth has finished.
-        self.wfile.write(bytes('<!DOCTYPE html><html><head><script>window.close();</script><style>*{background-color:black;color:white;font-size:24pt;}</head><body>Authentication complete. You may close this page.</body></html>', 'utf8'))
-
-        self.server.auth_queue.put(self.path.strip('/callback?code='))
-
-    # ========
-    def log_message(self, format, *args) -> None:
-        # Mutes default console logging of requests
-        pass
@@ -0,0 +1,97 @@
+import collections
+import contextlib
+import os
+import threading
+import time
+import typing
+
+
+# Off unless enable() is called. Spans are only ever kept in memory until dump() is called.
+ENABLED = False
+
+DEFAULT_CAPACITY = 50000  # Spans kept per process; the oldest are dropped first
+
+_process_name = None
+_spans = collections.deque(maxlen=DEFAULT_CAPACITY)
+
+
+# ========
+def enable(process_name: str, capacity: int = DEFAULT_CAPACITY) -> None:
+    """
+    Starts recording spans into a ring buffer of :capacity. :process_name labels this process in the timeline.
+    """
+
+    global ENABLED, _process_name, _spans
+
+    _process_name = process_name
+    _spans  = collections.deque(maxlen=capacity)
+    ENABLED = True
+
+# ========
+def record(name: str, started: float, ended: float, args: typing.Union[dict, None] = None) -> None:
+    """
+    Records a span from :started to :ended, both from time.perf_counter(), which is system-wide on the platforms
+    Heartbroken runs on, so spans from the app loop and the tray line up
+    """
+
+    if not ENABLED:
+        return
+
+    _spans.append((name, started, ended, threading.get_ident(), args))
+
+# ====
+@contextlib.contextmanager
+def _span(name: str, args: dict) -> typing.Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, started, time.perf_counter(), args or None)
+
+def span(name: str, **args: typing.Any) -> typing.ContextManager:
+    """
+    Context manager that records everything inside of it as one span. Free (a shared null context) while disabled.
+    """
+
+    if not ENABLED:
+        return contextlib.nullcontext()
+
+    return _span(name, args)
+
+# ========
+def events() -> typing.List[dict]:
+    """
+    This process' spans as Chrome trace events. They can be passed between processes and merged with dump().
+    """
+
+    pid = os.getpid()
+
+    trace_events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': _process_name}}]
+
+    for name, started, ended, tid, args in list(_spans):
+        event = {'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                 'ts': round(started * 1e6, 3), 'dur': round((ended - started) * 1e6, 3)}
+
+        if args is not None:
+            event['args'] = args
+
+        trace_events.append(event)
+
+    return trace_events
+
+# ====
+def dump(path: typing.Union[None, str] = None, other_events: typing.Iterable[dict] = ()) -> str:
+    """
+    Writes this process' spans, plus :other_events from other processes, to a JSON file that chrome://tracing and
+    ui.perfetto.dev can open. Returns the path written to.
+    """
+
+    import json
+
+    if path is None:
+        path = time.strftime('heartbroken_trace_%Y%m%d-%H%M%S.json')
+
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events() + list(other_events), 'displayTimeUnit': 'ms'}, f)
+
+    return path
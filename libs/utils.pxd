@@ -0,0 +1,6 @@
+# Augments utils.py when it is compiled by buildtools/cython_setup.py; ignored by the interpreted build.
+
+cimport cython
+
+@cython.locals(result=object, key=object)
+cpdef object _deep_get(object dictionary, object keys, object default=*)
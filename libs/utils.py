@@ -1,3 +1,5 @@
+# cython: boundscheck=False, wraparound=False
+import math
 import typing
 
 
@@ -20,22 +22,35 @@ class StaticClass (metaclass=_NoWrite):
 
 # ========
 def _DEEP_GET_FAIL(): pass  # Arbitrary unused object for comparison
-def _deep_get(dictionary: typing.Union[dict, None],
-              keys: typing.Iterable, default: typing.Any = None) -> typing.Any:
+def _deep_get(dictionary: typing.Any, keys: typing.Iterable, default: typing.Any = None) -> typing.Any:
     """
     Dig into a dictionary following the iterable of keys.
-    Safely handles non-existant gets as well as the dictionary itself being None.
+    Safely handles non-existant gets as well as the dictionary itself being None, or not a dictionary at all.
     Return :default if it fails at any point in its journey, otherwise return result.
     """
 
-    if type(dictionary) != dict:
+    if type(dictionary) is not dict:
         return default
 
     result = dictionary
     for key in keys:
         # cython hates walruses :(
         result = result.get(key, _DEEP_GET_FAIL)
-        if result == _DEEP_GET_FAIL:
+        if result is _DEEP_GET_FAIL:
             return default
 
     return result
+
+# ========
+def percentile(values: typing.Sequence[float], fraction: float) -> typing.Union[float, None]:
+    """
+    Nearest-rank percentile of :values, where :fraction is between 0 and 1 (.5 == median).
+    Returns None if there are no values.
+    """
+
+    if len(values) == 0:
+        return None
+
+    ordered = sorted(values)
+    index   = min(len(ordered), max(1, math.ceil(fraction * len(ordered)))) - 1
+    return ordered[index]
@@ -147,15 +147,16 @@ def main():
                               ],
 
             'packages': TARGET_PACKAGES + [
-                'ctypes', 'datetime', 'http.server', 'json', 'multiprocessing', 'os', 'queue', 'sqlite3', 'sys', 'time', 'typing', 'urllib.parse', 'webbrowser',
+                'ctypes', 'datetime', 'http.server', 'json', 'logging', 'multiprocessing', 'os', 'queue', 'sqlite3', 'sys', 'time', 'typing', 'urllib.parse', 'webbrowser',
                 'encodings', 'encodings.cp949', 'encodings.utf_8', 'encodings.ascii',
                 'pkg_resources._vendor', 'requests', 'requests_oauthlib',
                 'pywintypes', 'win32api', 'win32con', 'win32gui_struct', 'win32gui'
             ],
 
             'excludes': [
-                'tkinter', 'cProfile', 'profile', 'pdb', 'pydoc', 'doctest', 'cryptography', #'cryptography.hazmat.bindings._openssl', 'cryptography.hazmat.bindings._rust',
-                'Cython', 'zodbpickle', 'lib2to3', 'unittest', 'asyncio', 'jinja2', 'ctypes.test'
+                'tkinter', 'pdb', 'pydoc', 'doctest', 'cryptography', #'cryptography.hazmat.bindings._openssl', 'cryptography.hazmat.bindings._rust',
+                'Cython', 'zodbpickle', 'lib2to3', 'unittest', 'jinja2', 'ctypes.test',
+                'jeepney'  # MPRIS (libs.nowplaying) is Linux only
             ],
 
             # cx_freeze includes JRE DLLs for unknown reasons